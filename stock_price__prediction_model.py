@@ -1,140 +1,876 @@
 # -*- coding: utf-8 -*-
-"""Stock_price _prediction_model.ipynb
-
-Automatically generated by Colab.
+"""
+Improved Stock Price Prediction Model
+改良版株価予測モデル
 
-Original file is located at
-    https://colab.research.google.com/drive/1lqYE2wH45Kt38BcfrLYUA9RTlRmXM6AF
+使い方:
+    python stock_price__prediction_model.py                   # 全工程を実行（従来通り）
+    python stock_price__prediction_model.py --headless run    # 描画・EDAなしで全工程を実行
+    python stock_price__prediction_model.py {ingest,features,train,backtest,predict,startup} ...
+    python stock_price__prediction_model.py benchmark --scale small medium [--compare benchmarks/<基準>.json]
+    python stock_price__prediction_model.py --profile-dir logs [--profile cprofile|torch] train ...
 
-### 1. Importing Required Libraries <br>
-### 必要なライブラリのインポート
+matplotlib・seaborn・statsmodels・scikit-learnは使用する関数の中で読み込むため、
+インポート時に読み込まれるのはpandas・numpy・torchだけである。
 """
 
+# ライブラリのインポート
+import io
+import abc
+import os
+import sys
+import glob
+import json
+import copy
+import math
+import time
+import queue
+import shutil
+import argparse
+import platform
+import tempfile
+import hashlib
+import functools
+import itertools
+import threading
+import subprocess
+import multiprocessing
+import contextlib
+import cProfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import pandas as pd
 import numpy as np
-import math
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset, get_worker_info
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 描画の設定
+# --headlessでは描画をすべて省略し、--plot-dirを指定すると画面に表示する代わりにPNGとして保存する
+PLOT_SETTINGS = {'enabled': True, 'output_dir': None}
+
+def load_pyplot():
+    import matplotlib
+    if PLOT_SETTINGS['output_dir'] is not None:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import japanize_matplotlib
+    return plt
+
+def show_figure(plt, name):
+    if PLOT_SETTINGS['output_dir'] is None:
+        plt.show()
+        return
+    os.makedirs(PLOT_SETTINGS['output_dir'], exist_ok=True)
+    plt.savefig(os.path.join(PLOT_SETTINGS['output_dir'], f'{name}.png'))
+    plt.close()
+
+# 計測（プロファイリング）
+# 工程ごとの経過時間・ピークRSS・テンソルのメモリ量と、エポックごとのスループットを記録する
+# --profile-dirを指定した場合だけ有効になり、JSON Lines・CSVとして保存する
+def peak_rss_mb():
+    # Linuxでは/proc/self/statusのVmHWMを使う（reset_peak_rssでリセットできる）
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+# ピークRSSを現在のRSSに戻す（Linuxのみ。リセットできない場合はFalse）
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+# ビュー（系列のウィンドウなど）は元のストレージの大きさで数え、同じストレージは1回だけ数える
+def tensor_mb(*tensors):
+    storages = {t.untyped_storage().data_ptr(): t.untyped_storage().nbytes() for t in tensors if isinstance(t, torch.Tensor)}
+    return sum(storages.values()) / (1024 * 1024)
+
+class Instrumentation:
+    def __init__(self):
+        self.enabled = False
+        self.output_dir = None
+        self.capture = None
+        self.records = []
+        self.local = threading.local()
+        self.capture_lock = threading.Lock()
+        self.captures = 0
+        self.prefix = None
+
+    # 工程グラフの工程はスレッドで同時に実行されるため、入れ子の深さはスレッドごとに数える
+    @property
+    def depth(self):
+        return getattr(self.local, 'depth', 0)
+
+    @depth.setter
+    def depth(self, value):
+        self.local.depth = value
+
+    def configure(self, output_dir, capture=None, prefix=None):
+        self.enabled = True
+        self.output_dir = output_dir
+        self.capture = capture
+        self.prefix = prefix or time.strftime('run-%Y%m%d-%H%M%S')
+        os.makedirs(output_dir, exist_ok=True)
+
+    def log(self, kind, **fields):
+        if self.enabled:
+            self.records.append({'kind': kind, 'time': time.time(), **fields})
+
+    # 工程の計測。最上位の工程だけcProfileまたはtorch.profilerで詳細を取得する
+    # （複数のスレッドで同時に最上位の工程を実行している場合は、先に始まった1つだけを取得する）
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        if not self.enabled:
+            yield fields
+            return
+        profiler = None
+        if self.capture and self.depth == 0 and self.capture_lock.acquire(blocking=False):
+            if self.capture == 'torch':
+                profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True)
+                profiler.__enter__()
+            else:
+                profiler = cProfile.Profile()
+                profiler.enable()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.depth += 1
+        started = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            seconds = time.perf_counter() - started
+            self.depth -= 1
+            if profiler is not None:
+                self.captures += 1
+                path = os.path.join(self.output_dir, f'{self.prefix}-{self.captures:03d}-{name}')
+                if self.capture == 'torch':
+                    profiler.__exit__(None, None, None)
+                    profiler.export_chrome_trace(path + '.json')
+                else:
+                    profiler.disable()
+                    profiler.dump_stats(path + '.prof')
+                self.capture_lock.release()
+            if torch.cuda.is_available():
+                fields['cuda_peak_mb'] = torch.cuda.max_memory_allocated() / (1024 * 1024)
+            self.log('stage', stage=name, seconds=seconds, peak_rss_mb=peak_rss_mb(), **fields)
+
+    def save(self, prefix=None):
+        if not self.enabled or not self.records:
+            return None
+        base = os.path.join(self.output_dir, prefix or self.prefix)
+        with open(base + '.jsonl', 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record, default=str) + '\n')
+        records = pd.DataFrame(self.records)
+        for kind, group in records.groupby('kind'):
+            group.dropna(axis=1, how='all').to_csv(f'{base}-{kind}s.csv', index=False)
+        print(f'Saved instrumentation logs to {base}.jsonl')
+        return base
+
+INSTRUMENTATION = Instrumentation()
 
-"""### 2. Loading and Preprocessing the Data
- ### データの読み込みと前処理
-
-"""
-
-df = pd.read_csv('stock_price.csv')
-
-# Renaming columns for consistency
-df.columns = ['Date', 'Close', 'Open', 'High', 'Low', 'Volume', 'Change_Rate']
-
-# Converting 'Date' to datetime and sorting the data by date
-df['Date'] = pd.to_datetime(df['Date'])
-df = df.sort_values('Date')
-df.set_index('Date', inplace=True)
-
-# Convert 'Volume' to numeric (handling millions and billions)
-def convert_volume(x):
-    if isinstance(x, str):
-        if 'M' in x:
-            return float(x.replace('M', '')) * 1e6
-        elif 'B' in x:
-            return float(x.replace('B', '')) * 1e9
-    return float(x)
-
-df['Volume'] = df['Volume'].apply(convert_volume)
-
-# Converting 'Change_Rate' from percentage to decimal
-df['Change_Rate'] = df['Change_Rate'].str.rstrip('%').astype('float') / 100.0
-
-"""### 3. Exploratory Data Analysis (EDA)
-### 探索的データ分析（EDA）
+# データの読み込みと前処理
+# CSVの列名と読み込み時の型
+COLUMN_NAMES = ['Date', 'Close', 'Open', 'High', 'Low', 'Volume', 'Change_Rate']
+CSV_DTYPES = {'Close': 'float64', 'Open': 'float64', 'High': 'float64', 'Low': 'float64',
+              'Volume': 'str', 'Change_Rate': 'str'}
+CACHE_DIR = '.cache'
+
+# ボリュームの変換（単位：百万株、十億株）を列全体でベクトル化して行う
+def convert_volume(volume):
+    volume = volume.astype(str).str.strip()
+    multiplier = np.select([volume.str.endswith('M'), volume.str.endswith('B')], [1e6, 1e9], default=1.0)
+    return volume.str.rstrip('MB').astype('float') * multiplier
+
+# CSVを解析してDataFrameに変換
+def parse_stock_csv(file_path):
+    return parse_stock_frame(pd.read_csv(file_path, header=0, names=COLUMN_NAMES, dtype=CSV_DTYPES))
+
+def parse_stock_frame(df):
+    df['Date'] = pd.to_datetime(df['Date'])
+    df = df.sort_values('Date')
+    df.set_index('Date', inplace=True)
 
+    df['Volume'] = convert_volume(df['Volume'])
 
-"""
+    # 変化率をパーセンテージから小数に変換
+    df['Change_Rate'] = df['Change_Rate'].str.rstrip('%').astype('float') / 100.0
 
-# Displaying the basic information and summary of the dataset
-print(df.info())
-print(df.describe())
-
-# Plotting the time series of 'Close' prices
-plt.figure(figsize=(12, 6))
-plt.plot(df.index, df['Close'])
-plt.title('NTT Stock Closing Prices Over Time')
-plt.xlabel('Date')
-plt.ylabel('Close Price')
-plt.show()
-
-# Decomposing the series to observe trend and seasonality
-from statsmodels.tsa.seasonal import seasonal_decompose
-result = seasonal_decompose(df['Close'], model='multiplicative', period=30)
-result.plot()
-plt.show()
-
-"""### 4. Feature Engineering
-### 特徴量エンジニアリング
-"""
+    return df
 
-# Creating lag features and rolling statistics
-df['Lag_1'] = df['Close'].shift(1)
-df['Lag_7'] = df['Close'].shift(7)
-df['Rolling_Mean_7'] = df['Close'].rolling(window=7).mean()
-df['Rolling_Std_7'] = df['Close'].rolling(window=7).std()
+# 一時ファイルに書いてからpathに置き換える（読み手が書き込み途中のファイルを見ないようにする）
+# 一時ファイル名はmkstempで決めるので、同じプロセスの複数スレッドから同時に書いても衝突しない
+def write_atomically(path, write):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+# ファイル内容のハッシュと更新時刻からキャッシュキーを作成
+# cache_dirを指定すると(サイズ, 更新時刻)と結果をcache_dir/fingerprints/にファイルごとに記録し、
+# どちらも変わっていなければファイルを読まずに記録済みの値を返す（変わっていればハッシュを計算し直す）
+def file_fingerprint(file_path, chunk_size=1 << 20, cache_dir=None):
+    stat = os.stat(file_path)
+    record_path = None
+    if cache_dir is not None:
+        source = hashlib.sha256(os.path.abspath(file_path).encode()).hexdigest()[:16]
+        record_path = os.path.join(cache_dir, 'fingerprints', f'{source}.json')
+        try:
+            with open(record_path) as f:
+                record = json.load(f)
+            if (record['size'], record['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+                return record['fingerprint']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    fingerprint = f'{digest.hexdigest()[:16]}-{stat.st_mtime_ns}'
+    if record_path is not None:
+        record = {'path': os.path.abspath(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'fingerprint': fingerprint}
+
+        def write(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump(record, f)
+        write_atomically(record_path, write)
+    return fingerprint
+
+# float32で値が変わらない列だけをfloat32に縮小
+def downcast_column(values):
+    values = np.asarray(values, dtype='float64')
+    downcast = values.astype('float32')
+    if np.array_equal(downcast.astype('float64'), values, equal_nan=True):
+        return downcast
+    return values
+
+# 列ごとの.npyファイルとしてキャッシュを書き込む
+def write_column_cache(df, cache_path):
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(cache_path) or '.', prefix=f'.{os.path.basename(cache_path)}.', suffix='.tmp')
+    np.save(os.path.join(tmp_path, 'Date.npy'), df.index.values)
+    manifest = {'columns': list(df.columns), 'dtypes': {}}
+    for col in df.columns:
+        values = downcast_column(df[col].values)
+        np.save(os.path.join(tmp_path, f'{col}.npy'), values)
+        manifest['dtypes'][col] = str(values.dtype)
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    # 書き込み途中のキャッシュが読まれないように最後にリネームする（別のスレッドが先に置いていれば自分の分は捨てる）
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+# キャッシュをメモリマップで読み込む（CSVの解析は行わない）
+def read_column_cache(cache_path):
+    with open(os.path.join(cache_path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    index = pd.DatetimeIndex(np.load(os.path.join(cache_path, 'Date.npy'), mmap_mode='r'), name='Date')
+    columns = {col: np.load(os.path.join(cache_path, f'{col}.npy'), mmap_mode='r') for col in manifest['columns']}
+    return pd.DataFrame(columns, index=index, copy=False)
+
+def load_and_preprocess_data(file_path, cache_dir=CACHE_DIR, use_cache=True):
+    with INSTRUMENTATION.stage('ingest', source=file_path) as record:
+        if not use_cache:
+            record['cache'] = 'disabled'
+            return parse_stock_csv(file_path)
+
+        stem = os.path.splitext(os.path.basename(file_path))[0]
+        cache_path = os.path.join(cache_dir, f'{stem}-{file_fingerprint(file_path, cache_dir=cache_dir)}')
+        if os.path.exists(os.path.join(cache_path, 'manifest.json')):
+            record['cache'] = 'hit'
+            return read_column_cache(cache_path)
+
+        record['cache'] = 'miss'
+        df = parse_stock_csv(file_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        write_column_cache(df, cache_path)
+        return df
+
+# CSVをおよそchunk_rows行ずつ古い順に読み込む（ファイル全体をメモリに載せない）
+# stock_price.csvのように新しい日付が先頭のファイルは、末尾からブロック単位で逆向きに読む
+def iter_stock_csv(file_path, chunk_rows=100_000):
+    with open(file_path, 'rb') as f:
+        data_start = len(f.readline())
+        first, second = f.readline(), f.readline()
+    dates = [line.split(b',', 1)[0].decode() for line in (first, second) if line.strip()]
+    if len(dates) < 2 or pd.to_datetime(dates[0]) <= pd.to_datetime(dates[1]):
+        for chunk in pd.read_csv(file_path, header=0, names=COLUMN_NAMES, dtype=CSV_DTYPES, chunksize=chunk_rows):
+            yield parse_stock_frame(chunk)
+        return
+    for block in iter_reversed_blocks(file_path, data_start, len(first) * chunk_rows):
+        yield parse_stock_frame(pd.read_csv(io.BytesIO(block), header=None, names=COLUMN_NAMES, dtype=CSV_DTYPES))
+
+# ファイル末尾から約block_sizeバイトずつ、完全な行だけからなるブロックを返す
+def iter_reversed_blocks(file_path, data_start, block_size):
+    with open(file_path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        carry = b''
+        while end > data_start:
+            start = max(data_start, end - block_size)
+            f.seek(start)
+            block = f.read(end - start) + carry
+            end = start
+            if start > data_start:
+                # 先頭の不完全な行は、ファイル上で1つ前のブロックと結合する
+                cut = block.find(b'\n') + 1
+                if cut == 0:
+                    carry = block
+                    continue
+                carry, block = block[:cut], block[cut:]
+            else:
+                carry = b''
+            if block.strip():
+                yield block
 
-# Dropping rows with missing values after creating lag features
-df.dropna(inplace=True)
+# 特徴量エンジニアリング
+# 一括計算と逐次更新の両方で同じ演算順序を使うことで、結果がビット単位で一致する
+FEATURE_COLUMNS = ['Open', 'High', 'Low', 'Volume', 'Change_Rate', 'Lag_1', 'Lag_7', 'Rolling_Mean_7', 'Rolling_Std_7', 'MACD', 'Signal_Line', 'RSI']
+ENGINEERED_COLUMNS = ['Lag_1', 'Lag_7', 'Rolling_Mean_7', 'Rolling_Std_7', 'EMA12', 'EMA26', 'MACD', 'Signal_Line', 'RSI']
+RSI_WINDOW = 14
+
+# 先頭から順に足し合わせる（配列でもスカラーでも同じ順序で計算される）
+def ordered_sum(terms):
+    total = terms[0]
+    for term in terms[1:]:
+        total = total + term
+    return total
+
+def window_mean(terms):
+    return ordered_sum(terms) / len(terms)
+
+# 不偏標準偏差（pandasのrolling().std()と同じddof=1）
+def window_std(terms):
+    mean = window_mean(terms)
+    squares = [(term - mean) * (term - mean) for term in terms]
+    return np.sqrt(ordered_sum(squares) / (len(terms) - 1))
+
+def rsi_from_means(gain, loss):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rs = np.divide(gain, loss)
+        return 100 - (100 / (1 + rs))
+
+# 1本分のEMAの更新。pandasのewm(adjust=False)と同じ漸化式（重みの和で割る）で、ema_seriesとビット単位で一致する
+def ema_step(prev, value, span):
+    if prev is None or prev != prev:
+        return value
+    alpha = 2.0 / (span + 1)
+    old = 1.0 - alpha
+    return (old * prev + alpha * value) / (old + alpha)
+
+# 一括計算用：各時点の直近window個の値を、古い順に並んだ配列のリストとして返す
+def window_terms(values, window):
+    n = len(values) - window + 1
+    return [values[k:k + n] for k in range(window)]
+
+def lag_values(values, periods):
+    out = np.full(len(values), np.nan)
+    if len(values) > periods:
+        out[periods:] = values[:len(values) - periods]
+    return out
+
+def rolling_apply(values, window, func):
+    out = np.full(len(values), np.nan)
+    if len(values) >= window:
+        out[window - 1:] = func(window_terms(values, window))
+    return out
+
+# resetsがTrueの行（銘柄の先頭など）でEMAを初期化し直す。initialは直前の行までのEMA（チャンクの継続用）
+# pandasのewm(adjust=False)で計算する。initialは先頭に1行加えて続きから計算し、初期化し直す行があれば
+# その区間ごとにgroupbyでまとめて計算する
+def ema_series(values, span, resets=None, initial=None):
+    continued = initial is not None and initial == initial and not (resets is not None and len(resets) and resets[0])
+    if continued:
+        values = np.concatenate([[initial], values])
+        resets = np.concatenate([[False], resets]) if resets is not None else None
+    series = pd.Series(values, dtype='float64')
+    if resets is None or not resets[1:].any():
+        out = series.ewm(span=span, adjust=False).mean().to_numpy()
+    else:
+        out = series.groupby(np.cumsum(resets)).ewm(span=span, adjust=False).mean().to_numpy()
+    return out[1:] if continued else out
+
+# 終値の配列から全特徴量を一括計算する
+# positionは各行の銘柄内での位置（単一銘柄ではarange）で、窓が銘柄の境界をまたぐ行は欠損値にする
+# 先頭のhistory行は前のチャンクの終値で、ラグ・移動平均・RSIの窓にだけ使い、EMAはema_initialから続けて計算する
+def compute_features(close, position=None, history=0, ema_initial=(None, None, None)):
+    if position is None:
+        position = np.arange(len(close))
+    lag_1 = np.where(position >= 1, lag_values(close, 1), np.nan)
+    delta = close - lag_1
+    gain = np.where(delta > 0, delta, 0.0)
+    loss = np.where(delta < 0, -delta, 0.0)
+
+    features = {
+        'Lag_1': lag_1,
+        'Lag_7': np.where(position >= 7, lag_values(close, 7), np.nan),
+        'Rolling_Mean_7': np.where(position >= 6, rolling_apply(close, 7, window_mean), np.nan),
+        'Rolling_Std_7': np.where(position >= 6, rolling_apply(close, 7, window_std), np.nan),
+    }
+    # MACD (Moving Average Convergence Divergence)
+    resets = position[history:] == 0
+    padding = np.full(history, np.nan)
+    ema12 = ema_series(close[history:], 12, resets, ema_initial[0])
+    ema26 = ema_series(close[history:], 26, resets, ema_initial[1])
+    features['EMA12'] = np.concatenate([padding, ema12])
+    features['EMA26'] = np.concatenate([padding, ema26])
+    features['MACD'] = features['EMA12'] - features['EMA26']
+    features['Signal_Line'] = np.concatenate([padding, ema_series(ema12 - ema26, 9, resets, ema_initial[2])])
 
-"""### 5. Data Normalization and Splitting
-### データの正規化と分割
-"""
+    # RSI (Relative Strength Index)
+    rsi = rsi_from_means(rolling_apply(gain, RSI_WINDOW, window_mean), rolling_apply(loss, RSI_WINDOW, window_mean))
+    features['RSI'] = np.where(position >= RSI_WINDOW - 1, rsi, np.nan)
+    return features, gain, loss
+
+class FeatureEngine:
+    def __init__(self):
+        # 直近の終値（ラグ・移動平均には8本、チャンク境界でのRSIの再計算には14本）、RSI用の値上がり幅・値下がり幅、
+        # 各EMAの最新値と、これまでに取り込んだ行数を状態として保持する
+        self.closes = deque(maxlen=RSI_WINDOW)
+        self.gains = deque(maxlen=RSI_WINDOW)
+        self.losses = deque(maxlen=RSI_WINDOW)
+        self.ema12 = None
+        self.ema26 = None
+        self.signal = None
+        self.count = 0
+
+    # コールドスタート：履歴全体から特徴量を一括計算し、状態を末尾から復元する
+    def fit_transform(self, df):
+        close = df['Close'].to_numpy(dtype='float64')
+        features, gain, loss = compute_features(close)
+
+        self.closes.clear()
+        self.gains.clear()
+        self.losses.clear()
+        self.ema12 = self.ema26 = self.signal = None
+        self.count = len(close)
+        self.carry_state(close, features, gain, loss)
+
+        # 呼び出し元のDataFrameは変更せず、欠損値を含む行を除いた新しいDataFrameを返す
+        return df.assign(**{col: features[col] for col in ENGINEERED_COLUMNS}).dropna()
+
+    # 次のチャンク（または逐次更新）のために、計算済みの配列の末尾から状態を更新する
+    def carry_state(self, close, features, gain, loss):
+        self.closes.extend(close[-RSI_WINDOW:].tolist())
+        self.gains.extend(gain[-RSI_WINDOW:].tolist())
+        self.losses.extend(loss[-RSI_WINDOW:].tolist())
+        if len(close):
+            self.ema12 = features['EMA12'][-1]
+            self.ema26 = features['EMA26'][-1]
+            self.signal = features['Signal_Line'][-1]
+
+    # 1チャンク分の特徴量をベクトル化して計算する。直前までの終値とEMAを引き継ぐため、
+    # チャンクに分けて計算しても履歴全体をfit_transformした結果とビット単位で一致する
+    def transform_chunk(self, chunk):
+        close = chunk['Close'].to_numpy(dtype='float64')
+        history = np.array(self.closes, dtype='float64')
+        combined = np.concatenate([history, close])
+        position = np.arange(self.count - len(history), self.count + len(close))
+        features, gain, loss = compute_features(combined, position, history=len(history),
+                                                ema_initial=(self.ema12, self.ema26, self.signal))
+        self.count += len(close)
+        self.carry_state(close, features, gain[len(history):], loss[len(history):])
+        return chunk.assign(**{col: features[col][len(history):] for col in ENGINEERED_COLUMNS}).dropna()
+
+    # 新しい日足1本分の特徴量をO(1)で計算する（欠損がある場合はNoneを返す）
+    def update(self, date, bar):
+        close = float(bar['Close'])
+        delta = close - self.closes[-1] if self.closes else np.nan
+        self.gains.append(delta if delta > 0 else 0.0)
+        self.losses.append(-delta if delta < 0 else 0.0)
+        self.closes.append(close)
+        self.count += 1
+        closes = list(self.closes)
+
+        self.ema12 = ema_step(self.ema12, close, 12)
+        self.ema26 = ema_step(self.ema26, close, 26)
+        macd = self.ema12 - self.ema26
+        self.signal = ema_step(self.signal, macd, 9)
+
+        row = dict(bar)
+        row['Lag_1'] = closes[-2] if len(closes) >= 2 else np.nan
+        row['Lag_7'] = closes[-8] if len(closes) >= 8 else np.nan
+        row['Rolling_Mean_7'] = window_mean(closes[-7:]) if len(closes) >= 7 else np.nan
+        row['Rolling_Std_7'] = window_std(closes[-7:]) if len(closes) >= 7 else np.nan
+        row['EMA12'] = self.ema12
+        row['EMA26'] = self.ema26
+        row['MACD'] = macd
+        row['Signal_Line'] = self.signal
+        if len(self.gains) == RSI_WINDOW:
+            row['RSI'] = rsi_from_means(window_mean(list(self.gains)), window_mean(list(self.losses)))
+        else:
+            row['RSI'] = np.nan
+
+        row = pd.Series(row, name=date, dtype='float64')
+        if row.isna().any():
+            return None
+        return row
+
+    # オンライン更新のために状態をJSONで保存・復元する
+    def state_dict(self):
+        return {'closes': list(self.closes), 'gains': list(self.gains), 'losses': list(self.losses),
+                'ema12': self.ema12, 'ema26': self.ema26, 'signal': self.signal, 'count': self.count}
+
+    def load_state_dict(self, state):
+        self.closes = deque(state['closes'], maxlen=RSI_WINDOW)
+        self.gains = deque(state['gains'], maxlen=RSI_WINDOW)
+        self.losses = deque(state['losses'], maxlen=RSI_WINDOW)
+        self.ema12, self.ema26, self.signal = state['ema12'], state['ema26'], state['signal']
+        self.count = state['count']
+
+    # 追加された複数の日足を順に取り込み、特徴量が揃った行だけを返す
+    def transform_new(self, new_df):
+        rows = [self.update(date, bar) for date, bar in new_df.iterrows()]
+        rows = [row for row in rows if row is not None]
+        if not rows:
+            return new_df.iloc[:0].assign(**{col: np.nan for col in ENGINEERED_COLUMNS})
+        features = pd.DataFrame(rows)
+        features.index.name = new_df.index.name
+        return features
 
-# Initializing scalers for the features (X) and target (y)
-scaler_X = MinMaxScaler()
-scaler_y = MinMaxScaler()
+def engineer_features(df):
+    with INSTRUMENTATION.stage('features', rows=len(df)):
+        return FeatureEngine().fit_transform(df)
+
+# CSVをチャンクごとに読みながら特徴量を計算する（チャンク間で窓とEMAの状態を引き継ぐ）
+def iter_feature_chunks(file_path, chunk_rows=100_000):
+    engine = FeatureEngine()
+    for chunk in iter_stock_csv(file_path, chunk_rows):
+        features = engine.transform_chunk(chunk)
+        if len(features):
+            yield features
+
+# 計算結果のキャッシュ
+# データ・設定のハッシュをキーとしてcache_dirにCSVで保存し、同じ入力では再計算しない（特徴量重要度・EDAで共通）
+def cached_frame(cache_dir, kind, key, compute, use_cache=True):
+    if not use_cache or cache_dir is None:
+        return compute()
+    cache_path = os.path.join(cache_dir, f'{kind}-{key}.csv')
+    if os.path.exists(cache_path):
+        INSTRUMENTATION.log('cache', name=kind, result='hit')
+        return pd.read_csv(cache_path)
+    result = compute()
+    write_atomically(cache_path, lambda tmp_path: result.to_csv(tmp_path, index=False))
+    return result
 
-# Defining features and target variable
-X = df[['Open', 'High', 'Low', 'Volume', 'Change_Rate', 'Lag_1', 'Lag_7', 'Rolling_Mean_7', 'Rolling_Std_7']]
-y = df[['Close']]
+# 探索的データ分析 (EDA)
+# mode='full'は従来通りすべての点を描画する。mode='scalable'は数百万行・多銘柄のデータ向けで、
+# 折れ線はLTTB（またはmin-max）でmax_points点に間引き、分布はKDEの代わりにビンの度数とそこから求めた近似分位点で要約する
+# 分解と相関はデータのハッシュをキーとしてキャッシュする。描画はどちらのモードでもバックグラウンドのプロセスで行う
+# downsampleは折れ線の間引き方（'lttb'または'minmax'）
+# mode='auto'は行数がEDA_FULL_MAX_ROWS以下ならfull、それより多ければscalable
+EDA_FULL_MAX_ROWS = 100_000
+EDA_MAX_POINTS = 2000
+EDA_RENDERER = {'executor': None, 'futures': []}
+
+def perform_eda(df, mode='auto', max_points=EDA_MAX_POINTS, cache_dir=CACHE_DIR, downsample='lttb'):
+    if mode == 'auto':
+        mode = 'full' if len(df) <= EDA_FULL_MAX_ROWS else 'scalable'
+    if mode == 'scalable':
+        return perform_scalable_eda(df, max_points=max_points, cache_dir=cache_dir, downsample=downsample)
+    if mode != 'full':
+        raise ValueError(f"Unknown EDA mode: {mode}")
+
+    print(df.describe())
+    return [future for future in [submit_render(render_full_eda, df)] if future is not None]
+
+# mode='full'の図（すべての点を描画する）
+def render_full_eda(df):
+    plt = load_pyplot()
+    import seaborn as sns
+    from statsmodels.tsa.seasonal import seasonal_decompose
 
-# Scaling the features and target variable
-X_scaled = pd.DataFrame(scaler_X.fit_transform(X), columns=X.columns, index=X.index)
-y_scaled = pd.DataFrame(scaler_y.fit_transform(y), columns=y.columns, index=y.index)
+    plt.figure(figsize=(12, 6))
+    plt.plot(df.index, df['Close'])
+    plt.title('NTT株価の推移')
+    plt.xlabel('日付')
+    plt.ylabel('終値')
+    show_figure(plt, 'eda_close')
 
-# Splitting the data into training and test sets (no shuffling for time series)
-X_train, X_test, y_train, y_test = train_test_split(X_scaled, y_scaled, test_size=0.2, shuffle=False)
+    # トレンドと季節性の分解
+    result = seasonal_decompose(df['Close'], model='multiplicative', period=30)
+    result.plot()
+    show_figure(plt, 'eda_decomposition')
 
-# Converting data to PyTorch tensors
-X_train_tensor = torch.FloatTensor(X_train.values)
-y_train_tensor = torch.FloatTensor(y_train.values)
-X_test_tensor = torch.FloatTensor(X_test.values)
-y_test_tensor = torch.FloatTensor(y_test.values)
+    # 相関ヒートマップ
+    plt.figure(figsize=(12, 10))
+    sns.heatmap(df.corr(), annot=True, cmap='coolwarm')
+    plt.title('特徴量間の相関')
+    show_figure(plt, 'eda_correlation')
 
-"""### 6. Defining the Models
-### モデルの定義
+    # 分布プロット
+    plt.figure(figsize=(15, 10))
+    for i, col in enumerate(['Close', 'Volume', 'Change_Rate', 'RSI']):
+        plt.subplot(2, 2, i+1)
+        sns.histplot(df[col], kde=True)
+        plt.title(f'{col}の分布')
+    plt.tight_layout()
+    show_figure(plt, 'eda_distributions')
+
+# Largest-Triangle-Three-Buckets：各区間から、前に選んだ点と次の区間の平均点とで作る三角形が最大になる点を選ぶ
+# 形（山・谷）を保ったままn_out点に減らす。戻り値は選んだ行番号（昇順）
+def lttb_indices(values, n_out):
+    y = np.asarray(values, dtype='float64')
+    n = len(y)
+    if n <= 2 * n_out or n_out < 3:
+        return np.arange(n)
+    x = np.arange(n, dtype='float64')
+    edges = np.linspace(1, n - 1, n_out - 1).astype('int64')
+    selected = np.empty(n_out, dtype='int64')
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        following = y[end:next_end]
+        avg_x = x[end:next_end].mean()
+        avg_y = np.nanmean(following) if np.isfinite(following).any() else y[a]
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(np.where(np.isnan(area), -1.0, area)))
+        selected[i + 1] = a
+    return selected
+
+# 区間ごとの最小値と最大値の行を残す（n_out // 2区間。ノイズの多い系列の振れ幅を保つ）
+def minmax_indices(values, n_out):
+    y = np.asarray(values, dtype='float64')
+    n = len(y)
+    n_buckets = max(1, n_out // 2)
+    if n <= n_out:
+        return np.arange(n)
+    size = n // n_buckets
+    blocks = y[:size * n_buckets].reshape(n_buckets, size)
+    offsets = np.arange(n_buckets) * size
+    lows = offsets + np.argmin(np.where(np.isnan(blocks), np.inf, blocks), axis=1)
+    highs = offsets + np.argmax(np.where(np.isnan(blocks), -np.inf, blocks), axis=1)
+    return np.unique(np.concatenate([[0, n - 1], lows, highs]))
+
+def downsample_indices(values, max_points=EDA_MAX_POINTS, method='lttb'):
+    return lttb_indices(values, max_points) if method == 'lttb' else minmax_indices(values, max_points)
+
+# ビンの度数による分布の要約（1パス）。分位点は度数の累積分布から線形補間した近似値
+def binned_summary(values, bins=64):
+    values = np.asarray(values, dtype='float64')
+    values = values[np.isfinite(values)]
+    counts, edges = np.histogram(values, bins=bins)
+    cdf = np.concatenate([[0.0], np.cumsum(counts) / max(counts.sum(), 1)])
+    summary = {'count': len(values), 'mean': float(values.mean()), 'std': float(values.std(ddof=1)) if len(values) > 1 else np.nan,
+               'min': float(edges[0]), 'max': float(edges[-1])}
+    summary.update({f'p{int(q * 100)}': float(np.interp(q, cdf, edges)) for q in (0.01, 0.25, 0.5, 0.75, 0.99)})
+    return counts, edges, summary
+
+# 分解（multiplicative, period=30）の各成分を間引いた表。終値のハッシュをキーとしてキャッシュする
+def cached_decomposition(close, max_points=EDA_MAX_POINTS, period=30, cache_dir=CACHE_DIR, downsample='lttb'):
+    values = close.to_numpy(dtype='float64')
+    settings = np.frombuffer(json.dumps(['decomposition', period, max_points, downsample]).encode(), dtype='uint8')
+
+    def compute():
+        from statsmodels.tsa.seasonal import seasonal_decompose
+
+        with INSTRUMENTATION.stage('decomposition', rows=len(values)):
+            result = seasonal_decompose(values, model='multiplicative', period=period)
+            rows = downsample_indices(values, max_points, downsample)
+            return pd.DataFrame({'date': close.index[rows], 'observed': values[rows], 'trend': result.trend[rows],
+                                 'seasonal': result.seasonal[rows], 'resid': result.resid[rows]})
+
+    decomposition = cached_frame(cache_dir, 'eda-decomposition', array_fingerprint(values, settings), compute)
+    decomposition['date'] = pd.to_datetime(decomposition['date'])
+    return decomposition
+
+def cached_correlation(df, cache_dir=CACHE_DIR):
+    numeric = df.select_dtypes('number')
+    values = numeric.to_numpy(dtype='float64')
+    settings = np.frombuffer(json.dumps(['correlation', list(numeric.columns)]).encode(), dtype='uint8')
+
+    def compute():
+        with INSTRUMENTATION.stage('correlation', rows=len(values), columns=values.shape[1]):
+            corr = np.corrcoef(values, rowvar=False)
+        return pd.DataFrame(corr, columns=numeric.columns).assign(feature=numeric.columns)
+
+    corr = cached_frame(cache_dir, 'eda-correlation', array_fingerprint(values, settings), compute)
+    return corr.set_index('feature').rename_axis(None)
+
+# 描画（バックグラウンドのプロセスで実行する。scalableでは引数は間引き済みの小さな配列だけ）
+def init_render_worker(output_dir):
+    PLOT_SETTINGS.update(enabled=True, output_dir=output_dir)
+
+def render_line(name, title, x, y, xlabel, ylabel):
+    plt = load_pyplot()
+    plt.figure(figsize=(12, 6))
+    plt.plot(x, y)
+    plt.title(title)
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    show_figure(plt, name)
+
+def render_decomposition(name, decomposition):
+    plt = load_pyplot()
+    fig, axes = plt.subplots(4, 1, figsize=(12, 10), sharex=True)
+    for ax, column in zip(axes, ['observed', 'trend', 'seasonal', 'resid']):
+        ax.plot(decomposition['date'], decomposition[column], marker='o' if column == 'resid' else None,
+                linestyle='none' if column == 'resid' else '-', markersize=2)
+        ax.set_ylabel(column.capitalize())
+    show_figure(plt, name)
+
+def render_heatmap(name, corr):
+    plt = load_pyplot()
+    import seaborn as sns
+    plt.figure(figsize=(12, 10))
+    # 列が多い場合はセルごとの注記を省略する
+    sns.heatmap(corr, annot=len(corr) <= 20, cmap='coolwarm')
+    plt.title('特徴量間の相関')
+    show_figure(plt, name)
 
-AR Model <br>
-ARモデル
-"""
+def render_histograms(name, histograms):
+    plt = load_pyplot()
+    plt.figure(figsize=(15, 10))
+    for i, (col, (counts, edges)) in enumerate(histograms.items()):
+        plt.subplot(2, 2, i+1)
+        plt.stairs(counts, edges, fill=True)
+        plt.title(f'{col}の分布')
+    plt.tight_layout()
+    show_figure(plt, name)
+
+# 描画はバックグラウンドのプロセス（1つ）に投入する。画面に表示する場合もそのプロセスでウィンドウを開くため、
+# 呼び出し元（訓練など）は描画を待たずに先へ進む。--headlessでは何も投入しない
+def submit_render(func, *args):
+    if not PLOT_SETTINGS['enabled']:
+        return None
+    if EDA_RENDERER['executor'] is None:
+        EDA_RENDERER['executor'] = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                                       initializer=init_render_worker, initargs=(PLOT_SETTINGS['output_dir'],))
+    future = EDA_RENDERER['executor'].submit(func, *args)
+    EDA_RENDERER['futures'].append(future)
+    return future
+
+# 投入した描画がすべて終わるまで待つ（描画中の例外はここで送出される）
+def wait_for_renders():
+    futures, EDA_RENDERER['futures'] = EDA_RENDERER['futures'], []
+    try:
+        for future in futures:
+            future.result()
+    finally:
+        if EDA_RENDERER['executor'] is not None:
+            EDA_RENDERER['executor'].shutdown()
+            EDA_RENDERER['executor'] = None
+
+def perform_scalable_eda(df, max_points=EDA_MAX_POINTS, cache_dir=CACHE_DIR, distribution_columns=('Close', 'Volume', 'Change_Rate', 'RSI'),
+                         downsample='lttb'):
+    with INSTRUMENTATION.stage('eda', rows=len(df), mode='scalable'):
+        histograms, summaries = {}, {}
+        for col in df.select_dtypes('number').columns:
+            counts, edges, summaries[col] = binned_summary(df[col])
+            if col in distribution_columns:
+                histograms[col] = (counts, edges)
+        print(pd.DataFrame(summaries))
+
+        close = df['Close'].to_numpy(dtype='float64')
+        rows = downsample_indices(close, max_points, downsample)
+        futures = [submit_render(render_line, 'eda_close', 'NTT株価の推移', df.index[rows], close[rows], '日付', '終値')]
+        futures.append(submit_render(render_decomposition, 'eda_decomposition',
+                                     cached_decomposition(df['Close'], max_points, cache_dir=cache_dir, downsample=downsample)))
+        futures.append(submit_render(render_heatmap, 'eda_correlation', cached_correlation(df, cache_dir)))
+        futures.append(submit_render(render_histograms, 'eda_distributions', histograms))
+    return [future for future in futures if future is not None]
 
-class ARModel(nn.Module):
-    def __init__(self, input_dim, hidden_dim, output_dim):
-        super(ARModel, self).__init__()
-        self.hidden_layer = nn.Linear(input_dim, hidden_dim)
-        self.output_layer = nn.Linear(hidden_dim, output_dim)
+# 特徴量重要度の分析
+# 結果はデータ・特徴量の組・設定のハッシュをキーとしてキャッシュする（cached_frame）
+def plot_feature_importance(feature_importance, title='特徴量の重要度', name='feature_importance'):
+    plt = load_pyplot()
+    import seaborn as sns
+    plt.figure(figsize=(10, 6))
+    sns.barplot(x='importance', y='feature', data=feature_importance)
+    plt.title(title)
+    show_figure(plt, name)
+
+# ランダムフォレストの不純度に基づく重要度
+# 木はn_jobsのプロセスで並列に学習し、行数がmax_samplesを超える場合は各木をmax_samples行の部分標本で学習する
+def analyze_feature_importance(X, y, n_jobs=-1, max_samples=100_000, n_estimators=100, cache_dir=CACHE_DIR, use_cache=True,
+                               plot=True):
+    X_values, y_values = X.to_numpy(dtype='float64'), np.ravel(np.asarray(y, dtype='float64'))
+    max_samples = max_samples if len(X_values) > max_samples else None
+    settings = json.dumps([list(X.columns), n_estimators, max_samples]).encode()
+    key = array_fingerprint(X_values, y_values, np.frombuffer(settings, dtype='uint8'))
+
+    def compute():
+        from sklearn.ensemble import RandomForestRegressor
+
+        with INSTRUMENTATION.stage('importance', method='forest', rows=len(X_values), max_samples=max_samples):
+            rf = RandomForestRegressor(n_estimators=n_estimators, random_state=42, n_jobs=n_jobs, max_samples=max_samples)
+            rf.fit(X_values, y_values)
+        return pd.DataFrame({
+            'feature': X.columns,
+            'importance': rf.feature_importances_
+        }).sort_values('importance', ascending=False)
+
+    feature_importance = cached_frame(cache_dir, 'importance-forest', key, compute, use_cache)
+
+    if plot and PLOT_SETTINGS['enabled']:
+        plot_feature_importance(feature_importance)
 
-    def forward(self, x):
-        x = torch.relu(self.hidden_layer(x))
-        return self.output_layer(x)
+    return feature_importance
 
-"""LSTM Model <br>
-LSTMモデル
-"""
+# 訓練済みモデルの並べ替え重要度（正規化済みの系列を入力とする）
+# 特徴量ごとにウィンドウ全体の値をサンプル間で並べ替え、MSEの増加量を重要度とする。再学習は行わない
+def permutation_importance(model, X_seq, y_seq, feature_columns=FEATURE_COLUMNS, n_repeats=3, max_samples=5_000, seed=0,
+                           batch_size=4096, cache_dir=CACHE_DIR, use_cache=True):
+    generator = torch.Generator().manual_seed(seed)
+    if len(X_seq) > max_samples:
+        rows = torch.randperm(len(X_seq), generator=generator)[:max_samples].sort().values
+        X_seq, y_seq = X_seq[rows], y_seq[rows]
+    X_seq, y_seq = X_seq.contiguous(), y_seq.contiguous()
+    weights = [tensor.detach().numpy() for tensor in model.state_dict().values()]
+    settings = json.dumps([type(model).__name__, list(feature_columns), n_repeats, seed]).encode()
+    key = array_fingerprint(X_seq.numpy(), y_seq.numpy(), np.frombuffer(settings, dtype='uint8'), *weights)
+
+    def mse(X):
+        with torch.inference_mode():
+            predictions = torch.cat([model(batch) for batch in torch.split(X, batch_size)])
+        return float(((predictions - y_seq) ** 2).mean())
+
+    def compute():
+        model.eval()
+        with INSTRUMENTATION.stage('importance', method='permutation', model=type(model).__name__, samples=len(X_seq)):
+            base_mse = mse(X_seq)
+            results = []
+            permuted = X_seq.clone()
+            for j, feature in enumerate(feature_columns):
+                increases = []
+                for _ in range(n_repeats):
+                    permuted[:, :, j] = X_seq[torch.randperm(len(X_seq), generator=generator), :, j]
+                    increases.append(mse(permuted) - base_mse)
+                permuted[:, :, j] = X_seq[:, :, j]
+                results.append({'feature': feature, 'importance': float(np.mean(increases)), 'std': float(np.std(increases))})
+        return pd.DataFrame(results).sort_values('importance', ascending=False)
+
+    return cached_frame(cache_dir, 'importance-permutation', key, compute, use_cache)
 
+# モデルの定義
 class LSTMModel(nn.Module):
     def __init__(self, input_dim, hidden_dim, output_dim, num_layers):
         super(LSTMModel, self).__init__()
@@ -150,9 +886,15 @@ class LSTMModel(nn.Module):
         out = self.fc(out[:, -1, :])
         return out
 
-"""Transformer Model <br>
-ランスフォーマーモデル
-"""
+class ARModel(nn.Module):
+    def __init__(self, input_dim, hidden_dim, output_dim):
+        super(ARModel, self).__init__()
+        self.hidden_layer = nn.Linear(input_dim, hidden_dim)
+        self.output_layer = nn.Linear(hidden_dim, output_dim)
+
+    def forward(self, x):
+        x = torch.relu(self.hidden_layer(x))
+        return self.output_layer(x)
 
 class TransformerModel(nn.Module):
     def __init__(self, input_dim, hidden_dim, output_dim, num_layers, nhead):
@@ -186,401 +928,2147 @@ class PositionalEncoding(nn.Module):
     def forward(self, x):
         return x + self.pe[:x.size(0), :]
 
-"""### 7. Training Function
-### トレーニング関数
-"""
-
-def train_model(model, X_train, y_train, epochs=100, lr=0.001):
-    optimizer = optim.Adam(model.parameters(), lr=lr)
-    criterion = nn.MSELoss()
-
-    model.train()
-    for epoch in range(epochs):
-        optimizer.zero_grad()
-        output = model(X_train)
-        loss = criterion(output, y_train)
-        loss.backward()
-        optimizer.step()
-
-        if (epoch+1) % 10 == 0:
-            print(f'Epoch {epoch+1}/{epochs}, Loss: {loss.item():.4f}')
+# 系列長ごとの位置エンコーディング表と因果マスク（PositionalEncodingと同じ式。実際のlookbackの大きさで作成し、使い回す）
+@functools.lru_cache(maxsize=None)
+def positional_table(length, d_model, device='cpu', dtype=torch.float32):
+    position = torch.arange(0, length, dtype=torch.float).unsqueeze(1)
+    div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
+    pe = torch.zeros(length, d_model)
+    pe[:, 0::2] = torch.sin(position * div_term)
+    pe[:, 1::2] = torch.cos(position * div_term)
+    return pe.to(device=device, dtype=dtype)
+
+@functools.lru_cache(maxsize=None)
+def causal_mask(length, device='cpu'):
+    return nn.Transformer.generate_square_subsequent_mask(length, device=device)
+
+# TransformerModelの高速版
+# batch_first=Trueのエンコーダ層を使い、注意はscaled_dot_product_attention（推論時は融合カーネル）で計算する
+# causal=Trueでは各位置が過去の位置だけを参照する。pooling='last'では最終層で最後の位置のクエリだけを計算し、
+# 'mean'では全位置の平均を出力に使う
+class FastTransformerModel(nn.Module):
+    def __init__(self, input_dim, hidden_dim, output_dim, num_layers, nhead, causal=True, pooling='last'):
+        super(FastTransformerModel, self).__init__()
+        if pooling not in ('last', 'mean'):
+            raise ValueError(f"Unknown pooling: {pooling}")
+        self.hidden_dim = (hidden_dim // nhead) * nhead
+        self.causal = causal
+        self.pooling = pooling
+        self.input_projection = nn.Linear(input_dim, self.hidden_dim)
+        self.layers = nn.ModuleList([nn.TransformerEncoderLayer(d_model=self.hidden_dim, nhead=nhead, batch_first=True)
+                                     for _ in range(num_layers)])
+        self.output_projection = nn.Linear(self.hidden_dim, output_dim)
 
-"""### 8. Evaluation Function
-### 評価関数
+    def forward(self, x):
+        length = x.size(1)
+        x = self.input_projection(x) + positional_table(length, self.hidden_dim, str(x.device), x.dtype)
+        mask = causal_mask(length, str(x.device)) if self.causal else None
+        layers = self.layers[:-1] if self.pooling == 'last' else self.layers
+        for layer in layers:
+            x = layer(x, src_mask=mask, is_causal=self.causal)
+        if self.pooling == 'last':
+            x = self.last_token(self.layers[-1], x)
+        else:
+            x = x.mean(dim=1)
+        return self.output_projection(x)
 
+    # 最終層を最後の位置についてだけ計算する（最後の位置はすべての位置を参照できるのでマスクは不要）
+    # nn.TransformerEncoderLayer（norm_first=False）と同じ計算順序
+    @staticmethod
+    def last_token(layer, x):
+        query = x[:, -1:, :]
+        attended = layer.self_attn(query, x, x, need_weights=False)[0]
+        h = layer.norm1(query + layer.dropout1(attended))
+        h = layer.norm2(h + layer.dropout2(layer.linear2(layer.dropout(layer.activation(layer.linear1(h))))))
+        return h[:, 0]
+
+# 古典的なベースライン
+# ニューラルモデルと同じ正規化済みの系列（サンプル, lookback, 特徴量）を入力とし、閉形式で数ミリ秒で当てはめる
+# nn.Moduleとして実装しているため、evaluate_model・EnsembleModelにそのまま渡せる
+# LinearBaselineは抽象クラスで、系列から説明変数を作るdesignをサブクラスで実装する
+class LinearBaseline(nn.Module, abc.ABC):
+    def __init__(self, alpha=0.0):
+        super(LinearBaseline, self).__init__()
+        self.alpha = alpha
+        self.register_buffer('coef', torch.zeros(0))
+        self.register_buffer('intercept', torch.zeros(0))
+
+    @abc.abstractmethod
+    def design(self, x):
+        pass
+
+    # 切片付きの最小二乗（alpha>0ではリッジ）。多期間の目標値は列ごとに同時に解く
+    def fit(self, X, y):
+        A = self.design(torch.as_tensor(X)).double()
+        Y = torch.as_tensor(y).double()
+        A_mean, Y_mean = A.mean(dim=0), Y.mean(dim=0)
+        A, Y = A - A_mean, Y - Y_mean
+        if self.alpha > 0:
+            coef = torch.linalg.solve(A.T @ A + self.alpha * len(A) * torch.eye(A.shape[1], dtype=A.dtype), A.T @ Y)
+        else:
+            coef = torch.linalg.lstsq(A, Y).solution
+        self.coef = coef.float()
+        self.intercept = (Y_mean - A_mean @ coef).float()
+        return self
 
-"""
+    def forward(self, x):
+        return self.design(x) @ self.coef + self.intercept
+
+# AR(p)：直近p本の終値（Lag_1列の系列）に対するOLS
+class ARBaseline(LinearBaseline):
+    def __init__(self, p, lag_index):
+        super(ARBaseline, self).__init__()
+        self.p = p
+        self.lag_index = lag_index
+
+    def design(self, x):
+        return x[:, -self.p:, self.lag_index]
+
+# 最終行の特徴量すべてに対するリッジ回帰
+class RidgeBaseline(LinearBaseline):
+    def design(self, x):
+        return x[:, -1, :]
+
+# 持続（前日の終値をそのまま予測）とEWMA。特徴量の終値（Lag_1）を目標値のスケールに写すだけで、学習する係数はない
+# span='auto'ではfitで訓練データのMSEが最小になるスパンを選ぶ（span=1が持続予測）。多期間ではすべての期間に同じ値を出力する
+class EWMABaseline(nn.Module):
+    def __init__(self, lag_index, scaler_X, scaler_y, span=1):
+        super(EWMABaseline, self).__init__()
+        self.lag_index = lag_index
+        self.span = span
+        self.output_dim = 1
+        # Lag_1（正規化済み）→ 終値 → 目標値（正規化済み）のアフィン変換
+        self.gain = float(scaler_y.scale_[0] / scaler_X.scale_[lag_index])
+        self.offset = float(scaler_y.min_[0] - scaler_X.min_[lag_index] * self.gain)
+
+    @staticmethod
+    def ewma_weights(span, lookback):
+        alpha = 2.0 / (span + 1)
+        weights = (1.0 - alpha) ** torch.arange(lookback - 1, -1, -1, dtype=torch.float64)
+        return weights / weights.sum()
+
+    def fit(self, X, y, spans=(1, 2, 3, 5, 10, 20)):
+        self.output_dim = y.shape[1]
+        if self.span != 'auto':
+            return self
+        X, y = torch.as_tensor(X), torch.as_tensor(y).double()
+        spans = [span for span in spans if span <= X.shape[1]]
+        # 候補のスパンをまとめて1回の行列積で評価する
+        weights = torch.stack([self.ewma_weights(span, X.shape[1]) for span in spans], dim=1)
+        predictions = (X[:, :, self.lag_index].double() @ weights) * self.gain + self.offset
+        mse = ((predictions.unsqueeze(2) - y.unsqueeze(1)) ** 2).mean(dim=(0, 2))
+        self.span = spans[int(mse.argmin())]
+        return self
 
-def evaluate_model(model, X_test, y_test):
+    def forward(self, x):
+        weights = self.ewma_weights(self.span, x.shape[1]).to(x.dtype)
+        value = (x[:, :, self.lag_index] @ weights) * self.gain + self.offset
+        return value.unsqueeze(1).expand(-1, self.output_dim)
+
+# モデルの訓練用データセット（テンソルをコピーせずにインデックスで参照する）
+class TimeSeriesDataset(Dataset):
+    def __init__(self, X, y):
+        self.X = X
+        self.y = y
+
+    def __len__(self):
+        return len(self.X)
+
+    def __getitem__(self, idx):
+        return self.X[idx], self.y[idx]
+
+# スライディングウィンドウによる系列データの作成
+# unfoldで連続したfloat32配列のストライドビューを作るため、重複するウィンドウをコピーしない
+# 窓の最終行がeのとき、目標値はy[e + horizon - 1]（lookback=1, horizon=1は従来のunsqueeze(1)と同じ）
+# multi_output=Trueでは目標値をy[e], ..., y[e + horizon - 1]のhorizon列とする（yの1列目をunfoldしたビュー）
+def make_sequences(X, y, lookback=1, horizon=1, stride=1, multi_output=False):
+    X = torch.as_tensor(X, dtype=torch.float32)
+    y = torch.as_tensor(y, dtype=torch.float32)
+    n_windows = max(0, (len(X) - lookback - horizon + 1) // stride + 1)
+    X_seq = X.unfold(0, lookback, stride)[:n_windows].transpose(1, 2)
+    if multi_output:
+        y_seq = y[lookback - 1:, 0].unfold(0, horizon, stride)[:n_windows]
+    else:
+        y_seq = y[lookback + horizon - 2::stride][:n_windows]
+    return X_seq, y_seq
+
+class SequenceDataset(TimeSeriesDataset):
+    def __init__(self, X, y, lookback=1, horizon=1, stride=1):
+        X_seq, y_seq = make_sequences(X, y, lookback, horizon, stride)
+        super(SequenceDataset, self).__init__(X_seq, y_seq)
+
+# CSVからチャンクごとに特徴量を計算・正規化し、系列を1つずつ返すIterableDataset
+# 保持するのは1チャンク分と、チャンク境界をまたぐウィンドウ用の末尾lookback+horizon-2行だけなので、
+# メモリ使用量は履歴の長さではなくchunk_rowsで決まる
+# 目標値はmake_sequences(multi_output=True)と同じく、窓の最終行から先horizon本の終値（horizon=1では従来の1列）
+# start・stopは目標値の行番号（特徴量の行を先頭から数えたもの）で、訓練・検証の範囲を指定する
+# shuffle=Trueの場合はチャンク内でウィンドウの順序を入れ替える
+class StreamingSequenceDataset(IterableDataset):
+    def __init__(self, file_path, scaler_X, scaler_y, lookback=1, horizon=1, chunk_rows=100_000, start=0, stop=None,
+                 shuffle=False, seed=0):
+        super(StreamingSequenceDataset, self).__init__()
+        self.file_path = file_path
+        self.scaler_X = scaler_X
+        self.scaler_y = scaler_y
+        self.lookback = lookback
+        self.horizon = horizon
+        self.chunk_rows = chunk_rows
+        self.start = start
+        self.stop = stop
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        worker = get_worker_info()
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        context = self.lookback + self.horizon - 2
+        tail_X = np.empty((0, len(FEATURE_COLUMNS)), dtype='float32')
+        tail_y = np.empty((0, 1), dtype='float32')
+        offset = 0
+        for index, features in enumerate(iter_feature_chunks(self.file_path, self.chunk_rows)):
+            X = np.concatenate([tail_X, self.scaler_X.transform(features[FEATURE_COLUMNS].to_numpy(dtype='float64')).astype('float32')])
+            y = np.concatenate([tail_y, self.scaler_y.transform(features[['Close']].to_numpy(dtype='float64')).astype('float32')])
+            X_seq, y_seq = make_sequences(X, y, self.lookback, self.horizon, multi_output=True)
+            targets = offset + context + np.arange(len(X_seq))
+            keep = targets >= self.start
+            if self.stop is not None:
+                keep &= targets < self.stop
+            # 複数ワーカーの場合は、チャンクをワーカーに順番に割り当てる（特徴量の計算は各ワーカーで行う）
+            if worker is None or index % worker.num_workers == worker.id:
+                keep = np.flatnonzero(keep)
+                if self.shuffle:
+                    keep = rng.permutation(keep)
+                for i in keep.tolist():
+                    yield X_seq[i], y_seq[i]
+            # チャンクの配列全体を参照し続けないように、末尾はコピーして持ち越す
+            tail_X, tail_y = X[len(X) - context:].copy(), y[len(y) - context:].copy()
+            offset += len(X) - context
+            if self.stop is not None and offset + context >= self.stop:
+                break
+
+# 特徴量ストア
+# 特徴量と目標値を1つの連続したfloat32配列（行×列、目標値は最後の列）にまとめ、列名から列番号を引けるようにする
+# 正規化は配列上でインプレースに行い、テンソルはtorch.from_numpyで同じメモリを参照する（コピーしない）
+# pathを指定するとメモリマップした.npyファイルとして保存し、FeatureStore.openで開き直せる
+class FeatureStore:
+    def __init__(self, values, columns, index=None):
+        self.values = values
+        self.columns = list(columns)
+        self.column_index = {col: i for i, col in enumerate(self.columns)}
+        self.index = index
+        self.scaler_X = None
+        self.scaler_y = None
+
+    @classmethod
+    def from_frame(cls, df, feature_columns=FEATURE_COLUMNS, target='Close', path=None):
+        columns = list(feature_columns) + [target]
+        shape = (len(df), len(columns))
+        if path is None:
+            values = np.empty(shape, dtype='float32')
+        else:
+            os.makedirs(path, exist_ok=True)
+            values = np.lib.format.open_memmap(os.path.join(path, 'values.npy'), mode='w+', dtype='float32', shape=shape)
+            np.save(os.path.join(path, 'index.npy'), df.index.values)
+            with open(os.path.join(path, 'columns.json'), 'w') as f:
+                json.dump(columns, f)
+        # 列ごとに書き込むため、DataFrame全体のfloat64コピーは作らない
+        for i, col in enumerate(columns):
+            values[:, i] = df[col].to_numpy()
+        return cls(values, columns, df.index)
+
+    # DataFrame・配列の特徴量Xと目標値y（1列）から作成する
+    @classmethod
+    def from_arrays(cls, X, y, index=None):
+        values = np.empty((len(X), np.shape(X)[1] + 1), dtype='float32')
+        values[:, :-1] = np.asarray(X)
+        values[:, -1:] = np.asarray(y).reshape(len(X), 1)
+        if isinstance(X, pd.DataFrame):
+            columns = list(X.columns) + [y.columns[0] if isinstance(y, pd.DataFrame) else 'target']
+            index = X.index if index is None else index
+        else:
+            columns = [f'x{i}' for i in range(values.shape[1] - 1)] + ['target']
+        return cls(values, columns, index)
+
+    # mode='c'（コピーオンライト）では、正規化してもファイルは変更されない
+    @classmethod
+    def open(cls, path, mode='c'):
+        with open(os.path.join(path, 'columns.json')) as f:
+            columns = json.load(f)
+        index = pd.DatetimeIndex(np.load(os.path.join(path, 'index.npy'), mmap_mode='r'), name='Date')
+        return cls(np.load(os.path.join(path, 'values.npy'), mmap_mode=mode), columns, index)
+
+    @property
+    def feature_columns(self):
+        return self.columns[:-1]
+
+    # 特徴量と目標値のビュー（NumPy配列）
+    def arrays(self, rows=slice(None)):
+        return self.values[rows, :-1], self.values[rows, -1:]
+
+    # 特徴量と目標値のテンソル（配列と同じメモリを参照する）
+    def tensors(self):
+        values = torch.from_numpy(self.values)
+        return values[:, :-1], values[:, -1:]
+
+    def sequences(self, lookback=1, horizon=1, stride=1, multi_output=False):
+        X, y = self.tensors()
+        return make_sequences(X, y, lookback, horizon, stride, multi_output)
+
+    # rowsの行（訓練範囲）で最小値・最大値を求め、配列全体をブロックごとにインプレースで[0, 1]に正規化する
+    def scale_(self, rows=slice(None), block_rows=1 << 16):
+        fit_rows = self.values[index_slice(rows)]
+        data_min = fit_rows.min(axis=0).astype('float64')
+        data_max = fit_rows.max(axis=0).astype('float64')
+        data_range = data_max - data_min
+        scale = 1.0 / np.where(data_range != 0, data_range, 1.0)
+        min_ = -data_min * scale
+        scale32, min32 = scale.astype('float32'), min_.astype('float32')
+        for start in range(0, len(self.values), block_rows):
+            block = self.values[start:start + block_rows]
+            block *= scale32
+            block += min32
+        params = [{'feature_range': [0, 1], 'min': min_[cols].tolist(), 'scale': scale[cols].tolist(),
+                   'data_min': data_min[cols].tolist(), 'data_max': data_max[cols].tolist()}
+                  for cols in (slice(None, -1), slice(-1, None))]
+        self.scaler_X, self.scaler_y = scaler_from_dict(params[0]), scaler_from_dict(params[1])
+        return self.scaler_X, self.scaler_y
+
+    # 元の値を残したまま、正規化したコピーを作る（バックテストのウィンドウ・CVのフォールドごとの正規化用）
+    def scaled(self, rows=slice(None)):
+        store = FeatureStore(np.array(self.values, dtype='float32'), self.columns, self.index)
+        store.scale_(rows)
+        return store
+
+# 連続したインデックス配列はスライスに変換する（配列・テンソルの添字に使うとコピーではなくビューになる）
+def index_slice(index):
+    if isinstance(index, slice):
+        return index
+    index = np.asarray(index)
+    if len(index) and index[-1] - index[0] + 1 == len(index) and np.all(np.diff(index) == 1):
+        return slice(int(index[0]), int(index[-1]) + 1)
+    return index
+
+# ミニバッチ用のDataLoaderを作成（ワーカー数・ピン留め・先読みを指定可能）
+def make_data_loader(X, y, batch_size, shuffle=False, num_workers=0, pin_memory=None, prefetch_factor=2):
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    options = {}
+    if num_workers > 0:
+        options = {'prefetch_factor': prefetch_factor, 'persistent_workers': True}
+    # Datasetが直接渡された場合（パネルの系列など）はそのまま使う
+    dataset = X if isinstance(X, Dataset) else TimeSeriesDataset(X, y)
+    # IterableDatasetはDataLoaderでシャッフルできないため、データセット側で行う
+    if isinstance(dataset, IterableDataset):
+        shuffle = False
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
+                      num_workers=num_workers, pin_memory=pin_memory, **options)
+
+# 検証データの損失をバッチ単位で計算
+def compute_loss(model, batches, criterion, device):
     model.eval()
+    total, count = 0.0, 0
     with torch.no_grad():
-        predictions = model(X_test)
-    predictions = predictions.numpy()
-    y_test = y_test.numpy()
-
-    predictions = scaler_y.inverse_transform(predictions)
-    y_test = scaler_y.inverse_transform(y_test)
-
-    mse = mean_squared_error(y_test, predictions)
-    mae = mean_absolute_error(y_test, predictions)
-    r2 = r2_score(y_test, predictions)
-
-    print(f'MSE: {mse:.4f}, MAE: {mae:.4f}, R^2: {r2:.4f}')
-
-    plt.figure(figsize=(12, 6))
-    plt.plot(y_test, label='Actual')
-    plt.plot(predictions, label='Predicted')
-    plt.title('Actual vs Predicted Stock Prices')
-    plt.xlabel('Time')
-    plt.ylabel('Stock Price')
-    plt.legend()
-    plt.show()
-
-"""### 9. Training and Evaluating Models
-### モデルのトレーニングと評価
-
-AR model <br>
-ARモデル
-"""
-
-ar_model = ARModel(input_dim=X_train_tensor.shape[1], hidden_dim=64, output_dim=1)
-train_model(ar_model, X_train_tensor, y_train_tensor, epochs=100, lr=0.001)
-evaluate_model(ar_model, X_test_tensor, y_test_tensor)
-
-"""LSTM model <br>
-LSTMモデル
-"""
-
-lstm_model = LSTMModel(input_dim=X_train_tensor.shape[1], hidden_dim=64, output_dim=1, num_layers=2)
-train_model(lstm_model, X_train_tensor.unsqueeze(1), y_train_tensor, epochs=100, lr=0.001)
-evaluate_model(lstm_model, X_test_tensor.unsqueeze(1), y_test_tensor)
-
-"""Transformer model <br>
-ランスフォーマーモデル
-"""
-
-transformer_model = TransformerModel(input_dim=X_train_tensor.shape[1], hidden_dim=64, output_dim=1, num_layers=2, nhead=8)
-train_model(transformer_model, X_train_tensor.unsqueeze(1), y_train_tensor, epochs=100, lr=0.001)
-evaluate_model(transformer_model, X_test_tensor.unsqueeze(1), y_test_tensor)
-
-pip install japanize_matplotlib
-
-# -*- coding: utf-8 -*-
-"""
-Improved Stock Price Prediction Model
-改良版株価予測モデル
-"""
-
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.model_selection import train_test_split, TimeSeriesSplit
-from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.model_selection import GridSearchCV
-import torch
-import torch.nn as nn
-import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
-import japanize_matplotlib
-
-# ライブラリのインポート
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.model_selection import train_test_split, TimeSeriesSplit
-from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.model_selection import GridSearchCV
-import torch
-import torch.nn as nn
-import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
-import japanize_matplotlib
-
-# データの読み込みと前処理
-# データの読み込みと前処理
-def load_and_preprocess_data(file_path):
-    df = pd.read_csv('/content/stock_price.csv')
-    df.columns = ['Date', 'Close', 'Open', 'High', 'Low', 'Volume', 'Change_Rate']
-    df['Date'] = pd.to_datetime(df['Date'])
-    df = df.sort_values('Date')
-    df.set_index('Date', inplace=True)
-
-    # ボリュームの変換（単位：百万株、十億株）
-    df['Volume'] = df['Volume'].apply(lambda x: float(x.replace('M', '')) * 1e6 if 'M' in str(x) else (float(x.replace('B', '')) * 1e9 if 'B' in str(x) else float(x)))
-
-    # 変化率をパーセンテージから小数に変換
-    df['Change_Rate'] = df['Change_Rate'].str.rstrip('%').astype('float') / 100.0
-
-    return df
-
-# 特徴量エンジニアリング
-def engineer_features(df):
-    # ラグ特徴量と移動平均の作成
-    df['Lag_1'] = df['Close'].shift(1)
-    df['Lag_7'] = df['Close'].shift(7)
-    df['Rolling_Mean_7'] = df['Close'].rolling(window=7).mean()
-    df['Rolling_Std_7'] = df['Close'].rolling(window=7).std()
-
-    # 技術的指標の追加
-    # MACD (Moving Average Convergence Divergence)
-    df['EMA12'] = df['Close'].ewm(span=12, adjust=False).mean()
-    df['EMA26'] = df['Close'].ewm(span=26, adjust=False).mean()
-    df['MACD'] = df['EMA12'] - df['EMA26']
-    df['Signal_Line'] = df['MACD'].ewm(span=9, adjust=False).mean()
-
-    # RSI (Relative Strength Index)
-    delta = df['Close'].diff()
-    gain = (delta.where(delta > 0, 0)).rolling(window=14).mean()
-    loss = (-delta.where(delta < 0, 0)).rolling(window=14).mean()
-    rs = gain / loss
-    df['RSI'] = 100 - (100 / (1 + rs))
-
-    # 欠損値の削除
-    df.dropna(inplace=True)
-
-    return df
-
-# 探索的データ分析 (EDA)
-def perform_eda(df):
-    plt.figure(figsize=(12, 6))
-    plt.plot(df.index, df['Close'])
-    plt.title('NTT株価の推移')
-    plt.xlabel('日付')
-    plt.ylabel('終値')
-    plt.show()
-
-    # 相関ヒートマップ
-    plt.figure(figsize=(12, 10))
-    sns.heatmap(df.corr(), annot=True, cmap='coolwarm')
-    plt.title('特徴量間の相関')
-    plt.show()
-
-    # 分布プロット
-    plt.figure(figsize=(15, 10))
-    for i, col in enumerate(['Close', 'Volume', 'Change_Rate', 'RSI']):
-        plt.subplot(2, 2, i+1)
-        sns.histplot(df[col], kde=True)
-        plt.title(f'{col}の分布')
-    plt.tight_layout()
-    plt.show()
-
-# 特徴量重要度の分析
-def analyze_feature_importance(X, y):
-    rf = RandomForestRegressor(n_estimators=100, random_state=42)
-    rf.fit(X, y)
-
-    feature_importance = pd.DataFrame({
-        'feature': X.columns,
-        'importance': rf.feature_importances_
-    }).sort_values('importance', ascending=False)
-
-    plt.figure(figsize=(10, 6))
-    sns.barplot(x='importance', y='feature', data=feature_importance)
-    plt.title('特徴量の重要度')
-    plt.show()
-
-    return feature_importance
-
-# モデルの定義
-class LSTMModel(nn.Module):
-    def __init__(self, input_dim, hidden_dim, output_dim, num_layers):
-        super(LSTMModel, self).__init__()
-        self.hidden_dim = hidden_dim
-        self.num_layers = num_layers
-        self.lstm = nn.LSTM(input_dim, hidden_dim, num_layers, batch_first=True)
-        self.fc = nn.Linear(hidden_dim, output_dim)
-
-    def forward(self, x):
-        h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_dim).requires_grad_()
-        c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_dim).requires_grad_()
-        out, _ = self.lstm(x, (h0.detach(), c0.detach()))
-        out = self.fc(out[:, -1, :])
-        return out
+        for X_batch, y_batch in batches:
+            X_batch = X_batch.to(device, non_blocking=True)
+            y_batch = y_batch.to(device, non_blocking=True)
+            total += criterion(model(X_batch), y_batch).item() * len(X_batch)
+            count += len(X_batch)
+    model.train()
+    return total / max(count, 1)
 
 # モデルの訓練
-def train_model(model, X_train, y_train, epochs=100, lr=0.001):
-    optimizer = optim.Adam(model.parameters(), lr=lr)
+# batch_sizeを指定しない場合は従来通り全データで1エポック1ステップ更新する
+def train_model(model, X_train, y_train, epochs=100, lr=0.001, batch_size=None, X_val=None, y_val=None,
+                patience=None, min_delta=0.0, accumulation_steps=1, num_workers=0, pin_memory=None,
+                prefetch_factor=2, shuffle=True, optimizer=None, verbose=True):
+    if optimizer is None:
+        optimizer = optim.Adam(model.parameters(), lr=lr)
     criterion = nn.MSELoss()
-
-    model.train()
-    for epoch in range(epochs):
-        optimizer.zero_grad()
-        output = model(X_train)
-        loss = criterion(output, y_train)
-        loss.backward()
-        optimizer.step()
-
-        if (epoch+1) % 10 == 0:
-            print(f'Epoch {epoch+1}/{epochs}, Loss: {loss.item():.4f}')
-
-# モデルの評価
-def evaluate_model(model, X_test, y_test, scaler_y):
+    device = next(model.parameters()).device
+    if isinstance(X_train, Dataset) and batch_size is None:
+        raise ValueError("batch_size is required when training from a Dataset")
+
+    if batch_size is None:
+        train_batches = [(X_train, y_train)]
+    else:
+        train_batches = make_data_loader(X_train, y_train, batch_size, shuffle=shuffle, num_workers=num_workers,
+                                         pin_memory=pin_memory, prefetch_factor=prefetch_factor)
+    val_batches = None
+    if X_val is not None:
+        if batch_size is None:
+            val_batches = [(X_val, y_val)]
+        else:
+            val_batches = make_data_loader(X_val, y_val, batch_size, num_workers=num_workers,
+                                           pin_memory=pin_memory, prefetch_factor=prefetch_factor)
+
+    history = {'train_loss': [], 'val_loss': [], 'best_epoch': None}
+    best_val_loss = float('inf')
+    best_state = None
+    epochs_without_improvement = 0
+
+    with INSTRUMENTATION.stage('training', model=type(model).__name__, epochs=epochs, batch_size=batch_size,
+                              param_mb=tensor_mb(*model.parameters()), input_mb=tensor_mb(X_train, y_train)):
+        model.train()
+        for epoch in range(epochs):
+            optimizer.zero_grad()
+            total, count = 0.0, 0
+            epoch_started = time.perf_counter()
+            step = -1
+            for step, (X_batch, y_batch) in enumerate(train_batches):
+                X_batch = X_batch.to(device, non_blocking=True)
+                y_batch = y_batch.to(device, non_blocking=True)
+                output = model(X_batch)
+                loss = criterion(output, y_batch)
+                # 勾配累積：accumulation_stepsバッチ分の勾配を平均してから更新する
+                (loss / accumulation_steps).backward()
+                if (step + 1) % accumulation_steps == 0:
+                    optimizer.step()
+                    optimizer.zero_grad()
+                total += loss.item() * len(X_batch)
+                count += len(X_batch)
+            # 最後の不完全なグループはaccumulation_stepsで割ってあるため、実際のバッチ数の平均に直してから更新する
+            # （バッチが1つもなかった場合は更新しない）
+            remainder = (step + 1) % accumulation_steps
+            if remainder:
+                for parameter in model.parameters():
+                    if parameter.grad is not None:
+                        parameter.grad.mul_(accumulation_steps / remainder)
+                optimizer.step()
+                optimizer.zero_grad()
+            history['train_loss'].append(total / max(count, 1))
+            epoch_seconds = time.perf_counter() - epoch_started
+
+            message = f'Epoch {epoch+1}/{epochs}, Loss: {history["train_loss"][-1]:.4f}'
+            if val_batches is not None:
+                val_loss = compute_loss(model, val_batches, criterion, device)
+                history['val_loss'].append(val_loss)
+                message += f', Val Loss: {val_loss:.4f}'
+
+                # 早期終了：検証損失がpatienceエポック改善しなければ最良の重みに戻して終了する
+                if val_loss < best_val_loss - min_delta:
+                    best_val_loss = val_loss
+                    best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+                    history['best_epoch'] = epoch + 1
+                    epochs_without_improvement = 0
+                else:
+                    epochs_without_improvement += 1
+
+            INSTRUMENTATION.log('epoch', model=type(model).__name__, epoch=epoch + 1, samples=count, seconds=epoch_seconds,
+                                samples_per_sec=count / epoch_seconds if epoch_seconds > 0 else None,
+                                train_loss=history['train_loss'][-1], val_loss=history['val_loss'][-1] if val_batches is not None else None)
+            if verbose and (epoch+1) % 10 == 0:
+                print(message)
+
+            if patience is not None and val_batches is not None and epochs_without_improvement >= patience:
+                if verbose:
+                    print(f'Early stopping at epoch {epoch+1} (best epoch: {history["best_epoch"]})')
+                break
+
+    if best_state is not None and patience is not None:
+        model.load_state_dict(best_state)
+    return history
+
+# 多期間出力（各列が1ステップ先、2ステップ先、…の終値）を列ごとに1列用のスケーラーで元の単位に戻す
+def inverse_transform_horizons(scaler_y, values):
+    values = np.asarray(values)
+    return scaler_y.inverse_transform(values.reshape(-1, 1)).reshape(values.shape)
+
+# 期間ごとの指標（行：期間1..H）
+def horizon_metrics(y_true, predictions):
+    from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
+
+    return pd.DataFrame({
+        'horizon': np.arange(1, y_true.shape[1] + 1),
+        'mse': mean_squared_error(y_true, predictions, multioutput='raw_values'),
+        'mae': mean_absolute_error(y_true, predictions, multioutput='raw_values'),
+        'r2': r2_score(y_true, predictions, multioutput='raw_values'),
+    })
+
+# CPU推論の精度（--precisionで指定する）
+# 'float32'：従来通り。'bf16'：CPUのautocastでbfloat16に落として計算する
+# 'int8'：nn.LSTM・nn.Linearの重みをint8に動的量子化したコピーで推論する（元のモデルは変更しない）
+INFERENCE_SETTINGS = {'precision': 'float32'}
+QUANTIZABLE_MODULES = {nn.LSTM, nn.Linear}
+
+# batch_firstのエンコーダ層（FastTransformerModel）は融合カーネルを使えるかの判定で重みを直接参照するため、
+# その中の線形層は量子化しない
+def quantize_model(model):
+    from torch.ao.quantization import quantize_dynamic
     model.eval()
-    with torch.no_grad():
-        predictions = model(X_test)
-    predictions = predictions.numpy()
-    y_test = y_test.numpy()
-
-    predictions = scaler_y.inverse_transform(predictions)
-    y_test = scaler_y.inverse_transform(y_test)
+    fused = [name for name, module in model.named_modules()
+             if isinstance(module, nn.TransformerEncoderLayer) and module.self_attn.batch_first]
+    names = {name for name, module in model.named_modules()
+             if type(module) in QUANTIZABLE_MODULES and not any(name.startswith(prefix + '.') for prefix in fused)}
+    return quantize_dynamic(model, names, dtype=torch.qint8)
 
-    mse = mean_squared_error(y_test, predictions)
-    mae = mean_absolute_error(y_test, predictions)
-    r2 = r2_score(y_test, predictions)
-
-    print(f'MSE: {mse:.4f}, MAE: {mae:.4f}, R^2: {r2:.4f}')
-
-    plt.figure(figsize=(12, 6))
-    plt.plot(y_test, label='実際')
-    plt.plot(predictions, label='予測')
-    plt.title('実際の株価 vs 予測株価')
-    plt.xlabel('時間')
-    plt.ylabel('株価')
-    plt.legend()
-    plt.show()
+def prepare_inference_model(model, precision=None):
+    model.eval()
+    if (precision or INFERENCE_SETTINGS['precision']) == 'int8':
+        return quantize_model(model)
+    return model
+
+# 推論モードと（bf16の場合は）autocastをまとめて有効にする。出力はfloat()でfloat32に戻してから使う
+@contextlib.contextmanager
+def inference_context(precision=None):
+    precision = precision or INFERENCE_SETTINGS['precision']
+    with torch.inference_mode(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+        yield
+
+def state_dict_kb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024
+
+# 量子化の精度ガード：保留しておいた系列で浮動小数点と量子化後のMSE（正規化後の単位）を比べ、
+# 悪化がtolerance（相対）以内の場合だけ量子化モデルを返す。それ以外は元のモデルを返す
+# min_speedupを指定すると、同じ系列での推論時間がその倍率以上速くならない場合も採用しない
+def quantize_with_guard(model, X_val, y_val, tolerance=0.05, min_speedup=None, n_iter=10):
+    quantized = quantize_model(model)
+    results = {}
+    for key, candidate in (('float32', model), ('int8', quantized)):
+        with torch.inference_mode():
+            predictions = candidate(X_val)
+            started = time.perf_counter()
+            for _ in range(n_iter):
+                candidate(X_val)
+        results[f'{key}_mse'] = float(((predictions - y_val) ** 2).mean())
+        results[f'{key}_ms'] = (time.perf_counter() - started) / n_iter * 1000.0
+        results[f'{key}_kb'] = state_dict_kb(candidate)
+    results['speedup'] = results['float32_ms'] / results['int8_ms']
+    results['accepted'] = results['int8_mse'] <= results['float32_mse'] * (1 + tolerance)
+    if min_speedup is not None and results['speedup'] < min_speedup:
+        results['accepted'] = False
+    print(f"float32 MSE {results['float32_mse']:.6f}, int8 MSE {results['int8_mse']:.6f} "
+          f"({'accepted' if results['accepted'] else 'rejected'}, tolerance {tolerance:.0%}); "
+          f"{results['speedup']:.2f}x faster, {results['float32_kb']:.0f} KB -> {results['int8_kb']:.0f} KB")
+    return (quantized if results['accepted'] else model), results
+
+# ストリーミング指標
+# バッチごとに予測と目標値を受け取り、明示的に渡したscaler_yで元の単位に戻して、MSE・MAE・R^2・MAPE・方向の的中率を
+# 1パスで累積する（保持するのはモデル×期間ごとの集計値だけなので、メモリ使用量はサンプル数によらない）
+# 予測は (サンプル, 期間) か、複数のモデル・バックテストのウィンドウをまとめた (モデル, サンプル, 期間) の形で渡す
+# 目標値・予測がNaNの要素は数えない（長さの異なるウィンドウをNaNで埋めてまとめて渡せる）
+# 方向の的中率は直前の実績値からの上下で判定する。referenceを渡さない場合は1つ前のサンプルの1期先の目標値を使う
+# sinksにはupdate(predictions, targets)を持つオブジェクト（PlotSinkなど）を渡し、元の単位のバッチを受け取らせる
+class StreamingMetrics:
+    def __init__(self, scaler_y=None, sinks=()):
+        self.scaler_y = scaler_y
+        self.sinks = list(sinks)
+        self.totals = None
+        self.last_target = None
+
+    def inverse(self, values):
+        values = np.asarray(values, dtype='float64')
+        if self.scaler_y is None:
+            return values
+        return inverse_transform_horizons(self.scaler_y, values)
+
+    def update(self, predictions, targets, reference=None):
+        predictions = self.inverse(predictions)
+        if predictions.ndim == 2:
+            predictions = predictions[np.newaxis]
+        targets = np.broadcast_to(self.inverse(targets), predictions.shape)
+        if reference is None:
+            previous = self.last_target if self.last_target is not None else np.full(len(predictions), np.nan)
+            reference = np.concatenate([previous[:, np.newaxis], targets[:, :-1, 0]], axis=1)
+        else:
+            reference = np.broadcast_to(self.inverse(reference).reshape(-1, predictions.shape[1]), predictions.shape[:2])
+        self.last_target = targets[:, -1, 0].copy()
+
+        valid = ~(np.isnan(predictions) | np.isnan(targets))
+        error = np.where(valid, predictions - targets, 0.0)
+        n = valid.sum(axis=1)
+        target_values = np.where(valid, targets, 0.0)
+        batch_mean = target_values.sum(axis=1) / np.maximum(n, 1)
+        batch_m2 = (np.where(valid, targets - batch_mean[:, np.newaxis], 0.0) ** 2).sum(axis=1)
+        nonzero = valid & (targets != 0)
+        direction = valid & ~np.isnan(reference)[:, :, np.newaxis]
+        reference = reference[:, :, np.newaxis]
+        hits = direction & (np.sign(predictions - reference) == np.sign(targets - reference))
+        batch = {
+            'sse': (error ** 2).sum(axis=1),
+            'sae': np.abs(error).sum(axis=1),
+            'sape': np.where(nonzero, np.abs(error) / np.where(nonzero, np.abs(targets), 1.0), 0.0).sum(axis=1),
+            'n_ape': nonzero.sum(axis=1),
+            'hits': hits.sum(axis=1),
+            'n_direction': direction.sum(axis=1),
+        }
+
+        if self.totals is None:
+            self.totals = {key: np.zeros_like(value, dtype='float64') for key, value in batch.items()}
+            self.totals.update(n=np.zeros(n.shape), mean=np.zeros(n.shape), m2=np.zeros(n.shape))
+        for key, value in batch.items():
+            self.totals[key] += value
+        # 目標値の平均と偏差平方和はバッチ単位で合成する（大きな価格でも桁落ちしない）
+        total_n = self.totals['n'] + n
+        delta = batch_mean - self.totals['mean']
+        weight = np.divide(n, total_n, out=np.zeros(n.shape), where=total_n > 0)
+        self.totals['m2'] += batch_m2 + delta ** 2 * self.totals['n'] * weight
+        self.totals['mean'] += delta * weight
+        self.totals['n'] = total_n
+
+        for sink in self.sinks:
+            sink.update(predictions, targets)
+        return self
+
+    # モデル×期間ごとの指標の配列
+    def results(self):
+        totals = self.totals
+        ratio = lambda a, b: np.divide(a, b, out=np.full(np.shape(a), np.nan), where=b > 0)
+        return {
+            'n': totals['n'].astype('int64'),
+            'mse': ratio(totals['sse'], totals['n']),
+            'mae': ratio(totals['sae'], totals['n']),
+            'r2': 1.0 - ratio(totals['sse'], totals['m2']),
+            'mape': ratio(totals['sape'], totals['n_ape']),
+            'directional_accuracy': ratio(totals['hits'], totals['n_direction']),
+        }
+
+    # 縦長の表（行：モデル×期間）
+    def frame(self):
+        results = self.results()
+        n_models, n_horizons = results['n'].shape
+        frame = pd.DataFrame({key: value.ravel() for key, value in results.items()})
+        frame.insert(0, 'horizon', np.tile(np.arange(1, n_horizons + 1), n_models))
+        frame.insert(0, 'model', np.repeat(np.arange(n_models), n_horizons))
+        return frame
+
+    # 1モデル分の指標（全期間の単純平均。scikit-learnのmultioutput='uniform_average'と同じ）
+    def summary(self, model=0):
+        return {key: float(np.mean(value[model])) for key, value in self.results().items() if key != 'n'}
+
+# 描画用のシンク：最初のモデルの予測と目標値を、最大max_points点まで等間隔に間引いて保持する
+class PlotSink:
+    def __init__(self, max_points=5000):
+        self.max_points = max_points
+        self.stride = 1
+        self.seen = 0
+        self.predictions = []
+        self.targets = []
+
+    def update(self, predictions, targets):
+        keep = (np.arange(self.seen, self.seen + predictions.shape[1]) % self.stride) == 0
+        self.predictions.extend(predictions[0, keep])
+        self.targets.extend(targets[0, keep])
+        self.seen += predictions.shape[1]
+        if len(self.targets) > self.max_points:
+            # 間隔を2倍にして、保持している点を半分に間引く
+            self.predictions = self.predictions[::2]
+            self.targets = self.targets[::2]
+            self.stride *= 2
+
+    def render(self, name='evaluation'):
+        predictions, targets = np.array(self.predictions), np.array(self.targets)
+        plt = load_pyplot()
+        plt.figure(figsize=(12, 6))
+        plt.plot(targets[:, 0], label='実際')
+        plt.plot(predictions[:, 0], label='予測')
+        if targets.shape[1] > 1:
+            plt.plot(predictions[:, -1], label=f'予測（{targets.shape[1]}ステップ先）', alpha=0.7)
+        plt.title('実際の株価 vs 予測株価')
+        plt.xlabel('時間')
+        plt.ylabel('株価')
+        plt.legend()
+        show_figure(plt, name)
+
+# 複数のモデルを同じ系列でまとめて評価する（バッチごとに全モデルの予測を積み重ねて1回で累積する）
+def evaluate_models(models, X, y, scaler_y, batch_size=4096, sinks=()):
+    models = [prepare_inference_model(model) for model in models]
+    metrics = StreamingMetrics(scaler_y, sinks)
+    with INSTRUMENTATION.stage('inference', model=','.join(type(model).__name__ for model in models), samples=len(X),
+                               input_mb=tensor_mb(X), precision=INFERENCE_SETTINGS['precision']):
+        with inference_context():
+            for start in range(0, len(X), batch_size):
+                X_batch = X[start:start + batch_size]
+                predictions = torch.stack([model(X_batch).float() for model in models])
+                metrics.update(predictions.numpy(), y[start:start + batch_size].numpy())
+    return metrics
 
-# ハイパーパラメータチューニング
-def tune_hyperparameters(X_train, y_train):
-    param_grid = {
-        'hidden_dim': [32, 64, 128],
-        'num_layers': [1, 2, 3],
-        'lr': [0.001, 0.01, 0.1]
+# モデルの評価
+# StreamingMetricsでバッチごとに累積するため、予測全体を保持しない。描画は有効な場合だけPlotSinkで行う
+# 多期間出力のモデルでは、全期間の平均に加えて期間ごとの指標を'per_horizon'として返す
+def evaluate_model(model, X_test, y_test, scaler_y, plot=True, batch_size=4096):
+    sinks = [PlotSink()] if plot and PLOT_SETTINGS['enabled'] else []
+    engine = evaluate_models([model], X_test, y_test, scaler_y, batch_size=batch_size, sinks=sinks)
+    metrics = engine.summary()
+    print(f"MSE: {metrics['mse']:.4f}, MAE: {metrics['mae']:.4f}, R^2: {metrics['r2']:.4f}, "
+          f"MAPE: {metrics['mape']:.2%}, Direction: {metrics['directional_accuracy']:.1%}")
+    if engine.results()['n'].shape[1] > 1:
+        metrics['per_horizon'] = engine.frame().drop(columns=['model', 'n'])
+        print(metrics['per_horizon'].to_string(index=False, float_format='%.4f'))
+
+    for sink in sinks:
+        sink.render('evaluation')
+    return metrics
+
+# ベースラインの一括当てはめと評価
+# 結果はevaluate_modelと同じ指標（元の単位のMSE・MAE・R^2）で、当てはめ時間も含める
+def make_baselines(scaler_X, scaler_y, lookback, feature_columns=FEATURE_COLUMNS):
+    lag_index = list(feature_columns).index('Lag_1')
+    baselines = {
+        'persistence': EWMABaseline(lag_index, scaler_X, scaler_y, span=1),
+        'ewma': EWMABaseline(lag_index, scaler_X, scaler_y, span='auto'),
+        'ridge': RidgeBaseline(alpha=1e-3),
     }
+    for p in (1, 5, 20):
+        if p <= lookback:
+            baselines[f'ar{p}'] = ARBaseline(p, lag_index)
+    return baselines
 
-    def create_model(hidden_dim, num_layers, lr):
-        model = LSTMModel(input_dim=X_train.shape[2], hidden_dim=hidden_dim, output_dim=1, num_layers=num_layers)
-        return model
-
-    best_mse = float('inf')
-    best_params = None
-
-    for hidden_dim in param_grid['hidden_dim']:
-        for num_layers in param_grid['num_layers']:
-            for lr in param_grid['lr']:
-                model = create_model(hidden_dim, num_layers, lr)
-                train_model(model, X_train, y_train, epochs=50, lr=lr)
-
-                model.eval()
-                with torch.no_grad():
-                    predictions = model(X_train)
-                mse = mean_squared_error(y_train.numpy(), predictions.numpy())
+def evaluate_baselines(X_train, y_train, X_test, y_test, scaler_X, scaler_y, feature_columns=FEATURE_COLUMNS):
+    results = []
+    for name, baseline in make_baselines(scaler_X, scaler_y, X_train.shape[1], feature_columns).items():
+        started = time.perf_counter()
+        baseline.fit(X_train, y_train)
+        fit_seconds = time.perf_counter() - started
+        with contextlib.redirect_stdout(io.StringIO()):
+            metrics = evaluate_model(baseline, X_test, y_test, scaler_y, plot=False)
+        results.append({'baseline': name, 'mse': metrics['mse'], 'mae': metrics['mae'], 'r2': metrics['r2'],
+                        'fit_ms': fit_seconds * 1000})
+    report = pd.DataFrame(results)
+    print(report.to_string(index=False, float_format='%.4f'))
+    return report
 
-                if mse < best_mse:
-                    best_mse = mse
-                    best_params = {'hidden_dim': hidden_dim, 'num_layers': num_layers, 'lr': lr}
+# ハイパーパラメータチューニング
+# グリッド（またはランダムサンプル）の各設定をプロセスプールで並列に訓練し、
+# Successive Halvingで検証損失の悪い設定を早い段階で打ち切る
+# search_dirを指定すると試行ごとの結果とチェックポイントを保存し、同じ探索（search_fingerprintが一致する場合）だけ続きから再開する
+DEFAULT_PARAM_GRID = {
+    'hidden_dim': [32, 64, 128],
+    'num_layers': [1, 2, 3],
+    'lr': [0.001, 0.01, 0.1]
+}
+# ワーカーのデータ。プロセスプールを使わず同じプロセスで実行する場合（n_jobs=1）に、工程グラフで同時に実行している
+# 別の工程のデータと混ざらないように、スレッドごとに持つ
+class WorkerData(threading.local):
+    def __init__(self):
+        self.data = {}
+
+    def update(self, data):
+        self.data.update(data)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+WORKER_DATA = WorkerData()
+
+def make_trial_id(params):
+    return ','.join(f'{key}={params[key]}' for key in sorted(params))
+
+# ワーカープロセスの初期化：データを一度だけ受け取り、スレッド数を制限する（探索・バックテスト共通）
+def init_worker(data, num_threads=None):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    WORKER_DATA.update(data)
+
+# プロセスプールのワーカー数の上限。工程グラフで同時に実行している工程の間でCPUを分け合うため、スレッドごとに持つ
+# （設定していない場合はCPU数）
+WORKER_BUDGET = threading.local()
+
+def worker_budget():
+    return getattr(WORKER_BUDGET, 'cpus', None) or os.cpu_count() or 1
+
+# ワーカープロセスのプール。スレッドやtorchのスレッドプールが動いているプロセスからforkするとデッドロックすることがあるため、
+# spawnで起動する。各ワーカーのスレッド数は、予算をワーカー数で分けた数にする
+def make_worker_pool(n_jobs, data):
+    num_threads = max(1, worker_budget() // n_jobs)
+    return ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=init_worker, initargs=(data, num_threads))
+
+# 固定したシードでモデルを作成する。乱数の状態はプロセス全体で共有されるため、同時に実行している工程の初期化と
+# 混ざらないようにロックの中で初期化し、元の乱数の状態に戻す
+MODEL_INIT_LOCK = threading.Lock()
+
+def seeded_init(factory, seed):
+    with MODEL_INIT_LOCK, torch.random.fork_rng():
+        torch.manual_seed(seed)
+        return factory()
+
+# 1つの設定を指定エポック数まで訓練し（途中の状態があれば続きから）、検証MSEを返す
+def run_trial(params, epochs, state=None):
+    from sklearn.metrics import mean_squared_error
+
+    X_train, y_train = WORKER_DATA['X_train'], WORKER_DATA['y_train']
+    X_val, y_val = WORKER_DATA['X_val'], WORKER_DATA['y_val']
+    model = seeded_init(lambda: LSTMModel(input_dim=X_train.shape[2], hidden_dim=params['hidden_dim'], output_dim=y_train.shape[1],
+                                          num_layers=params['num_layers']), WORKER_DATA['seed'])
+    optimizer = optim.Adam(model.parameters(), lr=params['lr'])
+    trained_epochs = 0
+    if state is not None:
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        trained_epochs = state['epochs']
+
+    train_model(model, X_train, y_train, epochs=epochs - trained_epochs, lr=params['lr'], optimizer=optimizer, verbose=False)
 
+    model.eval()
+    with torch.no_grad():
+        predictions = model(X_val)
+    mse = mean_squared_error(y_val.numpy(), predictions.numpy())
+    if not np.isfinite(mse):
+        mse = float('inf')
+    return {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epochs': epochs}, mse
+
+# 探索の識別子：訓練データ・検証の分割位置・シード・探索空間（グリッドと試行数）のハッシュ
+# 試行ログの各行に記録し、別の探索のログから再開しないようにする
+def search_fingerprint(X_train, y_train, split, random_state, param_grid, n_trials):
+    settings = json.dumps([split, random_state, {key: list(values) for key, values in param_grid.items()}, n_trials], default=str)
+    return array_fingerprint(X_train, y_train, np.frombuffer(settings.encode(), dtype='uint8'))
+
+# 試行ログ（JSON Lines）の読み込み：{(trial_id, epochs): val_mse}
+# 別の探索（データ・分割・シード・探索空間のいずれかが異なる）のログであればValueErrorを送出する
+def load_trial_log(search_dir, search_id=None):
+    scores = {}
+    if search_dir is None or not os.path.exists(os.path.join(search_dir, 'trials.jsonl')):
+        return scores
+    with open(os.path.join(search_dir, 'trials.jsonl')) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record.get('search') != search_id:
+                    raise ValueError(f"{search_dir} holds trials of a different search (data, validation split, seed or "
+                                     f"parameter grid changed: {record.get('search')} != {search_id}); use a new search_dir")
+                scores[(record['trial_id'], record['epochs'])] = record['val_mse']
+    return scores
+
+# チェックポイントを先に保存してからログに追記する（途中で止まっても再開できる）
+def record_trial(search_dir, trial_id, params, state, mse, search_id=None):
+    if search_dir is None:
+        return
+    checkpoint_path = os.path.join(search_dir, f'{hashlib.sha1(trial_id.encode()).hexdigest()[:12]}.pt')
+    torch.save(state, checkpoint_path)
+    with open(os.path.join(search_dir, 'trials.jsonl'), 'a') as f:
+        f.write(json.dumps({'search': search_id, 'trial_id': trial_id, 'params': params, 'epochs': state['epochs'],
+                            'val_mse': mse}) + '\n')
+
+def load_trial_state(search_dir, trial_id):
+    checkpoint_path = os.path.join(search_dir, f'{hashlib.sha1(trial_id.encode()).hexdigest()[:12]}.pt')
+    if not os.path.exists(checkpoint_path):
+        return None
+    return torch.load(checkpoint_path)
+
+# 各段階の訓練エポック数（min_epochsからreduction_factor倍ずつ増やし、max_epochsで終わる）
+def halving_budgets(min_epochs, max_epochs, reduction_factor):
+    budgets = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        budgets.append(epochs)
+        epochs *= reduction_factor
+    budgets.append(max_epochs)
+    return budgets
+
+def tune_hyperparameters(X_train, y_train, param_grid=None, n_trials=None, val_fraction=0.2, max_epochs=50,
+                         min_epochs=5, reduction_factor=3, n_jobs=None, search_dir=None, random_state=42):
+    param_grid = param_grid or DEFAULT_PARAM_GRID
+    keys = list(param_grid)
+    configs = [dict(zip(keys, values)) for values in itertools.product(*(param_grid[key] for key in keys))]
+    # n_trialsを指定した場合はグリッドからランダムに選ぶ
+    if n_trials is not None and n_trials < len(configs):
+        rng = np.random.default_rng(random_state)
+        configs = [configs[i] for i in sorted(rng.choice(len(configs), size=n_trials, replace=False))]
+
+    # 時系列順に末尾を検証用として切り出す（訓練データでの評価は行わない）
+    split = int(len(X_train) * (1 - val_fraction))
+    data = {'X_train': X_train[:split], 'y_train': y_train[:split], 'X_val': X_train[split:], 'y_val': y_train[split:],
+            'seed': random_state}
+
+    search_id = None
+    if search_dir is not None:
+        os.makedirs(search_dir, exist_ok=True)
+        search_id = search_fingerprint(X_train, y_train, split, random_state, param_grid, n_trials)
+    logged_scores = load_trial_log(search_dir, search_id)
+    n_jobs = n_jobs or worker_budget()
+
+    states = {}
+    budgets = halving_budgets(min_epochs, max_epochs, reduction_factor)
+    if n_jobs > 1:
+        executor = make_worker_pool(n_jobs, data)
+    else:
+        init_worker(data)
+        executor = None
+
+    try:
+        for rung, epochs in enumerate(budgets):
+            scores = {}
+            pending = []
+            for params in configs:
+                trial_id = make_trial_id(params)
+                if (trial_id, epochs) in logged_scores:
+                    # 再開時：ログ済みの結果を再利用する
+                    scores[trial_id] = logged_scores[(trial_id, epochs)]
+                    if rung < len(budgets) - 1:
+                        states[trial_id] = load_trial_state(search_dir, trial_id)
+                else:
+                    pending.append(params)
+
+            if executor is not None:
+                futures = {executor.submit(run_trial, params, epochs, states.get(make_trial_id(params))): params for params in pending}
+                results = [(futures[future], future.result()) for future in as_completed(futures)]
+            else:
+                results = [(params, run_trial(params, epochs, states.get(make_trial_id(params)))) for params in pending]
+
+            for params, (state, mse) in results:
+                trial_id = make_trial_id(params)
+                states[trial_id] = state
+                scores[trial_id] = mse
+                record_trial(search_dir, trial_id, params, state, mse, search_id)
+
+            configs = sorted(configs, key=lambda params: scores[make_trial_id(params)])
+            print(f'Rung {rung+1}/{len(budgets)} ({epochs} epochs): {len(configs)} configs, best val MSE {scores[make_trial_id(configs[0])]:.6f}')
+            if rung < len(budgets) - 1:
+                configs = configs[:max(1, math.ceil(len(configs) / reduction_factor))]
+                states = {make_trial_id(params): states[make_trial_id(params)] for params in configs}
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    best_params = configs[0]
     print(f"Best parameters: {best_params}")
     return best_params
 
 # アンサンブル手法
+# 推論モードで各モデルをスレッドで同時に実行し、結合はテンソルのまま計算する
+# 既定は単純平均。fit_combinerで学習した重み（期間ごと）と切片があれば重み付き和にする
 class EnsembleModel:
-    def __init__(self, models):
+    def __init__(self, models, concurrent=True, weights=None, intercept=None):
         self.models = models
+        self.concurrent = concurrent and len(models) > 1
+        self.executor = None
+        self.weights = weights
+        self.intercept = intercept
+        self.inference_models = {}
+
+    # 推論用のスレッドプールと量子化したメンバーは保存しない（工程グラフのキャッシュ用）
+    def __getstate__(self):
+        return {**self.__dict__, 'executor': None, 'inference_models': {}}
+
+    # 各メンバーの予測を (メンバー, サンプル, 期間) の形で返す
+    # int8の場合、量子化したメンバーは一度だけ作成して使い回す
+    def member_outputs(self, X):
+        precision = INFERENCE_SETTINGS['precision']
+        if precision == 'int8':
+            if precision not in self.inference_models:
+                self.inference_models[precision] = [prepare_inference_model(model, precision) for model in self.models]
+            models = self.inference_models[precision]
+        else:
+            models = [prepare_inference_model(model, precision) for model in self.models]
+
+        def run(model):
+            with inference_context(precision):
+                return model(X).float()
+
+        if self.concurrent:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=len(models))
+            outputs = list(self.executor.map(run, models))
+        else:
+            outputs = [run(model) for model in models]
+        return torch.stack(outputs)
+
+    def predict_tensor(self, X):
+        outputs = self.member_outputs(X)
+        if self.weights is None:
+            return outputs.mean(dim=0)
+        return (self.weights.unsqueeze(1) * outputs).sum(dim=0) + self.intercept
 
     def predict(self, X):
-        predictions = [model(X).detach().numpy() for model in self.models]
-        return np.mean(predictions, axis=0)
-
-# バックテスト
-def perform_backtesting(df, window_size=252, step=20):
-    results = []
-    for i in range(0, len(df) - window_size, step):
-        train = df.iloc[i:i+window_size]
-        test = df.iloc[i+window_size:i+window_size+step]
-
-        X_train = train[['Open', 'High', 'Low', 'Volume', 'Change_Rate', 'Lag_1', 'Lag_7', 'Rolling_Mean_7', 'Rolling_Std_7', 'MACD', 'Signal_Line', 'RSI']]
-        y_train = train[['Close']]
-        X_test = test[['Open', 'High', 'Low', 'Volume', 'Change_Rate', 'Lag_1', 'Lag_7', 'Rolling_Mean_7', 'Rolling_Std_7', 'MACD', 'Signal_Line', 'RSI']]
-        y_test = test[['Close']]
-
-        scaler_X = MinMaxScaler()
-        scaler_y = MinMaxScaler()
-        X_train_scaled = scaler_X.fit_transform(X_train)
-        y_train_scaled = scaler_y.fit_transform(y_train)
-        X_test_scaled = scaler_X.transform(X_test)
-
-        X_train_tensor = torch.FloatTensor(X_train_scaled).unsqueeze(1)
-        y_train_tensor = torch.FloatTensor(y_train_scaled)
-        X_test_tensor = torch.FloatTensor(X_test_scaled).unsqueeze(1)
-
-        model = LSTMModel(input_dim=X_train_tensor.shape[2], hidden_dim=64, output_dim=1, num_layers=2)
-        train_model(model, X_train_tensor, y_train_tensor, epochs=50)
-
-        model.eval()
-        with torch.no_grad():
-            predictions = model(X_test_tensor)
-        predictions = scaler_y.inverse_transform(predictions.numpy())
+        with INSTRUMENTATION.stage('inference', model='EnsembleModel', members=len(self.models), samples=len(X)):
+            return self.predict_tensor(X).numpy()
+
+    # 検証データで結合方法を学習する（期間ごとに独立に求める）
+    # 'weighted'：検証MSEの逆数に比例する重み（和は1、切片なし）
+    # 'stacking'：各メンバーの予測を説明変数とする切片付きリッジ回帰
+    def fit_combiner(self, X_val, y_val, method='weighted', alpha=1e-3):
+        outputs = self.member_outputs(X_val).numpy().astype('float64')
+        y_val = np.asarray(y_val, dtype='float64').reshape(outputs.shape[1:])
+        n_members, _, n_horizons = outputs.shape
+        if method == 'weighted':
+            inverse_mse = 1.0 / np.maximum(((outputs - y_val) ** 2).mean(axis=1), 1e-12)
+            weights = inverse_mse / inverse_mse.sum(axis=0)
+            intercept = np.zeros(n_horizons)
+        elif method == 'stacking':
+            weights = np.empty((n_members, n_horizons))
+            intercept = np.empty(n_horizons)
+            for h in range(n_horizons):
+                P = outputs[:, :, h].T
+                P_mean, y_mean = P.mean(axis=0), y_val[:, h].mean()
+                P_centered = P - P_mean
+                weights[:, h] = np.linalg.solve(P_centered.T @ P_centered + alpha * len(P) * np.eye(n_members),
+                                                P_centered.T @ (y_val[:, h] - y_mean))
+                intercept[h] = y_mean - P_mean @ weights[:, h]
+        else:
+            raise ValueError(f"Unknown combiner: {method}")
+        self.weights = torch.as_tensor(weights, dtype=torch.float32)
+        self.intercept = torch.as_tensor(intercept, dtype=torch.float32)
+        return self
+
+# アンサンブルの一括訓練
+# 同じ形（hidden_dim・num_layers）のメンバーはパラメータを先頭の次元に積み重ね、torch.func.vmapで1回の計算で訓練できる
+# （既定のstacked='auto'では、順に訓練するより速いと計測できた場合だけ積み重ねる）
+# 形の異なるグループはプロセスプールで並列に訓練する
+# nn.LSTMはvmapに対応していないため、同じパラメータ名・ゲート順（i, f, g, o）の関数版LSTMで順伝播を計算する
+def lstm_forward(params, x, num_layers):
+    out = x
+    for layer in range(num_layers):
+        w_hh = params[f'lstm.weight_hh_l{layer}']
+        # 入力側の変換は全時点をまとめて計算し、時間方向のループでは隠れ状態側だけを計算する
+        # （時点ごとの添字ではなくunbindで分けることで、逆伝播で全時点分の勾配テンソルを毎回作らない）
+        bias = params[f'lstm.bias_ih_l{layer}'] + params[f'lstm.bias_hh_l{layer}']
+        gates_x = nn.functional.linear(out, params[f'lstm.weight_ih_l{layer}'], bias)
+        h = gates_x.new_zeros(gates_x.shape[0], w_hh.shape[1])
+        c = h
+        outputs = []
+        for gates_t in gates_x.unbind(1):
+            i, f, g, o = torch.addmm(gates_t, h, w_hh.T).chunk(4, dim=1)
+            c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+            h = torch.sigmoid(o) * torch.tanh(c)
+            outputs.append(h)
+        if layer < num_layers - 1:
+            out = torch.stack(outputs, dim=1)
+    return nn.functional.linear(h, params['fc.weight'], params['fc.bias'])
+
+# 1回の順伝播・逆伝播で扱う（メンバー数×サンプル数）の上限
+# ミニバッチがこれを超える場合（batch_size=Noneの全データなど）は分割して勾配を足し合わせるため、メモリは一定に収まる
+STACKED_CHUNK_ROWS = 4096
+
+def stacked_chunk_size(n_members, chunk_rows=STACKED_CHUNK_ROWS):
+    return max(1, chunk_rows // n_members)
+
+# 同じ形のメンバーをn_members個まとめて訓練する（batch_size=Noneは全データで1エポック1ステップ）
+# bootstrap=Trueでは、メンバーごとに復元抽出した訓練データからミニバッチを取る（バギング）
+def train_stacked_members(init_kwargs, n_members, X_train, y_train, epochs=100, lr=0.001, batch_size=256,
+                          bootstrap=False, seed=0, verbose=False, chunk_rows=STACKED_CHUNK_ROWS):
+    members = seeded_init(lambda: [LSTMModel(**init_kwargs) for _ in range(n_members)], seed)
+    params, _ = torch.func.stack_module_state(members)
+    forward = torch.func.vmap(functools.partial(lstm_forward, num_layers=init_kwargs['num_layers']),
+                              in_dims=(0, 0 if bootstrap else None))
+    optimizer = optim.Adam(params.values(), lr=lr)
+    generator = torch.Generator().manual_seed(seed)
+    n = len(X_train)
+    batch_size = batch_size or n
+    samples = torch.randint(n, (n_members, n), generator=generator) if bootstrap else None
+    chunk_size = stacked_chunk_size(n_members, chunk_rows)
+
+    history = {'train_loss': []}
+    with INSTRUMENTATION.stage('training', model='StackedLSTM', members=n_members, epochs=epochs, batch_size=batch_size,
+                              param_mb=tensor_mb(*params.values()), input_mb=tensor_mb(X_train, y_train)):
+        for epoch in range(epochs):
+            order = torch.randperm(n, generator=generator) if batch_size < n else torch.arange(n)
+            total = torch.zeros(n_members)
+            epoch_started = time.perf_counter()
+            for start in range(0, n, batch_size):
+                batch = order[start:start + batch_size]
+                optimizer.zero_grad()
+                # 各メンバーの損失（バッチ内の平均）の和を最小化するため、勾配はメンバーごとに独立している
+                # バッチはchunk_size行ずつに分け、各部分の平均を行数で重み付けして勾配を累積する（バッチ全体の平均と同じ勾配）
+                for chunk_start in range(0, len(batch), chunk_size):
+                    index = batch[chunk_start:chunk_start + chunk_size]
+                    if bootstrap:
+                        index = samples[:, index]
+                    X_chunk, y_chunk = X_train[index], y_train[index]
+                    member_loss = ((forward(params, X_chunk) - y_chunk) ** 2).mean(dim=(-2, -1))
+                    (member_loss.sum() * (index.shape[-1] / len(batch))).backward()
+                    total += member_loss.detach() * index.shape[-1]
+                optimizer.step()
+            history['train_loss'].append((total / n).tolist())
+            epoch_seconds = time.perf_counter() - epoch_started
+            INSTRUMENTATION.log('epoch', model='StackedLSTM', members=n_members, epoch=epoch + 1, samples=n * n_members,
+                                seconds=epoch_seconds, samples_per_sec=n * n_members / epoch_seconds if epoch_seconds > 0 else None,
+                                train_loss=float(total.mean() / n))
+            if verbose and (epoch + 1) % 10 == 0:
+                print(f'Epoch {epoch+1}/{epochs}, Loss: {float(total.mean() / n):.4f} (mean of {n_members} members)')
+
+    for i, model in enumerate(members):
+        model.load_state_dict({name: value[i].detach().clone() for name, value in params.items()})
+    return members, history
+
+# 積み重ねた訓練が順に訓練するより速いかを、1ステップ分（順伝播・逆伝播）の時間で比べる
+# 関数版LSTMは時点ごとのループをPythonで回すため、隠れ層が大きい・コアが少ない場合は融合カーネルのnn.LSTMを順に使う方が速い
+# （例：hidden_dim=64・2層・1コアでは、10メンバーを積み重ねると順に訓練するより約25%遅い）
+def stacked_is_faster(init_kwargs, n_members, X_train, y_train, batch_size, repeats=2, margin=0.8):
+    rows = min(batch_size or len(X_train), stacked_chunk_size(n_members), len(X_train))
+    X_batch, y_batch = X_train[:rows], y_train[:rows]
+    with torch.random.fork_rng():
+        members = [LSTMModel(**init_kwargs) for _ in range(n_members)]
+        params, _ = torch.func.stack_module_state(members)
+        forward = torch.func.vmap(functools.partial(lstm_forward, num_layers=init_kwargs['num_layers']), in_dims=(0, None))
+
+        def stacked_step():
+            ((forward(params, X_batch) - y_batch) ** 2).mean(dim=(-2, -1)).sum().backward()
+
+        def sequential_step():
+            for model in members:
+                nn.functional.mse_loss(model(X_batch), y_batch).backward()
+
+        timings = {}
+        for name, step in (('stacked', stacked_step), ('sequential', sequential_step)):
+            step()
+            started = time.perf_counter()
+            for _ in range(repeats):
+                step()
+            timings[name] = (time.perf_counter() - started) / repeats
+    INSTRUMENTATION.log('ensemble_mode', members=n_members, hidden_dim=init_kwargs['hidden_dim'], rows=rows,
+                        stacked_seconds=timings['stacked'], sequential_seconds=timings['sequential'])
+    return timings['stacked'] < margin * timings['sequential']
+
+# 1グループ分の訓練（プロセスプールのワーカーで実行）
+# stacked=Trueでは同じ形のメンバーを積み重ねて訓練し、Falseまたはメンバーが1つだけの場合は
+# 融合カーネルを使うnn.LSTMのままtrain_modelで順に訓練する。'auto'はstacked_is_fasterで速い方を選ぶ
+def run_ensemble_group(init_kwargs, n_members, epochs, lr, batch_size, bootstrap, seed, stacked='auto'):
+    X_train, y_train = WORKER_DATA['X_train'], WORKER_DATA['y_train']
+    if stacked == 'auto' and n_members > 1:
+        stacked = stacked_is_faster(init_kwargs, n_members, X_train, y_train, batch_size)
+    if stacked and n_members > 1:
+        members, _ = train_stacked_members(init_kwargs, n_members, X_train, y_train, epochs=epochs, lr=lr,
+                                           batch_size=batch_size, bootstrap=bootstrap, seed=seed)
+        return [model.state_dict() for model in members]
+
+    generator = torch.Generator().manual_seed(seed)
+    states = []
+    for model in seeded_init(lambda: [LSTMModel(**init_kwargs) for _ in range(n_members)], seed):
+        if bootstrap:
+            sample = torch.randint(len(X_train), (len(X_train),), generator=generator)
+            train_model(model, X_train[sample], y_train[sample], epochs=epochs, lr=lr, batch_size=batch_size, verbose=False)
+        else:
+            train_model(model, X_train, y_train, epochs=epochs, lr=lr, batch_size=batch_size, verbose=False)
+        states.append(model.state_dict())
+    return states
+
+# membersはメンバーごとの{'hidden_dim', 'num_layers'}のリスト（同じ形を繰り返せば、その数だけまとめて訓練する）
+# combiner='weighted'・'stacking'ではX_val・y_valで結合方法を学習する
+def train_ensemble(X_train, y_train, members, X_val=None, y_val=None, combiner='mean', epochs=100, lr=0.001,
+                   batch_size=256, bootstrap=False, stacked='auto', n_jobs=None, seed=0):
+    if combiner != 'mean' and X_val is None:
+        raise ValueError(f"combiner='{combiner}' requires X_val and y_val")
+    counts = {}
+    for config in members:
+        shape = (config['hidden_dim'], config['num_layers'])
+        counts[shape] = counts.get(shape, 0) + 1
+    groups = [({'input_dim': X_train.shape[-1], 'hidden_dim': hidden_dim, 'output_dim': y_train.shape[1], 'num_layers': num_layers},
+               count, seed + k) for k, ((hidden_dim, num_layers), count) in enumerate(counts.items())]
+
+    data = {'X_train': X_train, 'y_train': y_train}
+    n_jobs = min(n_jobs or worker_budget(), len(groups))
+    if n_jobs > 1:
+        with make_worker_pool(n_jobs, data) as executor:
+            futures = [executor.submit(run_ensemble_group, init_kwargs, count, epochs, lr, batch_size, bootstrap, group_seed, stacked)
+                       for init_kwargs, count, group_seed in groups]
+            states = [future.result() for future in futures]
+    else:
+        init_worker(data)
+        states = [run_ensemble_group(init_kwargs, count, epochs, lr, batch_size, bootstrap, group_seed, stacked)
+                  for init_kwargs, count, group_seed in groups]
+
+    models = []
+    for (init_kwargs, _, _), group_states in zip(groups, states):
+        for state in group_states:
+            model = LSTMModel(**init_kwargs)
+            model.load_state_dict(state)
+            models.append(model)
+    ensemble = EnsembleModel(models)
+    if combiner != 'mean':
+        ensemble.fit_combiner(X_val, y_val, combiner)
+    return ensemble
+
+# バッチ推論サーバー
+# 到着したリクエストを最大max_batch_size件、または最初のリクエストからmax_latency_msが経つまでまとめて推論する
+# input_shapeは1サンプルの形 (lookback, 特徴量数)。省略した場合は最初のリクエストの形に合わせる
+# scaler_Xを渡すと、正規化前の特徴量を受け取ってサーバー側で正規化する
+class InferenceServer:
+    def __init__(self, ensemble, scaler_y=None, max_batch_size=64, max_latency_ms=5.0, history_size=10000, input_shape=None,
+                 scaler_X=None):
+        self.ensemble = ensemble
+        self.scaler_y = scaler_y
+        self.scaler_X = scaler_X
+        self.input_shape = tuple(input_shape) if input_shape is not None else None
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=history_size)
+        self.completed = 0
+        self.batches = 0
+        self.started_at = time.perf_counter()
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    # 1サンプル（lookback x 特徴量数）の推論を依頼し、Futureを返す
+    # 形の合わないリクエストはバッチに入れず、そのリクエストのFutureだけを失敗させる
+    def submit(self, x):
+        future = Future()
+        try:
+            x = np.asarray(x, dtype='float64')
+            if x.ndim != 2 or (self.input_shape is not None and x.shape != self.input_shape):
+                raise ValueError(f"Expected an input of shape {self.input_shape or '(lookback, n_features)'}, got {x.shape}")
+            if self.input_shape is None:
+                self.input_shape = x.shape
+            if self.scaler_X is not None:
+                x = self.scaler_X.transform(x)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        self.requests.put((time.perf_counter(), torch.from_numpy(x.astype('float32')), future))
+        return future
+
+    def predict(self, x, timeout=None):
+        return self.submit(x).result(timeout)
+
+    def next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[0] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            # 既に待っているリクエストは待たずに取り出し、キューが空なら期限まで待つ
+            try:
+                item = self.requests.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if item is None:
+                self.requests.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+            try:
+                predictions = self.ensemble.predict_tensor(torch.stack([x for _, x, _ in batch])).numpy()
+                if self.scaler_y is not None:
+                    predictions = inverse_transform_horizons(self.scaler_y, predictions)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+            with self.lock:
+                self.batches += 1
+                self.completed += len(batch)
+                self.latencies.extend(finished - received for received, _, _ in batch)
+            for (_, _, future), prediction in zip(batch, predictions):
+                future.set_result(prediction)
+
+    # スループットとレイテンシ（p50/p99、ミリ秒）の統計
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            completed, batches = self.completed, self.batches
+        elapsed = time.perf_counter() - self.started_at
+        return {
+            'requests': completed,
+            'batches': batches,
+            'mean_batch_size': completed / batches if batches else 0.0,
+            'throughput_per_sec': completed / elapsed if elapsed > 0 else 0.0,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+# ローカルHTTPフロントエンド
+# POST /predict {"inputs": [[[...], ...], ...]} -> {"predictions": [...]}、GET /stats -> 統計
+def serve_predictions(server, host='127.0.0.1', port=8000):
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, server.stats())
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                futures = [server.submit(x) for x in payload['inputs']]
+                predictions = [future.result().tolist() for future in futures]
+            except Exception as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            self.send_json(200, {'predictions': predictions})
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), PredictionHandler)
+    print(f'Serving predictions on http://{host}:{port}')
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        server.close()
+
+# モデルの保存と読み込み（モデルレジストリ）
+# models/<name>/<データのハッシュ>/ に重み・スケーラー・特徴量リスト・コンパイル済みグラフを保存する
+MODEL_REGISTRY_DIR = 'models'
+
+def array_fingerprint(*arrays):
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.shape, array.dtype.str)).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()[:16]
+
+# MinMaxScalerはpickleではなくJSONで保存する（推論時にscikit-learnが不要になる）
+def scaler_to_dict(scaler):
+    return {'feature_range': list(scaler.feature_range), 'min': scaler.min_.tolist(), 'scale': scaler.scale_.tolist(),
+            'data_min': scaler.data_min_.tolist(), 'data_max': scaler.data_max_.tolist()}
+
+def scaler_from_dict(params):
+    from sklearn.preprocessing import MinMaxScaler
+
+    scaler = MinMaxScaler(feature_range=tuple(params['feature_range']))
+    scaler.min_ = np.array(params['min'])
+    scaler.scale_ = np.array(params['scale'])
+    scaler.data_min_ = np.array(params['data_min'])
+    scaler.data_max_ = np.array(params['data_max'])
+    scaler.data_range_ = scaler.data_max_ - scaler.data_min_
+    scaler.n_features_in_ = len(scaler.min_)
+    return scaler
+
+def export_model(model, example_input, version_dir, export_onnx=False):
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_input, check_trace=False)
+    traced.save(os.path.join(version_dir, 'model.ts'))
+    if export_onnx:
+        torch.onnx.export(model, (example_input,), os.path.join(version_dir, 'model.onnx'),
+                          input_names=['input'], output_names=['output'],
+                          dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}}, dynamo=False)
+
+# benchmark=Falseでは書き出したグラフの推論時間を計測しない（オンライン更新など、保存を軽く済ませたい場合）
+# artifacts_fromには重みが同じ版のディレクトリを渡す。グラフを書き出し直さずにその版のファイルと推論時間を引き継ぐ
+def save_model(model, name, init_kwargs, scaler_X, scaler_y, feature_columns, data_hash, example_input=None,
+               lookback=1, registry_dir=MODEL_REGISTRY_DIR, export_onnx=False, quantized=False, benchmark=True,
+               artifacts_from=None):
+    version_dir = os.path.join(registry_dir, name, data_hash)
+    os.makedirs(version_dir, exist_ok=True)
+    torch.save(model.state_dict(), os.path.join(version_dir, 'weights.pt'))
+    manifest = {
+        'name': name,
+        'model_class': type(model).__name__,
+        'init_kwargs': init_kwargs,
+        'feature_columns': list(feature_columns),
+        'lookback': lookback,
+        'data_hash': data_hash,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scaler_X': scaler_to_dict(scaler_X),
+        'scaler_y': scaler_to_dict(scaler_y),
+        'quantized': quantized,
+    }
+    # 書き出したグラフは、通常実行との1バッチあたりの推論時間（ミリ秒）をmanifestに一緒に記録する
+    if artifacts_from is not None:
+        for filename in ('model.ts', 'model.onnx'):
+            if os.path.exists(os.path.join(artifacts_from, filename)):
+                shutil.copyfile(os.path.join(artifacts_from, filename), os.path.join(version_dir, filename))
+        with open(os.path.join(artifacts_from, 'manifest.json')) as f:
+            latency = json.load(f).get('latency_ms')
+        if latency is not None:
+            manifest['latency_ms'] = latency
+    elif example_input is not None:
+        export_model(model, example_input, version_dir, export_onnx=export_onnx)
+        if benchmark:
+            manifest['latency_ms'] = benchmark_compiled_model(model, example_input, version_dir)
+    with open(os.path.join(version_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    with open(os.path.join(registry_dir, name, 'LATEST'), 'w') as f:
+        f.write(data_hash)
+    return version_dir
+
+def resolve_version_dir(name, version=None, registry_dir=MODEL_REGISTRY_DIR):
+    if version is None:
+        with open(os.path.join(registry_dir, name, 'LATEST')) as f:
+            version = f.read().strip()
+    return os.path.join(registry_dir, name, version)
+
+# 保存したモデルを通常のPyTorchモデルとして復元する
+def load_model(name, version=None, registry_dir=MODEL_REGISTRY_DIR):
+    version_dir = resolve_version_dir(name, version, registry_dir)
+    with open(os.path.join(version_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    model = globals()[manifest['model_class']](**manifest['init_kwargs'])
+    # 量子化したモデルは、同じ構造に量子化してから重みを読み込む
+    if manifest.get('quantized'):
+        model = quantize_model(model)
+    model.load_state_dict(torch.load(os.path.join(version_dir, 'weights.pt'), weights_only=False))
+    model.eval()
+    return model, scaler_from_dict(manifest['scaler_X']), scaler_from_dict(manifest['scaler_y']), manifest
+
+# 通常実行とTorchScript（およびONNX Runtime）の1バッチあたりの推論時間を比較する
+def benchmark_compiled_model(model, example_input, version_dir, n_iter=100, warmup=10):
+    def measure(run):
+        for _ in range(warmup):
+            run()
+        started = time.perf_counter()
+        for _ in range(n_iter):
+            run()
+        return (time.perf_counter() - started) / n_iter * 1000.0
 
-        mse = mean_squared_error(y_test, predictions)
-        results.append({'start_date': test.index[0], 'mse': mse})
+    model.eval()
+    compiled = torch.jit.load(os.path.join(version_dir, 'model.ts'))
+    with torch.inference_mode():
+        results = {'eager_ms': measure(lambda: model(example_input)),
+                   'torchscript_ms': measure(lambda: compiled(example_input))}
+    onnx_path = os.path.join(version_dir, 'model.onnx')
+    if os.path.exists(onnx_path):
+        try:
+            import onnxruntime
+        except ImportError:
+            onnxruntime = None
+        if onnxruntime is not None:
+            session = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+            feed = {'input': example_input.numpy()}
+            results['onnx_ms'] = measure(lambda: session.run(None, feed))
+    print(', '.join(f'{key}: {value:.3f}' for key, value in results.items()))
+    return results
 
-    results_df = pd.DataFrame(results)
+# バックテスト
+# 特徴量と終値は最初に一度だけ特徴量ストア（float32配列）に変換し、各ウィンドウはその配列のスライスとして扱う
+# mode='cold'：各ウィンドウを新しいモデルで訓練（従来の動作）
+# mode='warm'：前のウィンドウの重みから開始し、fine_tune_epochsだけ追加訓練する
+# mode='parallel'：独立したウィンドウをプロセスプールで並列に訓練する
+# horizon>1では各系列の最終行から先horizon本の終値を1回の順伝播でまとめて予測し、期間ごとのMSEも記録する
+def run_backtest_window(start, window_size, step, epochs, hidden_dim=64, num_layers=2, lr=0.001, state=None, lookback=1,
+                        horizon=1, precision='float32', seed=0):
+    started = time.perf_counter()
+    # 訓練期間とテスト期間（最後のテスト系列の目標値まで）の行だけを、訓練期間の最小値・最大値で正規化したコピーにする
+    raw = FeatureStore(WORKER_DATA['values'][start:start+window_size+step+horizon-1], WORKER_DATA['columns'])
+    store = raw.scaled(slice(0, window_size))
+    scaler_y = store.scaler_y
+    # テスト期間の系列は、訓練期間末尾のlookback-1行を履歴として含める
+    # 訓練系列は目標値がすべて訓練期間内に収まるものだけを使う
+    X_seq, y_seq = store.sequences(lookback, horizon, multi_output=True)
+    n_train = window_size - lookback - horizon + 2
+    test = slice(window_size - lookback + 1, window_size - lookback + 1 + step)
+    X_train_tensor, y_train_tensor = X_seq[:n_train], y_seq[:n_train]
+    X_test_tensor = X_seq[test]
+    y_test = raw.sequences(lookback, horizon, multi_output=True)[1][test].numpy().astype('float64')
+    # 方向の的中率の基準：各テスト系列の最終行の前日の終値（最初のテスト系列では訓練期間の最後の終値）
+    reference = raw.values[window_size - 1:window_size - 1 + len(y_test), -1].astype('float64')
+
+    model = seeded_init(lambda: LSTMModel(input_dim=X_train_tensor.shape[2], hidden_dim=hidden_dim, output_dim=horizon,
+                                          num_layers=num_layers), seed + start)
+    if state is not None:
+        model.load_state_dict(state)
+    train_started = time.perf_counter()
+    train_model(model, X_train_tensor, y_train_tensor, epochs=epochs, lr=lr, verbose=False)
+    train_seconds = time.perf_counter() - train_started
+
+    inference_model = prepare_inference_model(model, precision)
+    with inference_context(precision):
+        predictions = inference_model(X_test_tensor).float()
+    predictions = inverse_transform_horizons(scaler_y, predictions.numpy())
+
+    # 指標は全ウィンドウの予測をまとめてからperform_backtestingで計算する
+    result = {'start': start, 'predictions': predictions, 'targets': y_test, 'reference': reference,
+              'train_seconds': train_seconds, 'window_seconds': time.perf_counter() - started}
+    return result, model.state_dict()
+
+# 全ウィンドウのテスト期間を (ウィンドウ, サンプル, 期間) の配列にNaNで埋めてそろえ、StreamingMetricsで1回で評価する
+def backtest_window_metrics(results, horizon=1):
+    n_test = max((len(result['targets']) for result in results), default=0)
+    predictions = np.full((len(results), n_test, horizon), np.nan)
+    targets = np.full((len(results), n_test, horizon), np.nan)
+    reference = np.full((len(results), n_test), np.nan)
+    for k, result in enumerate(results):
+        n = len(result['targets'])
+        predictions[k, :n], targets[k, :n], reference[k, :n] = result['predictions'], result['targets'], result['reference']
+    metrics = StreamingMetrics().update(predictions, targets, reference).results()
+    rows = []
+    for k, result in enumerate(results):
+        row = {'start': result['start'], 'mse': float(metrics['mse'][k].mean()), 'mae': float(metrics['mae'][k].mean()),
+               'directional_accuracy': float(metrics['directional_accuracy'][k].mean())}
+        if horizon > 1:
+            row.update({f'mse_h{h + 1}': value for h, value in enumerate(metrics['mse'][k])})
+        row.update({'train_seconds': result['train_seconds'], 'window_seconds': result['window_seconds']})
+        rows.append(row)
+    return rows
+
+def perform_backtesting(df, window_size=252, step=20, epochs=50, mode='cold', fine_tune_epochs=5,
+                        n_jobs=None, hidden_dim=64, num_layers=2, lr=0.001, lookback=1, horizon=1, plot=True, seed=0):
+    store = FeatureStore.from_frame(df)
+    data = {'values': store.values, 'columns': store.columns}
+    starts = list(range(0, len(df) - window_size - horizon + 1, step))
+    # ワーカープロセスにはINFERENCE_SETTINGSが引き継がれないため、推論の精度は引数で渡す
+    options = {'hidden_dim': hidden_dim, 'num_layers': num_layers, 'lr': lr, 'lookback': lookback, 'horizon': horizon,
+               'precision': INFERENCE_SETTINGS['precision'], 'seed': seed}
+
+    if mode == 'parallel':
+        n_jobs = n_jobs or worker_budget()
+        with make_worker_pool(n_jobs, data) as executor:
+            futures = [executor.submit(run_backtest_window, start, window_size, step, epochs, **options) for start in starts]
+            results = [future.result()[0] for future in futures]
+    elif mode in ('cold', 'warm'):
+        init_worker(data)
+        results = []
+        state = None
+        for start in starts:
+            if mode == 'warm' and state is not None:
+                result, state = run_backtest_window(start, window_size, step, fine_tune_epochs, state=state, **options)
+            else:
+                result, state = run_backtest_window(start, window_size, step, epochs, **options)
+            results.append(result)
+    else:
+        raise ValueError(f"Unknown backtest mode: {mode}")
+
+    results_df = pd.DataFrame(backtest_window_metrics(results, horizon) if results else [])
+    if len(results_df):
+        results_df.insert(0, 'start_date', df.index[results_df.pop('start') + window_size])
+    print(f"Backtest ({mode}): {len(results_df)} windows, mean MSE {results_df['mse'].mean():.4f}, "
+          f"train time {results_df['train_seconds'].sum():.1f}s")
+    if horizon > 1 and len(results_df):
+        per_horizon = results_df[[f'mse_h{h}' for h in range(1, horizon + 1)]].mean()
+        print('Mean MSE by horizon: ' + ', '.join(f'{h}: {value:.4f}' for h, value in enumerate(per_horizon, 1)))
+
+    if plot and PLOT_SETTINGS['enabled']:
+        plot_backtest(results_df)
+    return results_df
+
+def plot_backtest(results_df):
+    plt = load_pyplot()
     plt.figure(figsize=(12, 6))
     plt.plot(results_df['start_date'], results_df['mse'])
     plt.title('バックテスト結果：時間経過に伴うMSE')
     plt.xlabel('開始日')
     plt.ylabel('MSE')
-    plt.show()
-
-# メイン実行部分
-if __name__ == "__main__":
-    # データの読み込みと前処理
-    df = load_and_preprocess_data('stock_price.csv')
-    df = engineer_features(df)
+    show_figure(plt, 'backtest')
+
+# 複数銘柄（パネル）モード
+# 銘柄ごとのCSVを (Ticker, Date) のMultiIndexを持つ縦長のDataFrameにまとめて扱う
+def load_panel(source, cache_dir=CACHE_DIR, n_jobs=None):
+    paths = sorted(glob.glob(os.path.join(source, '*.csv')) if os.path.isdir(source) else glob.glob(source))
+    if not paths:
+        raise FileNotFoundError(f"No CSV files found for {source}")
+    tickers = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        frames = list(executor.map(lambda path: load_and_preprocess_data(path, cache_dir=cache_dir), paths))
+    return pd.concat(frames, keys=tickers, names=['Ticker', 'Date'])
+
+# 各行の銘柄内での位置（銘柄ごとに0から数える）
+def panel_positions(index):
+    tickers = index.get_level_values('Ticker')
+    n = len(tickers)
+    is_start = np.ones(n, dtype=bool)
+    is_start[1:] = tickers[1:] != tickers[:-1]
+    rows = np.arange(n)
+    return rows - np.maximum.accumulate(np.where(is_start, rows, 0))
+
+# 全銘柄の特徴量を1回のベクトル化パスで計算する（銘柄ごとのengineer_featuresと同じ値になる）
+def engineer_panel_features(panel):
+    panel = panel.sort_index(level=['Ticker', 'Date'], sort_remaining=False)
+    features, _, _ = compute_features(panel['Close'].to_numpy(dtype='float64'), panel_positions(panel.index))
+    return panel.assign(**{col: features[col] for col in ENGINEERED_COLUMNS}).dropna()
+
+# 銘柄ごとのMinMaxスケーリング（groupbyで最小値・最大値をまとめて求める）
+class PanelScaler:
+    def fit(self, values):
+        grouped = values.groupby(level='Ticker', sort=False)
+        self.data_min_ = grouped.min()
+        self.data_max_ = grouped.max()
+        data_range = self.data_max_ - self.data_min_
+        self.scale_ = 1.0 / data_range.where(data_range != 0, 1.0)
+        self.min_ = -self.data_min_ * self.scale_
+        return self
+
+    def params_for(self, tickers):
+        return self.scale_.reindex(tickers).to_numpy(), self.min_.reindex(tickers).to_numpy()
+
+    def transform(self, values):
+        scale, min_ = self.params_for(values.index.get_level_values('Ticker'))
+        return values.to_numpy(dtype='float64') * scale + min_
+
+    def inverse_transform(self, scaled, tickers):
+        scale, min_ = self.params_for(tickers)
+        return (np.asarray(scaled) - min_) / scale
+
+    # 1銘柄分のスケーラーをMinMaxScalerとして取り出す（モデルレジストリへの保存用）
+    def scaler_for(self, ticker):
+        return scaler_from_dict({'feature_range': [0, 1], 'min': self.min_.loc[ticker].tolist(), 'scale': self.scale_.loc[ticker].tolist(),
+                                 'data_min': self.data_min_.loc[ticker].tolist(), 'data_max': self.data_max_.loc[ticker].tolist()})
+
+# 銘柄の境界をまたがないウィンドウだけをインデックスとして持つ系列データセット（ウィンドウはコピーしない）
+class PanelSequenceDataset(Dataset):
+    def __init__(self, X, y, position, lookback=1, horizon=1):
+        self.X = torch.as_tensor(X, dtype=torch.float32)
+        self.y = torch.as_tensor(y, dtype=torch.float32)
+        self.lookback = lookback
+        self.horizon = horizon
+        ends = np.arange(lookback - 1, len(position) - horizon + 1)
+        valid = (position[ends] >= lookback - 1) & (position[ends + horizon - 1] == position[ends] + horizon - 1)
+        self.ends = ends[valid]
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, idx):
+        end = self.ends[idx]
+        return self.X[end - self.lookback + 1:end + 1], self.y[end + self.horizon - 1]
+
+# 1銘柄分のモデルを訓練する（プロセスプールのワーカーで実行）
+def run_ticker_training(start, end, lookback, epochs, hidden_dim, num_layers, lr, batch_size):
+    X, y = WORKER_DATA['X'][start:end], WORKER_DATA['y'][start:end]
+    X_seq, y_seq = make_sequences(X, y, lookback)
+    model = seeded_init(lambda: LSTMModel(input_dim=X.shape[1], hidden_dim=hidden_dim, output_dim=1, num_layers=num_layers), start)
+    train_model(model, X_seq, y_seq, epochs=epochs, lr=lr, batch_size=batch_size, verbose=False)
+    return model.state_dict()
+
+# mode='shared'：全銘柄の系列で1つのモデルをミニバッチ訓練する
+# mode='per_ticker'：銘柄ごとのモデルをプロセスプールでまとめて訓練する
+def train_panel_models(panel, mode='shared', lookback=20, epochs=20, hidden_dim=64, num_layers=2, lr=0.001,
+                       batch_size=256, n_jobs=None):
+    scaler_X = PanelScaler().fit(panel[FEATURE_COLUMNS])
+    scaler_y = PanelScaler().fit(panel[['Close']])
+    X = scaler_X.transform(panel[FEATURE_COLUMNS]).astype('float32')
+    y = scaler_y.transform(panel[['Close']]).astype('float32')
+    position = panel_positions(panel.index)
+
+    if mode == 'shared':
+        dataset = PanelSequenceDataset(X, y, position, lookback)
+        model = LSTMModel(input_dim=X.shape[1], hidden_dim=hidden_dim, output_dim=1, num_layers=num_layers)
+        train_model(model, dataset, None, epochs=epochs, lr=lr, batch_size=batch_size)
+        return {'shared': model}, scaler_X, scaler_y
+
+    if mode != 'per_ticker':
+        raise ValueError(f"Unknown panel training mode: {mode}")
+    tickers = panel.index.get_level_values('Ticker')
+    starts = np.flatnonzero(position == 0)
+    bounds = list(zip(starts, list(starts[1:]) + [len(position)]))
+    n_jobs = n_jobs or worker_budget()
+    with make_worker_pool(n_jobs, {'X': X, 'y': y}) as executor:
+        futures = [executor.submit(run_ticker_training, start, end, lookback, epochs, hidden_dim, num_layers, lr, batch_size)
+                   for start, end in bounds]
+        states = [future.result() for future in futures]
+
+    models = {}
+    for (start, _), state in zip(bounds, states):
+        model = LSTMModel(input_dim=X.shape[1], hidden_dim=hidden_dim, output_dim=1, num_layers=num_layers)
+        model.load_state_dict(state)
+        models[tickers[start]] = model
+    return models, scaler_X, scaler_y
 
-    # 探索的データ分析 (EDA)
-    perform_eda(df)
+# クロスバリデーション関数
+# フォールドごとにスケーラーを学習し、モデルもフォールドごとに新しく作成する（前のフォールドの重みを引き継がない）
+# walk_forward=Trueは拡張ウィンドウ（TimeSeriesSplit相当）、Falseはパージ・エンバーゴ付きのK分割
+def purged_splits(n_samples, n_splits=5, purge=0, embargo=0, walk_forward=True):
+    indices = np.arange(n_samples)
+    if walk_forward:
+        # 先頭ブロックを訓練専用にし、残りをn_splits個の検証フォールドに分ける
+        fold_size = n_samples // (n_splits + 1)
+        for k in range(n_splits):
+            val_start = n_samples - (n_splits - k) * fold_size
+            val_end = val_start + fold_size
+            yield indices[:max(0, val_start - purge)], indices[val_start:val_end]
+    else:
+        for val_index in np.array_split(indices, n_splits):
+            keep = (indices < val_index[0] - purge) | (indices > val_index[-1] + embargo)
+            yield indices[keep], val_index
+
+# 1フォールド分の処理（プロセスプールのワーカーで実行）
+def run_cv_fold(fold, train_index, val_index, model_factory, lookback, epochs, lr, seed=0):
+    from sklearn.metrics import mean_squared_error
+
+    started = time.perf_counter()
+    # 系列iの最終行はi + lookback - 1。スケーラーは訓練系列の行だけで学習する
+    train_rows = np.unique((train_index[:, None] + np.arange(lookback)).ravel())
+    store = FeatureStore(WORKER_DATA['values'], WORKER_DATA['columns']).scaled(train_rows)
+    scaler_y = store.scaler_y
+    X_seq, y_seq = store.sequences(lookback)
+    # 連続した範囲（ウォークフォワードの訓練範囲・検証フォールド）はコピーせずにビューで渡す
+    train_view, val_view = index_slice(train_index), index_slice(val_index)
+
+    model = copy.deepcopy(model_factory) if isinstance(model_factory, nn.Module) else seeded_init(model_factory, seed + fold)
+    fit_started = time.perf_counter()
+    train_model(model, X_seq[train_view], y_seq[train_view], epochs=epochs, lr=lr, verbose=False)
+    fit_seconds = time.perf_counter() - fit_started
 
-    # 特徴量と目標変数の定義
-    X = df[['Open', 'High', 'Low', 'Volume', 'Change_Rate', 'Lag_1', 'Lag_7', 'Rolling_Mean_7', 'Rolling_Std_7', 'MACD', 'Signal_Line', 'RSI']]
-    y = df[['Close']]
+    model.eval()
+    with torch.no_grad():
+        predictions = model(X_seq[val_view]).numpy()
+    y_val = y_seq[val_view].numpy()
+    return {
+        'fold': fold,
+        'train_size': len(train_index),
+        'val_size': len(val_index),
+        'val_start': int(val_index[0]) + lookback - 1,
+        'val_end': int(val_index[-1]) + lookback - 1,
+        'mse_scaled': mean_squared_error(y_val, predictions),
+        'mse': mean_squared_error(scaler_y.inverse_transform(y_val), scaler_y.inverse_transform(predictions)),
+        'fit_seconds': fit_seconds,
+        'total_seconds': time.perf_counter() - started,
+    }
 
-    # 特徴量重要度の分析
-    feature_importance = analyze_feature_importance(X, y)
+# model_factoryは引数なしでモデルを返す呼び出し可能オブジェクト（プロセスプールで使うためpickle可能なもの）
+# nn.Moduleを渡した場合は、その初期状態のコピーを各フォールドで使う
+# Xには正規化前のFeatureStoreを渡すこともできる（その場合yはNone）
+def perform_cross_validation(X, y, model_factory, n_splits=5, lookback=1, epochs=50, lr=0.001, purge=0, embargo=0,
+                             walk_forward=True, n_jobs=None, seed=0):
+    store = X if isinstance(X, FeatureStore) else FeatureStore.from_arrays(X, y)
+    index = store.index
+    data = {'values': store.values, 'columns': store.columns}
+    n_samples = len(store.values) - lookback + 1
+    folds = [(fold, train_index, val_index) for fold, (train_index, val_index)
+             in enumerate(purged_splits(n_samples, n_splits, purge, embargo, walk_forward)) if len(train_index)]
+
+    n_jobs = min(n_jobs or worker_budget(), len(folds))
+    if n_jobs > 1:
+        with make_worker_pool(n_jobs, data) as executor:
+            futures = [executor.submit(run_cv_fold, fold, train_index, val_index, model_factory, lookback, epochs, lr, seed)
+                       for fold, train_index, val_index in folds]
+            results = [future.result() for future in futures]
+    else:
+        init_worker(data)
+        results = [run_cv_fold(fold, train_index, val_index, model_factory, lookback, epochs, lr, seed)
+                   for fold, train_index, val_index in folds]
+
+    report = pd.DataFrame(results)
+    if index is not None and len(report):
+        report['val_start'] = index[report['val_start']]
+        report['val_end'] = index[report['val_end']]
+    print(f"Cross-validation MSE scores: {report['mse'].round(4).tolist()}")
+    print(f"Average MSE: {report['mse'].mean():.4f} (scaled: {report['mse_scaled'].mean():.6f}), "
+          f"fit time {report['fit_seconds'].sum():.1f}s")
+    return report
+
+# ストリーミング学習（分足・ティック由来など、メモリに載らない長さの履歴用）
+# CSVをチャンクごとに読み、スケーラーはpartial_fitで、モデルはStreamingSequenceDatasetから訓練する
+def fit_streaming_scalers(file_path, chunk_rows=100_000):
+    from sklearn.preprocessing import MinMaxScaler
 
-    # データの正規化
     scaler_X = MinMaxScaler()
     scaler_y = MinMaxScaler()
-    X_scaled = scaler_X.fit_transform(X)
-    y_scaled = scaler_y.fit_transform(y)
-
-    # データの分割
-    X_train, X_test, y_train, y_test = train_test_split(X_scaled, y_scaled, test_size=0.2, shuffle=False)
-
-    # PyTorchテンソルへの変換
-    X_train_tensor = torch.FloatTensor(X_train).unsqueeze(1)
-    y_train_tensor = torch.FloatTensor(y_train)
-    X_test_tensor = torch.FloatTensor(X_test).unsqueeze(1)
-    y_test_tensor = torch.FloatTensor(y_test)
-
-    # ハイパーパラメータチューニング
-    best_params = tune_hyperparameters(X_train_tensor, y_train_tensor)
+    n_rows = 0
+    for features in iter_feature_chunks(file_path, chunk_rows):
+        scaler_X.partial_fit(features[FEATURE_COLUMNS].to_numpy(dtype='float64'))
+        scaler_y.partial_fit(features[['Close']].to_numpy(dtype='float64'))
+        n_rows += len(features)
+    return scaler_X, scaler_y, n_rows
+
+# 末尾val_fractionの行を検証用とし、訓練・検証ともエポックごとにCSVを読み直す
+def train_streaming(model, file_path, chunk_rows=100_000, lookback=1, horizon=1, epochs=10, lr=0.001, batch_size=256,
+                    val_fraction=0.2, patience=None, shuffle=True, verbose=True):
+    with INSTRUMENTATION.stage('scaling', source=file_path, chunk_rows=chunk_rows) as record:
+        scaler_X, scaler_y, n_rows = fit_streaming_scalers(file_path, chunk_rows)
+        record['rows'] = n_rows
+    split = int(n_rows * (1 - val_fraction))
+    options = {'lookback': lookback, 'horizon': horizon, 'chunk_rows': chunk_rows}
+    train_data = StreamingSequenceDataset(file_path, scaler_X, scaler_y, stop=split, shuffle=shuffle, **options)
+    val_data = StreamingSequenceDataset(file_path, scaler_X, scaler_y, start=split, **options) if split < n_rows else None
+    history = train_model(model, train_data, None, epochs=epochs, lr=lr, batch_size=batch_size, X_val=val_data,
+                          patience=patience, verbose=verbose)
+    return scaler_X, scaler_y, history
+
+# オンライン更新
+# レジストリからモデル・オプティマイザの状態・スケーラーの範囲・特徴量エンジンの状態・直近の特徴量行を読み込み、
+# 前回の最終日より新しい行だけを特徴量エンジンで計算して、上限ステップ数だけ追加訓練する（スケーラーは再学習しない）
+# 新しい行がスケーラーの範囲から大きく外れる場合や、新しい行での誤差が保存時の基準より大きく悪化した場合（ドリフト）だけ、
+# 履歴全体から再訓練する
+ONLINE_CONTEXT_ROWS = 256
+
+# contextは直近の特徴量行（feature_columnsと終値の列）。追加訓練で過去の窓として再利用する
+def save_online_state(version_dir, optimizer, engine, context, last_date, reference_mse, lr, parent=None, updates=0):
+    np.save(os.path.join(version_dir, 'context.npy'), np.asarray(context, dtype='float64')[-ONLINE_CONTEXT_ROWS:])
+    torch.save(optimizer.state_dict(), os.path.join(version_dir, 'optimizer.pt'))
+    state = {'engine': engine.state_dict(), 'last_date': str(last_date), 'reference_mse': reference_mse, 'lr': lr,
+             'parent': parent, 'updates': updates}
+    with open(os.path.join(version_dir, 'online.json'), 'w') as f:
+        json.dump(state, f, indent=2)
+
+def load_online_state(version_dir):
+    online_path = os.path.join(version_dir, 'online.json')
+    if not os.path.exists(online_path):
+        raise FileNotFoundError(f'{version_dir} has no online state; retrain it with the train command first')
+    with open(online_path) as f:
+        state = json.load(f)
+    return state, np.load(os.path.join(version_dir, 'context.npy'))
+
+# ドリフトの判定：新しい行のうち正規化後に[-range_margin, 1 + range_margin]を外れる値の割合と、
+# 新しい行を目標に含む窓での誤差（元の単位のMSE）を保存時の基準MSEと比べる
+def detect_drift(model, X_new, y_new, X_rows, y_rows, scaler_y, reference_mse, drift_factor=3.0, range_margin=0.1,
+                 max_out_of_range=0.05):
+    values = np.concatenate([X_rows.ravel(), y_rows.ravel()])
+    out_of_range = float(((values < -range_margin) | (values > 1 + range_margin)).mean()) if len(values) else 0.0
+    mse = None
+    if len(X_new):
+        model.eval()
+        with torch.inference_mode():
+            predictions = inverse_transform_horizons(scaler_y, model(X_new).numpy())
+        mse = float(np.mean((predictions - inverse_transform_horizons(scaler_y, y_new.numpy())) ** 2))
+    reasons = []
+    if out_of_range > max_out_of_range:
+        reasons.append(f'{out_of_range:.1%} of new values outside the scaler range')
+    if mse is not None and reference_mse and mse > drift_factor * reference_mse:
+        reasons.append(f'MSE {mse:.4f} > {drift_factor:g} x reference {reference_mse:.4f}')
+    return {'drift': bool(reasons), 'reasons': reasons, 'mse': mse, 'reference_mse': reference_mse, 'out_of_range': out_of_range}
+
+# 上限max_stepsステップの追加訓練。新しい窓（recent_start以降）と過去の窓が、それぞれ抽出確率の半分を占める
+def fine_tune(model, optimizer, X_seq, y_seq, max_steps=50, batch_size=64, recent_start=0, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    weights = torch.ones(len(X_seq), dtype=torch.float64)
+    n_recent = len(X_seq) - recent_start
+    if 0 < n_recent < len(X_seq):
+        weights[recent_start:] = recent_start / n_recent
+    criterion = nn.MSELoss()
+    losses = []
+    model.train()
+    with INSTRUMENTATION.stage('fine_tune', model=type(model).__name__, steps=max_steps, windows=len(X_seq)):
+        for _ in range(max_steps):
+            rows = torch.multinomial(weights, min(batch_size, len(X_seq)), replacement=True, generator=generator)
+            optimizer.zero_grad()
+            loss = criterion(model(X_seq[rows]), y_seq[rows])
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+    model.eval()
+    return losses
+
+# ドリフト時の再訓練：保存時と同じクラス・設定のモデルを履歴全体から訓練し直し、新しい版として登録する
+def retrain_model(raw, name, manifest, lr, epochs=100, batch_size=None, registry_dir=MODEL_REGISTRY_DIR):
+    engine = FeatureEngine()
+    df = engine.fit_transform(raw)
+    feature_columns = manifest['feature_columns']
+    lookback, horizon = manifest['lookback'], manifest['init_kwargs']['output_dim']
+    store = FeatureStore.from_frame(df, feature_columns)
+    data_hash = array_fingerprint(store.values)
+    scaler_X, scaler_y = store.scale_()
+    X_seq, y_seq = store.sequences(lookback=lookback, horizon=horizon, multi_output=True)
+    split = int(len(X_seq) * 0.8)
+    model = globals()[manifest['model_class']](**manifest['init_kwargs'])
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    train_model(model, X_seq[:split], y_seq[:split], epochs=epochs, lr=lr, batch_size=batch_size, optimizer=optimizer, verbose=False)
+    metrics = evaluate_model(model, X_seq[split:], y_seq[split:], scaler_y, plot=False)
+    version_dir = save_model(model, name, manifest['init_kwargs'], scaler_X, scaler_y, feature_columns, data_hash,
+                             example_input=X_seq[:1].contiguous(), lookback=lookback, registry_dir=registry_dir, benchmark=False)
+    save_online_state(version_dir, optimizer, engine, df[feature_columns + ['Close']].to_numpy(dtype='float64'), df.index[-1],
+                      metrics['mse'], lr, parent=manifest['data_hash'])
+    return version_dir
+
+def online_update(name, data_path, version=None, registry_dir=MODEL_REGISTRY_DIR, max_steps=50, batch_size=64, drift_factor=3.0,
+                  range_margin=0.1, max_out_of_range=0.05, retrain=True, retrain_epochs=100, cache_dir=CACHE_DIR, seed=0):
+    model, scaler_X, scaler_y, manifest = load_model(name, version, registry_dir=registry_dir)
+    state, context = load_online_state(resolve_version_dir(name, version, registry_dir))
+    feature_columns = manifest['feature_columns']
+    lookback, horizon = manifest['lookback'], manifest['init_kwargs']['output_dim']
+
+    with INSTRUMENTATION.stage('online_update', model=manifest['model_class']) as record:
+        raw = load_and_preprocess_data(data_path, cache_dir=cache_dir)
+        new_rows = raw[raw.index > pd.Timestamp(state['last_date'])]
+        record['new_rows'] = len(new_rows)
+        if new_rows.empty:
+            print(f"No rows after {state['last_date']}; {name} is up to date")
+            return {'status': 'unchanged'}
+
+        engine = FeatureEngine()
+        engine.load_state_dict(state['engine'])
+        features = engine.transform_chunk(new_rows)
+        values = np.concatenate([context, features[feature_columns + ['Close']].to_numpy(dtype='float64')])
+        X = scaler_X.transform(values[:, :-1]).astype('float32')
+        y = scaler_y.transform(values[:, -1:]).astype('float32')
+        X_seq, y_seq = make_sequences(X, y, lookback, horizon, multi_output=True)
+        # 窓iの目標値は行i + lookback - 1からhorizon本。最後の目標値が新しい行に入る窓を「新しい窓」とする
+        recent_start = min(len(X_seq), max(0, len(context) - lookback - horizon + 2))
+
+        drift = detect_drift(model, X_seq[recent_start:], y_seq[recent_start:], X[len(context):], y[len(context):], scaler_y,
+                             state['reference_mse'], drift_factor, range_margin, max_out_of_range)
+        record.update(drift=drift['drift'], mse=drift['mse'], out_of_range=drift['out_of_range'])
+        if drift['drift']:
+            print('Drift detected: ' + '; '.join(drift['reasons']))
+            if not retrain:
+                return {'status': 'drift', **drift}
+            print('Retraining from the full history')
+            version_dir = retrain_model(raw, name, manifest, state['lr'], epochs=retrain_epochs, registry_dir=registry_dir)
+            return {'status': 'retrained', 'version_dir': version_dir, **drift}
+
+        optimizer = optim.Adam(model.parameters(), lr=state['lr'])
+        optimizer.load_state_dict(torch.load(os.path.join(resolve_version_dir(name, version, registry_dir), 'optimizer.pt')))
+        losses = []
+        if len(X_seq) > recent_start:
+            losses = fine_tune(model, optimizer, X_seq, y_seq, max_steps=max_steps, batch_size=batch_size,
+                               recent_start=recent_start, seed=seed)
+
+        # 更新のたびに推論時間は計測しない（必要ならbenchmark_compiled_modelで計測する）
+        # 訓練するステップがなく重みが変わらなかった場合は、グラフを書き出し直さずに元の版のものを使う
+        data_hash = array_fingerprint(values[len(context):], np.frombuffer(manifest['data_hash'].encode(), dtype='uint8'))
+        version_dir = save_model(model, name, manifest['init_kwargs'], scaler_X, scaler_y, feature_columns, data_hash,
+                                 example_input=X_seq[:1].contiguous() if len(X_seq) else None, lookback=lookback,
+                                 registry_dir=registry_dir, benchmark=False,
+                                 artifacts_from=None if losses else resolve_version_dir(name, version, registry_dir))
+        save_online_state(version_dir, optimizer, engine, values, new_rows.index[-1], state['reference_mse'], state['lr'],
+                          parent=manifest['data_hash'], updates=state['updates'] + 1)
+    mse = f"{drift['mse']:.4f}" if drift['mse'] is not None else 'n/a'
+    print(f'Ingested {len(new_rows)} new rows, fine-tuned {len(losses)} steps (MSE on new windows before update: {mse})')
+    return {'status': 'updated', 'version_dir': version_dir, 'steps': len(losses), **drift}
+
+# パイプラインの工程グラフ
+# 各工程は関数・依存する工程・パラメータで宣言し、出力は内容アドレスのキー（依存する工程のキー・パラメータ・
+# コードの版・外部入力のハッシュから求める）で <cache_dir>/pipeline/<工程名>-<キー>.pt に保存する
+# torch.saveで保存するため、同じストレージを参照するテンソル（系列のビューなど）は1回だけ書き込まれ、読み込み後も共有される
+# 入力ファイルのハッシュから順にキーが決まるため、データ・パラメータが変わった工程とその下流だけを再計算する
+# コードの版はこのスクリプトと推論ランタイムのソース、主要なライブラリのバージョンのハッシュで、
+# 工程から呼んでいる関数（train_model・特徴量の計算など）を変更した場合も全工程のキーが変わる
+# 依存関係のない工程はスレッドプールで同時に実行する。main_thread=Trueの工程（描画を行うEDAなど）は、
+# 他の工程をスレッドで実行している間にメインスレッドで実行する
+# 同時に実行する工程はCPUを等分し、各工程のプロセスプールはその数のワーカーまでに制限する（WORKER_BUDGET）
+# 工程の結果が実行の順序に左右されないように、乱数を使う工程にはパラメータでシードを渡す
+PIPELINE_STAGE_DIR = 'pipeline'
+
+@functools.lru_cache(maxsize=None)
+def pipeline_code_version():
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for filename in (os.path.basename(__file__), 'stock_price_runtime.py'):
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    digest.update(json.dumps([torch.__version__, np.__version__, pd.__version__]).encode())
+    return digest.hexdigest()[:16]
+
+class PipelineStage:
+    def __init__(self, name, func, deps=(), params=None, source=None, cache=True, main_thread=False):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.params = params or {}
+        self.source = source
+        self.cache = cache
+        self.main_thread = main_thread
+
+    # functools.partialで渡した引数（キャッシュの場所など）はキーに含めない
+    def key(self, input_keys):
+        payload = json.dumps({'name': self.name, 'inputs': input_keys, 'params': self.params, 'source': self.source,
+                              'code': pipeline_code_version()}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+class StageGraph:
+    def __init__(self, cache_dir=CACHE_DIR, use_cache=True, n_jobs=None):
+        self.stages = {}
+        self.stage_dir = os.path.join(cache_dir, PIPELINE_STAGE_DIR)
+        self.use_cache = use_cache
+        self.n_jobs = n_jobs
+        self.cpus_per_stage = None
+        self.report = []
+
+    # 依存する工程は先に追加しておく（追加順がそのまま実行可能な順序になる）
+    def add(self, name, func, deps=(), params=None, source=None, cache=True, main_thread=False):
+        if name in self.stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unknown stages: {missing}")
+        self.stages[name] = PipelineStage(name, func, deps, params, source, cache, main_thread)
+        return name
+
+    def keys(self):
+        keys = {}
+        for name, stage in self.stages.items():
+            keys[name] = stage.key([keys[dep] for dep in stage.deps])
+        return keys
+
+    def path(self, name, key):
+        return os.path.join(self.stage_dir, f'{name}-{key}.pt')
+
+    # forceで指定した工程とその下流はキャッシュがあっても再計算する
+    def downstream(self, names):
+        names = set(names)
+        unknown = names - set(self.stages)
+        if unknown:
+            raise ValueError(f"Unknown stages: {sorted(unknown)}")
+        for name, stage in self.stages.items():
+            if names.intersection(stage.deps):
+                names.add(name)
+        return names
+
+    # 各工程を'load'（キャッシュから読み込む）か'run'（実行する）に振り分ける
+    # 目標の工程から依存を逆にたどり、キャッシュから読み込める工程より上流は実行も読み込みもしない
+    def plan(self, targets=None, force=()):
+        keys = self.keys()
+        forced = self.downstream(force)
+        required = set(targets if targets is not None else self.stages)
+        actions = {}
+        for name in reversed(list(self.stages)):
+            if name not in required:
+                continue
+            stage = self.stages[name]
+            if (self.use_cache and stage.cache and name not in forced
+                    and os.path.exists(self.path(name, keys[name]))):
+                actions[name] = 'load'
+            else:
+                actions[name] = 'run'
+                required.update(stage.deps)
+        return {name: actions[name] for name in self.stages if name in actions}, keys
+
+    def execute(self, name, action, key, outputs):
+        stage = self.stages[name]
+        path = self.path(name, key)
+        started = time.perf_counter()
+        if action == 'load':
+            output = torch.load(path, weights_only=False)
+        else:
+            WORKER_BUDGET.cpus = self.cpus_per_stage
+            try:
+                with INSTRUMENTATION.stage(f'pipeline-{name}', key=key):
+                    output = stage.func(*[outputs[dep] for dep in stage.deps], **stage.params)
+            finally:
+                WORKER_BUDGET.cpus = None
+            if self.use_cache and stage.cache:
+                # 途中で止まっても壊れたファイルが残らないように、一時ファイルに書いてから置き換える
+                os.makedirs(self.stage_dir, exist_ok=True)
+                temp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+                torch.save(output, temp_path)
+                os.replace(temp_path, path)
+        seconds = time.perf_counter() - started
+        self.report.append({'stage': name, 'action': action, 'key': key, 'seconds': seconds})
+        INSTRUMENTATION.log('pipeline', stage=name, action=action, key=key, seconds=seconds)
+        print(f'[pipeline] {name}: {"loaded from cache" if action == "load" else "computed"} in {seconds:.2f}s (key {key})')
+        return output
+
+    # targetsを省略すると全工程を実行する。戻り値は工程名から出力への辞書（実行・読み込みした工程のみ）
+    def run(self, targets=None, force=()):
+        actions, keys = self.plan(targets, force)
+        pending = dict(actions)
+        outputs = {}
+        running = {}
+        max_workers = self.n_jobs or max(2, os.cpu_count() or 1)
+        concurrent = max(1, min(max_workers, list(actions.values()).count('run')))
+        self.cpus_per_stage = max(1, (os.cpu_count() or 1) // concurrent)
+
+        def ready(name):
+            return pending[name] == 'load' or all(dep in outputs for dep in self.stages[name].deps)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                main_stage = None
+                for name in [name for name in pending if ready(name)]:
+                    if pending[name] == 'run' and self.stages[name].main_thread:
+                        main_stage = main_stage or name
+                        continue
+                    running[executor.submit(self.execute, name, pending.pop(name), keys[name], outputs)] = name
+                if main_stage is not None:
+                    outputs[main_stage] = self.execute(main_stage, pending.pop(main_stage), keys[main_stage], outputs)
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    outputs[running.pop(future)] = future.result()
+        return outputs
+
+# 全工程の実行（従来のメイン実行部分）
+# 重い工程（特徴量・正規化済みの系列とスケーラー・チューニング・訓練済みの重み・アンサンブル・バックテスト・
+# クロスバリデーション）を工程グラフで実行・キャッシュし、結果の表示と描画は最後にメインスレッドでまとめて行う
+LOOKBACK = 20
+ENSEMBLE_MEMBERS = [{'hidden_dim': 64, 'num_layers': 2}, {'hidden_dim': 128, 'num_layers': 3}, {'hidden_dim': 32, 'num_layers': 1}]
+
+def pipeline_features(data_path, cache_dir=CACHE_DIR, use_cache=True):
+    return engineer_features(load_and_preprocess_data(data_path, cache_dir=cache_dir, use_cache=use_cache))
+
+def pipeline_importance(df, cache_dir=CACHE_DIR, use_cache=True):
+    return analyze_feature_importance(df[FEATURE_COLUMNS], df[['Close']], cache_dir=cache_dir, use_cache=use_cache, plot=False)
+
+# データの正規化（特徴量ストアの配列をインプレースで正規化する）と、時系列順・シャッフルなしの分割
+# 系列は過去lookback日分を1サンプルとする、ストアの配列を参照するビュー
+def pipeline_dataset(df, lookback=LOOKBACK, train_fraction=0.8):
+    with INSTRUMENTATION.stage('scaling', rows=len(df)):
+        store = FeatureStore.from_frame(df)
+        scaler_X, scaler_y = store.scale_()
+    X_seq, y_seq = store.sequences(lookback=lookback)
+    split = int(len(X_seq) * train_fraction)
+    return {'X_train': X_seq[:split], 'y_train': y_seq[:split], 'X_test': X_seq[split:], 'y_test': y_seq[split:],
+            'scaler_X': scaler_X, 'scaler_y': scaler_y}
+
+def pipeline_tuning(dataset, seed=42):
+    return tune_hyperparameters(dataset['X_train'], dataset['y_train'], random_state=seed)
+
+def pipeline_training(dataset, best_params, epochs=100, seed=0):
+    X_train, y_train = dataset['X_train'], dataset['y_train']
+    model = seeded_init(lambda: LSTMModel(input_dim=X_train.shape[2], hidden_dim=best_params['hidden_dim'], output_dim=1,
+                                          num_layers=best_params['num_layers']), seed)
+    train_model(model, X_train, y_train, epochs=epochs, lr=best_params['lr'])
+    return model
+
+# 形の異なるメンバーをプロセスプールで同時に訓練する
+def pipeline_ensemble(dataset, members=ENSEMBLE_MEMBERS, epochs=100, seed=0):
+    return train_ensemble(dataset['X_train'], dataset['y_train'], members, epochs=epochs, batch_size=None, seed=seed)
+
+def pipeline_backtest(df, lookback=LOOKBACK, seed=0):
+    return perform_backtesting(df, lookback=lookback, plot=False, seed=seed)
+
+def pipeline_cross_validation(df, lookback=LOOKBACK, hidden_dim=64, num_layers=2, seed=0):
+    cv_model = functools.partial(LSTMModel, input_dim=len(FEATURE_COLUMNS), hidden_dim=hidden_dim, output_dim=1, num_layers=num_layers)
+    return perform_cross_validation(df[FEATURE_COLUMNS], df[['Close']], cv_model, lookback=lookback, seed=seed)
+
+def build_pipeline_graph(data_path, cache_dir=CACHE_DIR, use_cache=True, n_jobs=None):
+    graph = StageGraph(cache_dir, use_cache=use_cache, n_jobs=n_jobs)
+    # 入力ファイルは内容のハッシュだけで識別する（file_fingerprintの更新時刻の部分は使わない）
+    graph.add('features', functools.partial(pipeline_features, data_path, cache_dir=cache_dir, use_cache=use_cache),
+              source=file_fingerprint(data_path, cache_dir=cache_dir if use_cache else None).split('-')[0])
+    # 探索的データ分析 (EDA)（大きなデータでは間引き、図はバックグラウンドのプロセスで描画する）
+    if PLOT_SETTINGS['enabled']:
+        graph.add('eda', functools.partial(perform_eda, cache_dir=cache_dir), deps=['features'], cache=False, main_thread=True)
+    graph.add('importance', functools.partial(pipeline_importance, cache_dir=cache_dir, use_cache=use_cache), deps=['features'])
+    graph.add('dataset', pipeline_dataset, deps=['features'], params={'lookback': LOOKBACK, 'train_fraction': 0.8})
+    graph.add('tuning', pipeline_tuning, deps=['dataset'], params={'seed': 42})
+    graph.add('training', pipeline_training, deps=['dataset', 'tuning'], params={'epochs': 100, 'seed': 0})
+    graph.add('ensemble', pipeline_ensemble, deps=['dataset'], params={'members': ENSEMBLE_MEMBERS, 'epochs': 100, 'seed': 0})
+    graph.add('backtest', pipeline_backtest, deps=['features'], params={'lookback': LOOKBACK, 'seed': 0})
+    graph.add('cross_validation', pipeline_cross_validation, deps=['features'],
+              params={'lookback': LOOKBACK, 'hidden_dim': 64, 'num_layers': 2, 'seed': 0})
+    return graph
+
+def run_pipeline(data_path='stock_price.csv', cache_dir=CACHE_DIR, use_cache=True, force=(), n_jobs=None):
+    from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
+
+    graph = build_pipeline_graph(data_path, cache_dir=cache_dir, use_cache=use_cache, n_jobs=n_jobs)
+    outputs = graph.run(force=force)
+    dataset = outputs['dataset']
+    X_train_tensor, y_train_tensor = dataset['X_train'], dataset['y_train']
+    X_test_tensor, y_test_tensor = dataset['X_test'], dataset['y_test']
+    scaler_X, scaler_y = dataset['scaler_X'], dataset['scaler_y']
+    y_test = y_test_tensor.numpy()
 
-    # 最適なモデルの訓練
-    best_model = LSTMModel(input_dim=X_train_tensor.shape[2], hidden_dim=best_params['hidden_dim'], output_dim=1, num_layers=best_params['num_layers'])
-    train_model(best_model, X_train_tensor, y_train_tensor, epochs=100, lr=best_params['lr'])
+    # 特徴量重要度の分析
+    print("特徴量の重要度:")
+    print(outputs['importance'].to_string(index=False, float_format='%.6f'))
+    if PLOT_SETTINGS['enabled']:
+        plot_feature_importance(outputs['importance'])
 
     # モデルの評価
+    best_model = outputs['training']
     evaluate_model(best_model, X_test_tensor, y_test_tensor, scaler_y)
 
-    # アンサンブルモデルの作成と評価
-    models = [
-        LSTMModel(input_dim=X_train_tensor.shape[2], hidden_dim=64, output_dim=1, num_layers=2),
-        LSTMModel(input_dim=X_train_tensor.shape[2], hidden_dim=128, output_dim=1, num_layers=3),
-        LSTMModel(input_dim=X_train_tensor.shape[2], hidden_dim=32, output_dim=1, num_layers=1)
-    ]
+    # 訓練済みLSTMの並べ替え重要度（テスト期間で計算し、再学習はしない）
+    lstm_importance = permutation_importance(best_model, X_test_tensor, y_test_tensor, cache_dir=cache_dir, use_cache=use_cache)
+    print("LSTMの並べ替え重要度:")
+    print(lstm_importance.to_string(index=False, float_format='%.6f'))
 
-    for model in models:
-        train_model(model, X_train_tensor, y_train_tensor, epochs=100)
+    # 古典的ベースラインとの比較
+    print("ベースラインの評価結果:")
+    evaluate_baselines(X_train_tensor, y_train_tensor, X_test_tensor, y_test_tensor, scaler_X, scaler_y)
 
-    ensemble_model = EnsembleModel(models)
-    ensemble_predictions = ensemble_model.predict(X_test_tensor)
+    # アンサンブルモデルの評価
+    ensemble_predictions = outputs['ensemble'].predict(X_test_tensor)
     ensemble_predictions = scaler_y.inverse_transform(ensemble_predictions)
     y_test_inv = scaler_y.inverse_transform(y_test)
 
@@ -590,46 +3078,703 @@ if __name__ == "__main__":
     r2 = r2_score(y_test_inv, ensemble_predictions)
     print(f'MSE: {mse:.4f}, MAE: {mae:.4f}, R^2: {r2:.4f}')
 
-    plt.figure(figsize=(12, 6))
-    plt.plot(y_test_inv, label='実際')
-    plt.plot(ensemble_predictions, label='アンサンブル予測')
-    plt.title('実際の株価 vs アンサンブル予測株価')
-    plt.xlabel('時間')
-    plt.ylabel('株価')
-    plt.legend()
-    plt.show()
-
-    # バックテストの実行
-    perform_backtesting(df)
-
+    if PLOT_SETTINGS['enabled']:
+        plt = load_pyplot()
+        plt.figure(figsize=(12, 6))
+        plt.plot(y_test_inv, label='実際')
+        plt.plot(ensemble_predictions, label='アンサンブル予測')
+        plt.title('実際の株価 vs アンサンブル予測株価')
+        plt.xlabel('時間')
+        plt.ylabel('株価')
+        plt.legend()
+        show_figure(plt, 'ensemble')
+
+    # バックテストの結果
+    backtest = outputs['backtest']
+    print(f"バックテスト: {len(backtest)} windows, mean MSE {backtest['mse'].mean():.4f}")
+    if PLOT_SETTINGS['enabled']:
+        plot_backtest(backtest)
+
+    # クロスバリデーションの結果
+    cv_report = outputs['cross_validation']
+    print(f"クロスバリデーション: MSE scores {cv_report['mse'].round(4).tolist()}, average {cv_report['mse'].mean():.4f}")
+
+    # バックグラウンドで描画しているEDAの図の完了を待つ
+    wait_for_renders()
     print("株価予測モデルの構築と評価が完了しました。")
 
-# クロスバリデーション関数
-def perform_cross_validation(X, y, model, n_splits=5):
-    tscv = TimeSeriesSplit(n_splits=n_splits)
-    cv_scores = []
-
-    for train_index, val_index in tscv.split(X):
-        X_train, X_val = X[train_index], X[val_index]
-        y_train, y_val = y[train_index], y[val_index]
-
-        X_train_tensor = torch.FloatTensor(X_train).unsqueeze(1)
-        y_train_tensor = torch.FloatTensor(y_train)
-        X_val_tensor = torch.FloatTensor(X_val).unsqueeze(1)
-        y_val_tensor = torch.FloatTensor(y_val)
+# ベンチマーク
+# 合成OHLCVデータ（stock_price.csvと同じ列・単位）を行数・銘柄数を変えて作成し、主要な処理の時間とメモリを計測する
+# 各ケースは新しいプロセスで実行するため、ピークRSSは他のケースの影響を受けない
+BENCHMARK_SCALES = {
+    'small': {'rows': 9_000, 'tickers': 10},
+    'medium': {'rows': 100_000, 'tickers': 100},
+    'large': {'rows': 1_000_000, 'tickers': 1_000},
+    'xlarge': {'rows': 5_000_000, 'tickers': 5_000},
+}
+# 全データを一度に処理する関数（一括の推論・全バッチ訓練・ウィンドウごとの再訓練）は、この行数までに制限して計測する
+BENCHMARK_ROW_LIMITS = {'evaluate': 200_000, 'backtest': 5_000, 'tune': 20_000, 'infer_transformer': 200_000,
+                        'infer_fast_transformer': 200_000}
+BENCHMARK_PARAM_GRID = {'hidden_dim': [32, 64], 'num_layers': [1, 2], 'lr': [0.001]}
+
+# 価格の対数を[-2, 2]で折り返すランダムウォークにすることで、数百万行でも値が発散しない
+def synthetic_ohlcv_arrays(shape, rng):
+    walk = np.cumsum(rng.normal(0.0, 0.02, shape), axis=-1)
+    close = np.round(100.0 * np.exp(np.abs((walk + 2.0) % 8.0 - 4.0) - 2.0), 2)
+    previous = np.concatenate([close[..., :1], close[..., :-1]], axis=-1)
+    open_ = np.round(previous * np.exp(rng.normal(0.0, 0.005, shape)), 2)
+    high = np.round(np.maximum(open_, close) * (1.0 + np.abs(rng.normal(0.0, 0.01, shape))), 2)
+    low = np.round(np.minimum(open_, close) * (1.0 - np.abs(rng.normal(0.0, 0.01, shape))), 2)
+    volume = np.round(rng.lognormal(np.log(100.0), 0.5, shape), 2) * 1e6
+    change_rate = np.round(close / previous - 1.0, 4)
+    return {'Close': close, 'Open': open_, 'High': high, 'Low': low, 'Volume': volume, 'Change_Rate': change_rate}
+
+# 日足では2262年を超えるため、6万行を超える場合は1分足の日時にする
+def synthetic_dates(n_rows, start='1990-01-01'):
+    if n_rows <= 60_000:
+        return pd.bdate_range(start, periods=n_rows, name='Date')
+    return pd.date_range(start, periods=n_rows, freq='min', name='Date')
+
+def make_synthetic_ohlcv(n_rows, seed=0):
+    columns = synthetic_ohlcv_arrays(n_rows, np.random.default_rng(seed))
+    return pd.DataFrame(columns, index=synthetic_dates(n_rows))
+
+# load_panelと同じ (Ticker, Date) のMultiIndexを持つパネルを作成する（合計n_rows行）
+def make_synthetic_panel(n_rows, n_tickers, seed=0):
+    per_ticker = max(1, n_rows // n_tickers)
+    columns = synthetic_ohlcv_arrays((n_tickers, per_ticker), np.random.default_rng(seed))
+    tickers = [f'T{i:05d}' for i in range(n_tickers)]
+    index = pd.MultiIndex.from_product([tickers, synthetic_dates(per_ticker)], names=['Ticker', 'Date'])
+    return pd.DataFrame({col: values.ravel() for col, values in columns.items()}, index=index)
+
+# stock_price.csvと同じ形式（日本語の列名・新しい日付が先頭・出来高はM単位・変化率は%）で書き出す
+def write_synthetic_csv(df, path):
+    out = pd.DataFrame({
+        '日付け': df.index.strftime('%Y-%m-%d %H:%M' if len(df) > 60_000 else '%Y-%m-%d'),
+        '終値': df['Close'], '始値': df['Open'], '高値': df['High'], '安値': df['Low'],
+        '出来高': np.char.add(np.char.mod('%.2f', df['Volume'].to_numpy() / 1e6), 'M'),
+        '変化率 %': np.char.add(np.char.mod('%.2f', df['Change_Rate'].to_numpy() * 100.0), '%'),
+    })
+    out.iloc[::-1].to_csv(path, index=False)
+    return path
+
+# 特徴量を計算し、系列データ（lookback行のウィンドウ）に変換する
+def synthetic_sequences(n_rows, options):
+    store = FeatureStore.from_frame(engineer_features(make_synthetic_ohlcv(n_rows + 26, options['seed'])))
+    _, scaler_y = store.scale_()
+    X_seq, y_seq = store.sequences(lookback=options['lookback'])
+    return X_seq, y_seq, scaler_y
+
+# 各ケースの準備（計測しない）。計測する関数と、処理量（行数・サンプル数）を返す
+def setup_ingest(n_rows, n_tickers, options, workdir):
+    path = write_synthetic_csv(make_synthetic_ohlcv(n_rows, options['seed']), os.path.join(workdir, 'synthetic.csv'))
+    return lambda: load_and_preprocess_data(path, use_cache=False), n_rows
+
+def setup_ingest_cached(n_rows, n_tickers, options, workdir):
+    path = write_synthetic_csv(make_synthetic_ohlcv(n_rows, options['seed']), os.path.join(workdir, 'synthetic.csv'))
+    cache_dir = os.path.join(workdir, 'cache')
+    load_and_preprocess_data(path, cache_dir=cache_dir)
+    return lambda: load_and_preprocess_data(path, cache_dir=cache_dir), n_rows
+
+def setup_features(n_rows, n_tickers, options, workdir):
+    df = make_synthetic_ohlcv(n_rows, options['seed'])
+    return lambda: engineer_features(df), n_rows
+
+def setup_panel_features(n_rows, n_tickers, options, workdir):
+    panel = make_synthetic_panel(n_rows, n_tickers, options['seed'])
+    return lambda: engineer_panel_features(panel), len(panel)
+
+def setup_training(model_class, n_rows, options):
+    X_seq, y_seq, _ = synthetic_sequences(n_rows, options)
+    if model_class is ARModel:
+        # ARModelは系列ではなく1時点の特徴量を入力とする
+        X_seq = X_seq[:, -1, :]
+        factory = lambda: ARModel(input_dim=X_seq.shape[-1], hidden_dim=64, output_dim=1)
+    elif model_class in (TransformerModel, FastTransformerModel):
+        factory = lambda: model_class(input_dim=X_seq.shape[-1], hidden_dim=64, output_dim=1, num_layers=2, nhead=4)
+    else:
+        factory = lambda: LSTMModel(input_dim=X_seq.shape[-1], hidden_dim=64, output_dim=1, num_layers=2)
+    train = lambda: train_model(factory(), X_seq, y_seq, epochs=options['epochs'], batch_size=options['batch_size'], verbose=False)
+    return train, len(X_seq) * options['epochs']
+
+# 推論のスループット（batch_sizeごとに推論モードで順伝播する）。TransformerModelとFastTransformerModelの比較用
+def setup_inference(model_class, n_rows, options):
+    X_seq, _, _ = synthetic_sequences(n_rows, options)
+    model = model_class(input_dim=X_seq.shape[-1], hidden_dim=64, output_dim=1, num_layers=2, nhead=4).eval()
+
+    def run():
+        with torch.inference_mode():
+            for batch in torch.split(X_seq, options['batch_size']):
+                model(batch)
+    return run, len(X_seq)
+
+# ストリーミング学習：CSVのチャンク読み込みから訓練までを計測する（ピークRSSはchunk_rowsで決まる）
+def setup_train_stream(n_rows, n_tickers, options, workdir):
+    path = write_synthetic_csv(make_synthetic_ohlcv(n_rows, options['seed']), os.path.join(workdir, 'synthetic.csv'))
+    factory = lambda: LSTMModel(input_dim=len(FEATURE_COLUMNS), hidden_dim=64, output_dim=1, num_layers=2)
+    train = lambda: train_streaming(factory(), path, chunk_rows=options['chunk_rows'], lookback=options['lookback'],
+                                    epochs=options['epochs'], batch_size=options['batch_size'], verbose=False)
+    return train, n_rows * options['epochs']
+
+def setup_evaluate(n_rows, n_tickers, options, workdir):
+    X_seq, y_seq, scaler_y = synthetic_sequences(n_rows, options)
+    model = LSTMModel(input_dim=X_seq.shape[2], hidden_dim=64, output_dim=1, num_layers=2)
+    return lambda: evaluate_model(model, X_seq, y_seq, scaler_y), len(X_seq)
+
+def setup_baselines(n_rows, n_tickers, options, workdir):
+    store = FeatureStore.from_frame(engineer_features(make_synthetic_ohlcv(n_rows + 26, options['seed'])))
+    scaler_X, scaler_y = store.scale_()
+    X_seq, y_seq = store.sequences(lookback=options['lookback'])
+    split = int(len(X_seq) * 0.8)
+    return lambda: evaluate_baselines(X_seq[:split], y_seq[:split], X_seq[split:], y_seq[split:], scaler_X, scaler_y), len(X_seq)
+
+def setup_backtest(n_rows, n_tickers, options, workdir):
+    df = engineer_features(make_synthetic_ohlcv(n_rows + 26, options['seed']))
+    run = lambda: perform_backtesting(df, epochs=options['epochs'], mode=options['backtest_mode'], n_jobs=options['n_jobs'], plot=False)
+    return run, len(range(0, len(df) - 252, 20))
+
+def setup_tune(n_rows, n_tickers, options, workdir):
+    X_seq, y_seq, _ = synthetic_sequences(n_rows, options)
+    run = lambda: tune_hyperparameters(X_seq, y_seq, param_grid=BENCHMARK_PARAM_GRID, max_epochs=options['epochs'] * 3,
+                                       min_epochs=options['epochs'], n_jobs=options['n_jobs'])
+    return run, len(X_seq)
+
+BENCHMARK_CASES = {
+    'ingest': setup_ingest,
+    'ingest_cached': setup_ingest_cached,
+    'features': setup_features,
+    'panel_features': setup_panel_features,
+    'train_lstm': lambda n_rows, n_tickers, options, workdir: setup_training(LSTMModel, n_rows, options),
+    'train_transformer': lambda n_rows, n_tickers, options, workdir: setup_training(TransformerModel, n_rows, options),
+    'train_fast_transformer': lambda n_rows, n_tickers, options, workdir: setup_training(FastTransformerModel, n_rows, options),
+    'infer_transformer': lambda n_rows, n_tickers, options, workdir: setup_inference(TransformerModel, n_rows, options),
+    'infer_fast_transformer': lambda n_rows, n_tickers, options, workdir: setup_inference(FastTransformerModel, n_rows, options),
+    'train_ar': lambda n_rows, n_tickers, options, workdir: setup_training(ARModel, n_rows, options),
+    'train_stream': setup_train_stream,
+    'evaluate': setup_evaluate,
+    'baselines': setup_baselines,
+    'backtest': setup_backtest,
+    'tune': setup_tune,
+}
+
+# 1ケースの計測（新しいプロセスで実行する）
+def run_benchmark_case(case, scale, n_rows, n_tickers, options):
+    torch.set_num_threads(options['threads'])
+    PLOT_SETTINGS['enabled'] = False
+    n_rows = min(n_rows, BENCHMARK_ROW_LIMITS.get(case, n_rows))
+    with tempfile.TemporaryDirectory() as workdir:
+        torch.manual_seed(options['seed'])
+        func, work = BENCHMARK_CASES[case](n_rows, n_tickers, options, workdir)
+        # 準備で使ったメモリが計測に含まれないように、可能ならピークをリセットしてから計測する
+        reset_peak_rss()
+        setup_rss = peak_rss_mb()
+        timings = []
+        for _ in range(options['repeat']):
+            torch.manual_seed(options['seed'])
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                func()
+            timings.append(time.perf_counter() - started)
+    peak_rss = peak_rss_mb()
+    median = float(np.median(timings))
+    return {'case': case, 'scale': scale, 'rows': n_rows, 'tickers': n_tickers if case == 'panel_features' else 1,
+            'work': work, 'repeat': len(timings), 'median_seconds': median, 'min_seconds': min(timings),
+            'work_per_sec': work / median if median > 0 else None, 'setup_peak_rss_mb': setup_rss, 'peak_rss_mb': peak_rss,
+            'case_rss_mb': None if peak_rss is None else peak_rss - setup_rss}
+
+# 結果を比較できるように、コミット・ライブラリのバージョン・スレッド数を記録する
+def benchmark_environment(options):
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = 'unknown', None
+    return {'commit': commit, 'dirty': dirty, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'torch': torch.__version__, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), **options}
+
+def run_benchmarks(scales=('small',), cases=None, output_dir='benchmarks', compare=None, rows=None, tickers=None,
+                   repeat=3, epochs=2, batch_size=256, lookback=20, threads=1, n_jobs=1, backtest_mode='cold', chunk_rows=100_000,
+                   seed=0):
+    cases = list(cases or BENCHMARK_CASES)
+    unknown = sorted(set(cases) - set(BENCHMARK_CASES))
+    if unknown:
+        raise ValueError(f"Unknown benchmark cases: {', '.join(unknown)}")
+    options = {'repeat': repeat, 'epochs': epochs, 'batch_size': batch_size, 'lookback': lookback, 'threads': threads,
+               'n_jobs': n_jobs, 'backtest_mode': backtest_mode, 'chunk_rows': chunk_rows, 'seed': seed}
+    # rows・tickersを指定した場合は、プリセットの代わりにその規模で計測する
+    if rows is not None or tickers is not None:
+        sizes = {'custom': {'rows': rows or BENCHMARK_SCALES['small']['rows'], 'tickers': tickers or BENCHMARK_SCALES['small']['tickers']}}
+    else:
+        sizes = {scale: BENCHMARK_SCALES[scale] for scale in scales}
+    environment = benchmark_environment(options)
 
-        train_model(model, X_train_tensor, y_train_tensor, epochs=50)
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for scale, size in sizes.items():
+        for case in cases:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_benchmark_case, case, scale, size['rows'], size['tickers'], options).result()
+            print(f"{scale:>7} {case:<18} {result['median_seconds']:9.3f}s  {result['work_per_sec'] or 0:12.0f}/s  "
+                  f"peak RSS {result['peak_rss_mb'] or 0:8.1f} MB (+{result['case_rss_mb'] or 0:.1f} MB)")
+            results.append(result)
+
+    os.makedirs(output_dir, exist_ok=True)
+    base = os.path.join(output_dir, f"{environment['commit']}-{time.strftime('%Y%m%d-%H%M%S')}")
+    with open(base + '.json', 'w') as f:
+        json.dump({'environment': environment, 'results': results}, f, indent=2)
+    # 全実行の結果を1つのCSVに追記していき、コミット間の推移を追えるようにする
+    history_path = os.path.join(output_dir, 'history.csv')
+    history = pd.DataFrame(results).assign(commit=environment['commit'], dirty=environment['dirty'], timestamp=environment['timestamp'])
+    history.to_csv(history_path, mode='a', header=not os.path.exists(history_path), index=False)
+    print(f'Saved benchmark results to {base}.json')
+
+    report = pd.DataFrame(results)
+    if compare:
+        report = compare_benchmarks(report, compare)
+    return report
+
+# 基準となる結果（JSON）と比べ、時間とピークRSSの比を表示する（1より小さければ改善）
+def compare_benchmarks(report, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    columns = ['case', 'scale', 'rows', 'median_seconds', 'peak_rss_mb']
+    merged = report.merge(pd.DataFrame(baseline['results'])[columns], on=['case', 'scale', 'rows'], how='left', suffixes=('', '_baseline'))
+    merged['time_ratio'] = merged['median_seconds'] / merged['median_seconds_baseline']
+    merged['rss_ratio'] = merged['peak_rss_mb'] / merged['peak_rss_mb_baseline']
+    print(f"Compared with {baseline['environment']['commit']} ({baseline_path}):")
+    print(merged[['scale', 'case', 'rows', 'median_seconds_baseline', 'median_seconds', 'time_ratio', 'rss_ratio']].to_string(index=False))
+    return merged
+
+# コマンドライン（サブコマンドごとの処理）
+def load_features(args):
+    return engineer_features(load_and_preprocess_data(args.data, cache_dir=args.cache_dir, use_cache=not args.no_cache))
+
+def command_ingest(args):
+    started = time.perf_counter()
+    if args.panel:
+        df = load_panel(args.panel, cache_dir=args.cache_dir)
+    else:
+        df = load_and_preprocess_data(args.data, cache_dir=args.cache_dir, use_cache=not args.no_cache)
+    print(f'Loaded {len(df)} rows x {df.shape[1]} columns in {time.perf_counter() - started:.3f}s')
+
+def command_features(args):
+    df = load_features(args)
+    print(f'Engineered {len(df)} rows x {df.shape[1]} columns')
+    if args.output:
+        df.to_csv(args.output)
+        print(f'Saved features to {args.output}')
+    if args.store:
+        store = FeatureStore.from_frame(df, path=args.store)
+        print(f'Saved feature store ({store.values.shape[0]} x {store.values.shape[1]} float32) to {args.store}')
+
+def command_train(args):
+    if args.stream:
+        return command_train_streaming(args)
+    # 特徴量エンジンの状態はオンライン更新のためにモデルと一緒に保存する
+    raw = load_and_preprocess_data(args.data, cache_dir=args.cache_dir, use_cache=not args.no_cache)
+    engine = FeatureEngine()
+    with INSTRUMENTATION.stage('features', rows=len(raw)):
+        df = engine.fit_transform(raw)
+    with INSTRUMENTATION.stage('scaling', rows=len(df)):
+        store = FeatureStore.from_frame(df)
+        data_hash = array_fingerprint(store.values)
+        scaler_X, scaler_y = store.scale_()
+        X_seq, y_seq = store.sequences(lookback=args.lookback, horizon=args.horizon, multi_output=True)
+    split = int(len(X_seq) * 0.8)
+
+    params = {'hidden_dim': args.hidden_dim, 'num_layers': args.num_layers, 'lr': args.lr}
+    if args.tune:
+        params = tune_hyperparameters(X_seq[:split], y_seq[:split], n_jobs=args.n_jobs)
+    init_kwargs = {'input_dim': X_seq.shape[2], 'hidden_dim': params['hidden_dim'], 'output_dim': args.horizon, 'num_layers': params['num_layers']}
+    model = LSTMModel(**init_kwargs)
+    optimizer = optim.Adam(model.parameters(), lr=params['lr'])
+    train_model(model, X_seq[:split], y_seq[:split], epochs=args.epochs, lr=params['lr'], batch_size=args.batch_size, optimizer=optimizer)
+    metrics = evaluate_model(model, X_seq[split:], y_seq[split:], scaler_y)
+
+    # 同じ分割で古典的ベースラインと比較し、勝てないモデルは（指定があれば）登録しない
+    baselines = evaluate_baselines(X_seq[:split], y_seq[:split], X_seq[split:], y_seq[split:], scaler_X, scaler_y)
+    best = baselines.loc[baselines['mse'].idxmin()]
+    print(f"LSTM MSE {metrics['mse']:.4f} vs best baseline {best['baseline']} {best['mse']:.4f}")
+    if args.require_baseline_win and metrics['mse'] >= best['mse']:
+        print('The model does not beat the baseline; not saving it to the registry')
+        return
+
+    version_dir = save_model(model, args.name, init_kwargs, scaler_X, scaler_y, FEATURE_COLUMNS, data_hash,
+                             example_input=X_seq[:1].contiguous(), lookback=args.lookback, registry_dir=args.registry_dir)
+    save_online_state(version_dir, optimizer, engine, df[FEATURE_COLUMNS + ['Close']].to_numpy(dtype='float64'), df.index[-1],
+                      metrics['mse'], params['lr'])
+    print(f'Saved model to {version_dir}')
+
+# --stream：CSVをチャンクごとに読みながら訓練する（評価は検証範囲の損失のみ）
+def command_train_streaming(args):
+    init_kwargs = {'input_dim': len(FEATURE_COLUMNS), 'hidden_dim': args.hidden_dim, 'output_dim': args.horizon, 'num_layers': args.num_layers}
+    model = LSTMModel(**init_kwargs)
+    scaler_X, scaler_y, history = train_streaming(model, args.data, chunk_rows=args.chunk_rows, lookback=args.lookback,
+                                                  horizon=args.horizon, epochs=args.epochs, lr=args.lr, batch_size=args.batch_size or 256)
+    if history['val_loss']:
+        print(f'Validation MSE (scaled): {history["val_loss"][-1]:.6f}')
+    data_hash = file_fingerprint(args.data, cache_dir=None if args.no_cache else args.cache_dir).split('-')[0]
+    version_dir = save_model(model, args.name, init_kwargs, scaler_X, scaler_y, FEATURE_COLUMNS, data_hash,
+                             example_input=torch.zeros(1, args.lookback, len(FEATURE_COLUMNS)), lookback=args.lookback,
+                             registry_dir=args.registry_dir)
+    print(f'Saved model to {version_dir}')
+
+def command_backtest(args):
+    df = load_features(args)
+    results_df = perform_backtesting(df, window_size=args.window_size, step=args.step, epochs=args.epochs, mode=args.mode,
+                                     n_jobs=args.n_jobs, lookback=args.lookback, horizon=args.horizon)
+    if args.output:
+        results_df.to_csv(args.output, index=False)
+        print(f'Saved backtest results to {args.output}')
+
+def command_predict(args):
+    model, scaler_X, scaler_y, manifest = load_model(args.name, args.version, registry_dir=args.registry_dir)
+    df = load_features(args)
+    window = df[manifest['feature_columns']].to_numpy(dtype='float64')[-manifest['lookback']:]
+    X = torch.from_numpy(scaler_X.transform(window).astype('float32')).unsqueeze(0)
+    model = prepare_inference_model(model)
+    with INSTRUMENTATION.stage('inference', model=type(model).__name__, samples=1, precision=INFERENCE_SETTINGS['precision']):
+        with inference_context():
+            prediction = inverse_transform_horizons(scaler_y, model(X).float().numpy())
+    print(f'{df.index[-1].date()}: predicted Close {prediction[0, 0]:.4f}')
+    # 多期間出力のモデルは、1回の順伝播で得た先の終値もまとめて表示する
+    for h, value in enumerate(prediction[0, 1:], 1):
+        print(f'  +{h} bars: predicted Close {value:.4f}')
+
+# レジストリのモデルを一度だけ読み込み、マイクロバッチ推論のHTTPサーバーとして公開する
+# 入力は正規化前の特徴量（lookback x 特徴量数、列はmanifestのfeature_columnsの順）、出力は元の単位の終値
+def command_serve(args):
+    model, scaler_X, scaler_y, manifest = load_model(args.name, args.version, registry_dir=args.registry_dir)
+    input_shape = (manifest['lookback'], len(manifest['feature_columns']))
+    server = InferenceServer(EnsembleModel([model]), scaler_y=scaler_y, max_batch_size=args.max_batch_size,
+                             max_latency_ms=args.max_latency_ms, input_shape=input_shape, scaler_X=scaler_X)
+    print(f"Loaded {args.name} ({manifest['model_class']}), inputs of shape {input_shape}: {manifest['feature_columns']}")
+    serve_predictions(server, host=args.host, port=args.port)
+
+# インポートにかかる時間の計測（毎回新しいプロセスで計測する）
+def benchmark_startup(runs=3):
+    module_name = os.path.splitext(os.path.basename(__file__))[0]
+    code = ('import sys, time; started = time.perf_counter(); import {0}; elapsed = time.perf_counter() - started; '
+            'heavy = sorted({{m.split(".")[0] for m in sys.modules}} & {{"matplotlib", "seaborn", "statsmodels", "sklearn"}}); '
+            'print(elapsed, ",".join(heavy))').format(module_name)
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.split()
+        timings.append(float(output[0]))
+    heavy = output[1] if len(output) > 1 else 'none'
+    print(f'Import time: median {np.median(timings):.3f}s, min {min(timings):.3f}s over {runs} runs (plotting/sklearn modules loaded: {heavy})')
+    return timings
+
+def command_startup(args):
+    benchmark_startup(args.runs)
+
+def command_benchmark(args):
+    run_benchmarks(scales=args.scale, cases=args.cases, output_dir=args.output_dir, compare=args.compare, rows=args.rows,
+                   tickers=args.tickers, repeat=args.repeat, epochs=args.epochs, batch_size=args.batch_size, lookback=args.lookback,
+                   threads=args.threads, n_jobs=args.n_jobs, backtest_mode=args.backtest_mode, chunk_rows=args.chunk_rows,
+                   seed=args.seed)
+
+def command_ensemble(args):
+    df = load_features(args)
+    store = FeatureStore.from_frame(df)
+    scaler_X, scaler_y = store.scale_()
+    X_seq, y_seq = store.sequences(lookback=args.lookback, horizon=args.horizon, multi_output=True)
+    # 時系列順に訓練・検証（結合方法の学習用）・テストに分ける
+    train_end, val_end = int(len(X_seq) * 0.6), int(len(X_seq) * 0.8)
+    members = []
+    for shape in args.shapes:
+        hidden_dim, num_layers = (int(value) for value in shape.split('x'))
+        members += [{'hidden_dim': hidden_dim, 'num_layers': num_layers}] * args.copies
+    started = time.perf_counter()
+    ensemble = train_ensemble(X_seq[:train_end], y_seq[:train_end], members, X_seq[train_end:val_end], y_seq[train_end:val_end],
+                              combiner=args.combiner, epochs=args.epochs, lr=args.lr, batch_size=args.batch_size,
+                              bootstrap=args.bootstrap, stacked={'auto': 'auto', 'stacked': True, 'sequential': False}[args.member_training],
+                              n_jobs=args.n_jobs)
+    print(f'Trained {len(ensemble.models)} members in {time.perf_counter() - started:.1f}s')
+    predictions = inverse_transform_horizons(scaler_y, ensemble.predict(X_seq[val_end:]))
+    y_test = inverse_transform_horizons(scaler_y, y_seq[val_end:].numpy())
+    print(horizon_metrics(y_test, predictions).to_string(index=False, float_format='%.4f'))
+
+# 保存済みモデルをint8に動的量子化し、精度ガードを通った場合だけ別の名前（既定は<name>-int8）で登録する
+# ガードには学習時と同じく、系列の末尾20%（テスト期間）を使う
+def command_quantize(args):
+    model, scaler_X, scaler_y, manifest = load_model(args.name, args.version, registry_dir=args.registry_dir)
+    df = load_features(args)
+    feature_columns = manifest['feature_columns']
+    X = torch.from_numpy(scaler_X.transform(df[feature_columns].to_numpy(dtype='float64')).astype('float32'))
+    y = torch.from_numpy(scaler_y.transform(df[['Close']].to_numpy(dtype='float64')).astype('float32'))
+    X_seq, y_seq = make_sequences(X, y, manifest['lookback'], horizon=manifest['init_kwargs']['output_dim'], multi_output=True)
+    split = int(len(X_seq) * 0.8)
+    quantized, report = quantize_with_guard(model, X_seq[split:].contiguous(), y_seq[split:].contiguous(), tolerance=args.tolerance,
+                                            min_speedup=args.min_speedup)
+    if not report['accepted']:
+        print('The quantized model was rejected by the accuracy guard; keeping the float32 model')
+        return
+    version_dir = save_model(quantized, args.output_name or f'{args.name}-int8', manifest['init_kwargs'], scaler_X, scaler_y,
+                             feature_columns, manifest['data_hash'], example_input=X_seq[:1].contiguous(),
+                             lookback=manifest['lookback'], registry_dir=args.registry_dir, quantized=True)
+    print(f'Saved quantized model to {version_dir}')
+
+# 前回の保存以降の新しい行だけで最新のモデルを更新する（ドリフト時は再訓練）
+def command_update(args):
+    online_update(args.name, args.data, version=args.version, registry_dir=args.registry_dir, max_steps=args.max_steps,
+                  batch_size=args.batch_size, drift_factor=args.drift_factor, retrain=not args.no_retrain,
+                  retrain_epochs=args.epochs, cache_dir=args.cache_dir)
+
+# 複数銘柄のモデルを訓練し、銘柄ごとのスケーラーと一緒に<name>-<銘柄>としてレジストリに登録する
+# （sharedでは全銘柄に同じ重みを、銘柄ごとのスケーラーで登録する）
+def command_panel(args):
+    panel = engineer_panel_features(load_panel(args.panel, cache_dir=args.cache_dir))
+    models, scaler_X, scaler_y = train_panel_models(panel, mode=args.mode, lookback=args.lookback, epochs=args.epochs,
+                                                    hidden_dim=args.hidden_dim, num_layers=args.num_layers, lr=args.lr,
+                                                    batch_size=args.batch_size, n_jobs=args.n_jobs)
+    data_hash = array_fingerprint(panel[FEATURE_COLUMNS + ['Close']].to_numpy(dtype='float32'))
+    init_kwargs = {'input_dim': len(FEATURE_COLUMNS), 'hidden_dim': args.hidden_dim, 'output_dim': 1, 'num_layers': args.num_layers}
+    tickers = panel.index.get_level_values('Ticker').unique()
+    for ticker in tickers:
+        model = models['shared'] if args.mode == 'shared' else models[ticker]
+        save_model(model, f'{args.name}-{ticker}', init_kwargs, scaler_X.scaler_for(ticker), scaler_y.scaler_for(ticker),
+                   FEATURE_COLUMNS, data_hash, lookback=args.lookback, registry_dir=args.registry_dir)
+    print(f'Saved {len(tickers)} {args.mode} models to {args.registry_dir}/{args.name}-<ticker>')
+
+def command_eda(args):
+    perform_eda(load_features(args), mode=args.mode, max_points=args.max_points, cache_dir=None if args.no_cache else args.cache_dir,
+                downsample=args.downsample)
+    wait_for_renders()
+
+# --method forestはランダムフォレスト、permutationはレジストリの訓練済みモデルの並べ替え重要度
+def command_importance(args):
+    df = load_features(args)
+    cache_dir = None if args.no_cache else args.cache_dir
+    if args.method == 'forest':
+        importance = analyze_feature_importance(df[FEATURE_COLUMNS], df[['Close']], n_jobs=args.n_jobs, max_samples=args.max_samples,
+                                                cache_dir=cache_dir)
+    else:
+        model, scaler_X, scaler_y, manifest = load_model(args.name, args.version, registry_dir=args.registry_dir)
+        feature_columns = manifest['feature_columns']
+        X = torch.from_numpy(scaler_X.transform(df[feature_columns].to_numpy(dtype='float64')).astype('float32'))
+        y = torch.from_numpy(scaler_y.transform(df[['Close']].to_numpy(dtype='float64')).astype('float32'))
+        X_seq, y_seq = make_sequences(X, y, manifest['lookback'], horizon=manifest['init_kwargs']['output_dim'], multi_output=True)
+        importance = permutation_importance(model, X_seq, y_seq, feature_columns, max_samples=args.max_samples, cache_dir=cache_dir)
+        if PLOT_SETTINGS['enabled']:
+            plot_feature_importance(importance, title='並べ替え重要度', name='permutation_importance')
+    print(importance.to_string(index=False, float_format='%.6f'))
+
+# ニューラルモデルを訓練する前に、ベースラインだけで精度を確認する（数ミリ秒で終わる）
+def command_baselines(args):
+    df = load_features(args)
+    store = FeatureStore.from_frame(df)
+    scaler_X, scaler_y = store.scale_()
+    X_seq, y_seq = store.sequences(lookback=args.lookback, horizon=args.horizon, multi_output=True)
+    split = int(len(X_seq) * 0.8)
+    report = evaluate_baselines(X_seq[:split], y_seq[:split], X_seq[split:], y_seq[split:], scaler_X, scaler_y)
+    if args.output:
+        report.to_csv(args.output, index=False)
+        print(f'Saved baseline results to {args.output}')
+
+def command_run(args):
+    run_pipeline(args.data, cache_dir=args.cache_dir, use_cache=not args.no_cache, force=args.force or (), n_jobs=args.n_jobs)
+
+# サブコマンドの前に指定する全体のオプション
+def build_global_options():
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--headless', action='store_true', help='EDAと描画を行わない')
+    options.add_argument('--plot-dir', help='図を画面に表示せず、このディレクトリにPNGとして保存する')
+    options.add_argument('--profile-dir', help='工程ごとの時間・メモリとエポックごとのスループットをこのディレクトリに記録する')
+    options.add_argument('--profile', choices=['cprofile', 'torch'], help='最上位の工程ごとにcProfileまたはtorch.profilerの結果も保存する')
+    options.add_argument('--precision', choices=['float32', 'bf16', 'int8'], default='float32',
+                         help='CPU推論の精度（評価・アンサンブル・バックテスト・予測）')
+    return options
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='株価予測モデル (Stock price prediction pipeline)', parents=[build_global_options()])
+    subparsers = parser.add_subparsers(dest='command')
+
+    data_options = argparse.ArgumentParser(add_help=False)
+    data_options.add_argument('--data', default='stock_price.csv')
+    data_options.add_argument('--cache-dir', default=CACHE_DIR)
+    data_options.add_argument('--no-cache', action='store_true')
+
+    ingest = subparsers.add_parser('ingest', parents=[data_options], help='CSVを読み込みキャッシュを作成する')
+    ingest.add_argument('--panel', help='銘柄ごとのCSVを含むディレクトリまたはglob')
+    ingest.set_defaults(func=command_ingest)
+
+    features = subparsers.add_parser('features', parents=[data_options], help='特徴量を計算する')
+    features.add_argument('--output', help='特徴量を保存するCSVのパス')
+    features.add_argument('--store', help='特徴量をfloat32のメモリマップ（特徴量ストア）として保存するディレクトリ')
+    features.set_defaults(func=command_features)
+
+    train = subparsers.add_parser('train', parents=[data_options], help='LSTMモデルを訓練してモデルレジストリに保存する')
+    train.add_argument('--name', default='lstm')
+    train.add_argument('--registry-dir', default=MODEL_REGISTRY_DIR)
+    train.add_argument('--epochs', type=int, default=100)
+    train.add_argument('--lr', type=float, default=0.001)
+    train.add_argument('--hidden-dim', type=int, default=64)
+    train.add_argument('--num-layers', type=int, default=2)
+    train.add_argument('--lookback', type=int, default=LOOKBACK)
+    train.add_argument('--batch-size', type=int)
+    train.add_argument('--horizon', type=int, default=1, help='1回の順伝播で予測する終値の本数（多期間出力）')
+    train.add_argument('--tune', action='store_true', help='ハイパーパラメータ探索を行う')
+    train.add_argument('--n-jobs', type=int)
+    train.add_argument('--stream', action='store_true', help='CSVをチャンクごとに読みながら訓練する（履歴全体をメモリに載せない）')
+    train.add_argument('--chunk-rows', type=int, default=100_000)
+    train.add_argument('--require-baseline-win', action='store_true', help='古典的ベースラインよりテストMSEが悪ければ保存しない')
+    train.set_defaults(func=command_train)
+
+    backtest = subparsers.add_parser('backtest', parents=[data_options], help='ウォークフォワード・バックテストを実行する')
+    backtest.add_argument('--mode', choices=['cold', 'warm', 'parallel'], default='cold')
+    backtest.add_argument('--epochs', type=int, default=50)
+    backtest.add_argument('--window-size', type=int, default=252)
+    backtest.add_argument('--step', type=int, default=20)
+    backtest.add_argument('--lookback', type=int, default=1)
+    backtest.add_argument('--horizon', type=int, default=1)
+    backtest.add_argument('--n-jobs', type=int)
+    backtest.add_argument('--output', help='結果を保存するCSVのパス')
+    backtest.set_defaults(func=command_backtest)
+
+    predict = subparsers.add_parser('predict', parents=[data_options], help='保存済みモデルで最新日の終値を予測する')
+    predict.add_argument('--name', default='lstm')
+    predict.add_argument('--version')
+    predict.add_argument('--registry-dir', default=MODEL_REGISTRY_DIR)
+    predict.set_defaults(func=command_predict)
+
+    serve = subparsers.add_parser('serve', help='保存済みモデルを読み込み、HTTPでマイクロバッチ推論を提供する')
+    serve.add_argument('--name', default='lstm')
+    serve.add_argument('--version')
+    serve.add_argument('--registry-dir', default=MODEL_REGISTRY_DIR)
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--max-batch-size', type=int, default=64)
+    serve.add_argument('--max-latency-ms', type=float, default=5.0, help='最初のリクエストからバッチを締め切るまでの最大待ち時間')
+    serve.set_defaults(func=command_serve)
+
+    ensemble = subparsers.add_parser('ensemble', parents=[data_options], help='アンサンブルを一括訓練し、テスト期間で評価する')
+    ensemble.add_argument('--shapes', nargs='+', default=['64x2', '128x3', '32x1'], help='メンバーの形（隠れ層の次元x層数）')
+    ensemble.add_argument('--copies', type=int, default=1, help='形ごとのメンバー数（同じ形の訓練方法は--member-trainingで選ぶ）')
+    ensemble.add_argument('--combiner', choices=['mean', 'weighted', 'stacking'], default='mean')
+    ensemble.add_argument('--bootstrap', action='store_true', help='メンバーごとに訓練データを復元抽出する')
+    ensemble.add_argument('--member-training', choices=['auto', 'stacked', 'sequential'], default='auto',
+                          help='同じ形のメンバーの訓練方法（autoは1ステップの計測で速い方を選ぶ）')
+    ensemble.add_argument('--epochs', type=int, default=20)
+    ensemble.add_argument('--lr', type=float, default=0.001)
+    ensemble.add_argument('--batch-size', type=int, default=256)
+    ensemble.add_argument('--lookback', type=int, default=LOOKBACK)
+    ensemble.add_argument('--horizon', type=int, default=1)
+    ensemble.add_argument('--n-jobs', type=int)
+    ensemble.set_defaults(func=command_ensemble)
+
+    quantize = subparsers.add_parser('quantize', parents=[data_options], help='保存済みモデルをint8に量子化して登録する（精度ガード付き）')
+    quantize.add_argument('--name', default='lstm')
+    quantize.add_argument('--version')
+    quantize.add_argument('--registry-dir', default=MODEL_REGISTRY_DIR)
+    quantize.add_argument('--tolerance', type=float, default=0.05, help='許容するテストMSEの相対的な悪化')
+    quantize.add_argument('--min-speedup', type=float, help='テスト期間の推論がこの倍率以上速くならなければ登録しない')
+    quantize.add_argument('--output-name', help='登録する名前（既定は<name>-int8）')
+    quantize.set_defaults(func=command_quantize)
+
+    update = subparsers.add_parser('update', parents=[data_options], help='新しい行だけで保存済みモデルを追加訓練する（ドリフト時は再訓練）')
+    update.add_argument('--name', default='lstm')
+    update.add_argument('--version')
+    update.add_argument('--registry-dir', default=MODEL_REGISTRY_DIR)
+    update.add_argument('--max-steps', type=int, default=50, help='追加訓練の最大ステップ数')
+    update.add_argument('--batch-size', type=int, default=64)
+    update.add_argument('--drift-factor', type=float, default=3.0, help='新しい行でのMSEが基準のこの倍数を超えたらドリフトとする')
+    update.add_argument('--epochs', type=int, default=100, help='ドリフト時の再訓練のエポック数')
+    update.add_argument('--no-retrain', action='store_true', help='ドリフトを検出しても再訓練しない')
+    update.set_defaults(func=command_update)
+
+    panel = subparsers.add_parser('panel', parents=[data_options], help='銘柄ごとのCSVから複数銘柄のモデルを訓練して登録する')
+    panel.add_argument('--panel', required=True, help='銘柄ごとのCSVを含むディレクトリまたはglob')
+    panel.add_argument('--mode', choices=['shared', 'per_ticker'], default='shared',
+                       help='shared：全銘柄で1つのモデル、per_ticker：銘柄ごとのモデルをプロセスプールで訓練する')
+    panel.add_argument('--name', default='panel')
+    panel.add_argument('--registry-dir', default=MODEL_REGISTRY_DIR)
+    panel.add_argument('--epochs', type=int, default=20)
+    panel.add_argument('--lr', type=float, default=0.001)
+    panel.add_argument('--hidden-dim', type=int, default=64)
+    panel.add_argument('--num-layers', type=int, default=2)
+    panel.add_argument('--lookback', type=int, default=LOOKBACK)
+    panel.add_argument('--batch-size', type=int, default=256)
+    panel.add_argument('--n-jobs', type=int)
+    panel.set_defaults(func=command_panel)
+
+    eda = subparsers.add_parser('eda', parents=[data_options], help='探索的データ分析の図を作成する')
+    eda.add_argument('--mode', choices=['auto', 'full', 'scalable'], default='auto',
+                     help=f'scalableは間引き・ビン集計・キャッシュを使う（autoは{EDA_FULL_MAX_ROWS}行を超えるとscalable）')
+    eda.add_argument('--max-points', type=int, default=EDA_MAX_POINTS, help='折れ線グラフの最大点数')
+    eda.add_argument('--downsample', choices=['lttb', 'minmax'], default='lttb',
+                     help='折れ線の間引き方（lttbは形を保つ点、minmaxは区間ごとの最小値・最大値を残す）')
+    eda.set_defaults(func=command_eda)
+
+    importance = subparsers.add_parser('importance', parents=[data_options], help='特徴量重要度を計算する（結果はキャッシュする）')
+    importance.add_argument('--method', choices=['forest', 'permutation'], default='forest')
+    importance.add_argument('--n-jobs', type=int, default=-1)
+    importance.add_argument('--max-samples', type=int, default=100_000, help='これより多い行は部分標本で計算する')
+    importance.add_argument('--name', default='lstm')
+    importance.add_argument('--version')
+    importance.add_argument('--registry-dir', default=MODEL_REGISTRY_DIR)
+    importance.set_defaults(func=command_importance)
+
+    baselines = subparsers.add_parser('baselines', parents=[data_options], help='持続・EWMA・AR(p)・リッジのベースラインを評価する')
+    baselines.add_argument('--lookback', type=int, default=LOOKBACK)
+    baselines.add_argument('--horizon', type=int, default=1)
+    baselines.add_argument('--output', help='結果を保存するCSVのパス')
+    baselines.set_defaults(func=command_baselines)
+
+    run = subparsers.add_parser('run', parents=[data_options], help='全工程を実行する（サブコマンド省略時の既定）')
+    run.add_argument('--force', nargs='+', metavar='STAGE',
+                     help='キャッシュがあっても再計算する工程（下流の工程も再計算する）')
+    run.add_argument('--n-jobs', type=int, help='同時に実行する工程の数')
+    run.set_defaults(func=command_run)
+
+    startup = subparsers.add_parser('startup', help='モジュールのインポート時間を計測する')
+    startup.add_argument('--runs', type=int, default=3)
+    startup.set_defaults(func=command_startup)
+
+    benchmark = subparsers.add_parser('benchmark', help='合成データで主要な処理の時間とメモリを計測する')
+    benchmark.add_argument('--scale', nargs='+', choices=list(BENCHMARK_SCALES), default=['small'])
+    benchmark.add_argument('--cases', nargs='+', choices=list(BENCHMARK_CASES), help='省略時はすべてのケース')
+    benchmark.add_argument('--rows', type=int, help='プリセットの代わりに行数を指定する')
+    benchmark.add_argument('--tickers', type=int, help='プリセットの代わりに銘柄数を指定する')
+    benchmark.add_argument('--repeat', type=int, default=3)
+    benchmark.add_argument('--epochs', type=int, default=2)
+    benchmark.add_argument('--batch-size', type=int, default=256)
+    benchmark.add_argument('--lookback', type=int, default=LOOKBACK)
+    benchmark.add_argument('--threads', type=int, default=1, help='torchのスレッド数（マシン間で比較しやすいよう既定は1）')
+    benchmark.add_argument('--n-jobs', type=int, default=1)
+    benchmark.add_argument('--backtest-mode', choices=['cold', 'warm', 'parallel'], default='cold')
+    benchmark.add_argument('--chunk-rows', type=int, default=100_000, help='train_streamのチャンクの行数')
+    benchmark.add_argument('--seed', type=int, default=0)
+    benchmark.add_argument('--output-dir', default='benchmarks')
+    benchmark.add_argument('--compare', help='比較の基準にする結果JSONのパス')
+    benchmark.set_defaults(func=command_benchmark)
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # サブコマンドを省略した場合はrunとして解析する（全体のオプションの後にrunのオプションを続けてもよい）
+    global_args, rest = build_global_options().parse_known_args(argv)
+    if not rest or (rest[0].startswith('-') and rest[0] not in ('-h', '--help')):
+        args = parser.parse_args(['run'] + rest, namespace=global_args)
+    else:
+        args = parser.parse_args(argv)
+    if args.headless:
+        PLOT_SETTINGS['enabled'] = False
+    INFERENCE_SETTINGS['precision'] = args.precision
+    if args.plot_dir:
+        PLOT_SETTINGS['output_dir'] = args.plot_dir
+    if args.profile_dir:
+        INSTRUMENTATION.configure(args.profile_dir, capture=args.profile, prefix=f'{args.command}-' + time.strftime('%Y%m%d-%H%M%S'))
+    try:
+        args.func(args)
+    finally:
+        INSTRUMENTATION.save()
 
-        model.eval()
-        with torch.no_grad():
-            predictions = model(X_val_tensor)
-        mse = mean_squared_error(y_val, predictions.numpy())
-        cv_scores.append(mse)
-
-    print(f"Cross-validation MSE scores: {cv_scores}")
-    print(f"Average MSE: {np.mean(cv_scores):.4f}")
-
-# クロスバリデーションの実行
-print("クロスバリデーションの実行:")
-cv_model = LSTMModel(input_dim=X_train_tensor.shape[2], hidden_dim=64, output_dim=1, num_layers=2)
-perform_cross_validation(X_scaled, y_scaled, cv_model)
\ No newline at end of file
+# メイン実行部分
+if __name__ == "__main__":
+    main()
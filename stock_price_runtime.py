@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight CPU inference runtime
+軽量なCPU推論ランタイム
+
+stock_price__prediction_model.pyのsave_modelで保存したモデルを読み込んで推論する。
+pandas・matplotlib・seaborn・statsmodels・scikit-learnは読み込まない。
+"""
+
+import os
+import json
+import numpy as np
+import torch
+
+# 保存済みモデルのバージョンディレクトリを解決する（未指定の場合は最新）
+def resolve_version_dir(name, version=None, registry_dir='models'):
+    if version is None:
+        with open(os.path.join(registry_dir, name, 'LATEST')) as f:
+            version = f.read().strip()
+    return os.path.join(registry_dir, name, version)
+
+# コンパイル済みモデルとスケーラーのパラメータだけで推論する
+class CompiledPredictor:
+    def __init__(self, version_dir, backend='torchscript'):
+        with open(os.path.join(version_dir, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.feature_columns = self.manifest['feature_columns']
+        self.lookback = self.manifest['lookback']
+        self.x_min = np.array(self.manifest['scaler_X']['min'])
+        self.x_scale = np.array(self.manifest['scaler_X']['scale'])
+        self.y_min = np.array(self.manifest['scaler_y']['min'])
+        self.y_scale = np.array(self.manifest['scaler_y']['scale'])
+        self.backend = backend
+        if backend == 'onnx':
+            import onnxruntime
+            self.session = onnxruntime.InferenceSession(os.path.join(version_dir, 'model.onnx'), providers=['CPUExecutionProvider'])
+        else:
+            self.module = torch.jit.load(os.path.join(version_dir, 'model.ts'), map_location='cpu')
+            self.module.eval()
+
+    # 入力は生の特徴量（バッチ x lookback x 特徴量数）、出力は元の価格単位
+    def predict(self, X):
+        X = np.asarray(X, dtype='float64')
+        if X.ndim == 2:
+            X = X[np.newaxis]
+        X_scaled = (X * self.x_scale + self.x_min).astype('float32')
+        if self.backend == 'onnx':
+            output = self.session.run(None, {'input': X_scaled})[0]
+        else:
+            with torch.inference_mode():
+                output = self.module(torch.from_numpy(X_scaled)).numpy()
+        return (output - self.y_min) / self.y_scale
+
+def load_predictor(name, version=None, registry_dir='models', backend='torchscript'):
+    return CompiledPredictor(resolve_version_dir(name, version, registry_dir), backend=backend)